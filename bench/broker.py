@@ -0,0 +1,148 @@
+import os, sys, asyncio, struct, threading, argparse
+# Minimal MQTT 3.1.1 broker for benchmarks and local runs without mosquitto:
+# CONNECT, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards and $share/<group>/
+# shared subscriptions (round-robin), PUBLISH at QoS 0/1 (PUBACK on
+# receipt, no redelivery of unacked messages), retained messages, PINGREQ,
+# persistent sessions: a clean_session=0 client that goes away keeps its
+# subscriptions and has QoS-1 messages queued (up to `queue` each, in
+# memory) until it reconnects. Sessions survive stop()/start() on the same
+# Broker, which is how bench/recovery.py restarts it. No auth, no wills.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+from shared.transport import topic_matches, share_group
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n % 128; n //= 128
+        out.append(b | 0x80 if n else b)
+        if not n: return bytes(out)
+
+def _str(b, i):
+    n = struct.unpack_from("!H", b, i)[0]; return b[i+2:i+2+n].decode("utf-8"), i+2+n
+
+class _Session:
+    def __init__(self, writer):
+        self.writer = writer; self.client_id = None; self.subs = {}; self._pid = 0; self.clean = True
+    def next_pid(self):
+        self._pid = self._pid % 65535 + 1; return self._pid
+    def send_publish(self, topic, payload, qos, retain=False):
+        t = topic.encode("utf-8"); body = struct.pack("!H", len(t)) + t
+        if qos: body += struct.pack("!H", self.next_pid())
+        body += payload
+        self.writer.write(bytes([0x30 | (qos << 1) | (1 if retain else 0)]) + _varint(len(body)) + body)
+
+class Broker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 1883, queue: int = 1000):
+        self.host = host; self.port = port; self.sessions = {}; self.retained = {}; self.stored = {}; self.queue = queue
+        self.msgs_in = 0; self.msgs_out = 0; self._server = None; self.loop = None; self._rr = {}
+        self.queued = 0; self.dropped = 0; self.resumed = 0
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]; return self
+    async def stop(self):
+        self._server.close()
+        for s in list(self.sessions.values()): s.writer.close()
+        await self._server.wait_closed()
+    def serve_in_thread(self) -> int:
+        # Run on a private loop in a daemon thread; returns the bound port.
+        ready = threading.Event()
+        def run():
+            loop = asyncio.new_event_loop(); asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start()); ready.set(); loop.run_forever()
+        threading.Thread(target=run, name="bench-broker", daemon=True).start(); ready.wait(); return self.port
+    def stop_in_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result(timeout=5)
+    def start_in_thread(self):
+        # After stop_in_thread(): listen again on the same port and loop.
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result(timeout=5)
+
+    async def _client(self, reader, writer):
+        s = _Session(writer)
+        try:
+            while True:
+                h = await reader.readexactly(1); n = 0; mul = 1
+                while True:
+                    b = (await reader.readexactly(1))[0]; n += (b & 0x7F) * mul; mul *= 128
+                    if not b & 0x80: break
+                body = await reader.readexactly(n) if n else b""
+                if not self._packet(s, h[0], body): break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError): pass
+        finally:
+            if s.client_id is not None and self.sessions.get(s.client_id) is s:
+                del self.sessions[s.client_id]
+                if not s.clean: self.stored[s.client_id] = (s.subs, [])
+            writer.close()
+
+    def _packet(self, s, h, b) -> bool:
+        kind = h >> 4
+        if kind == 1:  # CONNECT
+            _, i = _str(b, 0); s.clean = bool(b[i+1] & 2); i += 4; cid, i = _str(b, i)
+            cid = cid or f"anon-{id(s):x}"; old = self.sessions.get(cid); prev = self.stored.pop(cid, None)
+            if old is not None and old is not s:
+                old.writer.close()
+                if not old.clean: prev = (old.subs, [])
+            if s.clean: prev = None
+            s.client_id = cid; self.sessions[cid] = s; s.writer.write(b"\x20\x02" + (b"\x01" if prev else b"\x00") + b"\x00")
+            if prev:
+                s.subs, q = prev; self.resumed += 1
+                for topic, payload in q: s.send_publish(topic, payload, 1); self.msgs_out += 1
+        elif kind == 3:  # PUBLISH
+            qos = (h >> 1) & 3; retain = h & 1; topic, i = _str(b, 0)
+            if qos: pid = b[i:i+2]; i += 2; s.writer.write(b"\x40\x02" + pid)
+            self.publish(topic, b[i:], qos, bool(retain))
+        elif kind == 8:  # SUBSCRIBE
+            pid = b[:2]; i = 2; granted = bytearray(); new = []
+            while i < len(b):
+                flt, i = _str(b, i); q = min(b[i], 1); i += 1; s.subs[flt] = q; granted.append(q); new.append(flt)
+            s.writer.write(bytes([0x90]) + _varint(2+len(granted)) + pid + bytes(granted))
+            new = [f for f in new if not f.startswith("$share/")]
+            for topic, (payload, q) in list(self.retained.items()):
+                for flt in new:
+                    if topic_matches(flt, topic):
+                        s.send_publish(topic, payload, min(q, s.subs[flt]), retain=True); self.msgs_out += 1; break
+        elif kind == 10:  # UNSUBSCRIBE
+            pid = b[:2]; i = 2
+            while i < len(b): flt, i = _str(b, i); s.subs.pop(flt, None)
+            s.writer.write(b"\xb0\x02" + pid)
+        elif kind == 12: s.writer.write(b"\xd0\x00")  # PINGREQ
+        elif kind == 14: return False  # DISCONNECT
+        return True
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self.msgs_in += 1
+        if retain:
+            if payload: self.retained[topic] = (payload, qos)
+            else: self.retained.pop(topic, None)
+        shared = {}
+        for s in list(self.sessions.values()):
+            q = None
+            for flt, sq in s.subs.items():
+                g, flt = share_group(flt)
+                if not topic_matches(flt, topic): continue
+                if g is None: q = sq if q is None else max(q, sq)
+                else: shared.setdefault((g, flt), []).append((s, sq))
+            if q is not None: s.send_publish(topic, payload, min(q, qos)); self.msgs_out += 1
+        if qos and self.stored:
+            for subs, q in self.stored.values():
+                if any(sq and not flt.startswith("$share/") and topic_matches(flt, topic) for flt, sq in subs.items()):
+                    if len(q) < self.queue: q.append((topic, payload)); self.queued += 1
+                    else: self.dropped += 1
+        for k, members in shared.items():
+            n = self._rr[k] = self._rr.get(k, -1) + 1; s, q = members[n % len(members)]
+            s.send_publish(topic, payload, min(q, qos)); self.msgs_out += 1
+    def stats(self):
+        return {"clients": len(self.sessions), "retained": len(self.retained), "msgs_in": self.msgs_in, "msgs_out": self.msgs_out,
+                "stored": len(self.stored), "queued": self.queued, "dropped": self.dropped, "resumed": self.resumed}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="stand-in MQTT broker")
+    ap.add_argument("--host", default="127.0.0.1"); ap.add_argument("--port", type=int, default=1883)
+    a = ap.parse_args()
+    async def main():
+        b = await Broker(a.host, a.port).start(); print(f"[broker] listening on {a.host}:{b.port}")
+        await asyncio.Event().wait()
+    asyncio.run(main())
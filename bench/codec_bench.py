@@ -0,0 +1,47 @@
+import os, sys, json, time, argparse
+# Codec micro-benchmark: encode/decode cost and wire size per message type
+# for stdlib JSON, orjson (if installed) and the binary schemas.
+#   python -m bench.codec_bench --n 200000
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+from shared import codec
+
+RID = "slot-07-1f2e3d4c-2a"
+MESSAGES = {
+    "wallet_get": {"device_id": "slot-07", "tag_uid": "04A1B2C3D4", "req_id": RID},
+    "wallet_debit": {"device_id": "slot-07", "tag_uid": "04A1B2C3D4", "amount_cents": 200, "reason": "slot_bet", "req_id": RID},
+    "wallet_res": {"req_id": RID, "type": "wallet_debit", "status": "ok", "new_balance_cents": 123400},
+    "payout_new": {"payout_id": "PO-20261018-120000-a1b2", "source": "roulette", "amount_cents": 5000, "meta": {"round": "R-20261018-120000-a1b2"}},
+    "payout_claim": {"device_id": "change-01", "payout_id": "PO-20261018-120000-a1b2", "tag_uid": "04A1B2C3D4", "req_id": RID},
+    "claim_res": {"req_id": RID, "type": "payout_claim", "status": "ok", "credited_cents": 5000, "new_balance_cents": 128400},
+}
+
+def timeit(fn, arg, n):
+    t = time.perf_counter()
+    for _ in range(n): fn(arg)
+    return (time.perf_counter() - t) / n * 1e9
+
+def backends():
+    out = {"json": (lambda o: json.dumps(o, separators=(",", ":")).encode("utf-8"), json.loads)}
+    try:
+        import orjson; out["orjson"] = (orjson.dumps, orjson.loads)
+    except ImportError: pass
+    out["bin"] = (lambda o: codec.encode(o, "bin"), codec.decode)
+    return out
+
+def bench(n):
+    res = {}
+    for name, msg in MESSAGES.items():
+        row = res[name] = {}
+        for b, (enc, dec) in backends().items():
+            wire = enc(msg)
+            if dec(wire) != msg: raise SystemExit(f"{b} round-trip mismatch on {name}")
+            row[b] = {"bytes": len(wire), "encode_ns": round(timeit(enc, msg, n)), "decode_ns": round(timeit(dec, wire, n)),
+                      "binary": codec.content_type(wire) == "bin"}
+    return res
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="payload codec micro-benchmark")
+    ap.add_argument("--n", type=int, default=100000, help="iterations per measurement")
+    a = ap.parse_args()
+    print(json.dumps({"json_backend": codec.JSON_BACKEND, "n": a.n, "messages": bench(a.n)}, indent=2))
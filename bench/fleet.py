@@ -0,0 +1,197 @@
+import os, sys, json, time, random, asyncio, argparse, tempfile, contextlib, subprocess, urllib.request
+# Fleet load generator: N simulated slot/roulette/blackjack/change agents
+# running their real event loops (devices/*/agent.run) with keyboard and
+# GPIO left out, driven by synthetic events. Reports throughput and
+# request->response latency per op, plus SQLite commit counts, as JSON.
+#
+#   python -m bench.fleet --slots 20 --duration 10 --out run.json
+#   python -m bench.fleet --broker loopback          # deterministic, network-free
+#   python -m bench.fleet --broker 127.0.0.1:1883 --core external --core-url http://127.0.0.1:8000
+#   python -m bench.fleet --core-shards 4               # sharded core: 4 worker processes
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+from devices.common.event_bus import EventBus, Event
+from devices.common.mqtt_helper import MqttClient
+from devices.slot import agent as slot_agent
+from devices.roulette import agent as roulette_agent
+from devices.blackjack import agent as blackjack_agent
+from devices.change import agent as change_agent
+from shared.transport import loopback_broker
+from bench.broker import Broker
+
+def pct(xs, p):
+    if not xs: return None
+    xs = sorted(xs); return xs[min(len(xs)-1, int(round(p/100.0*(len(xs)-1))))]
+
+class Recorder:
+    def __init__(self):
+        self.lat = {}; self.sent = {}; self.status = {}; self.timeouts = {}; self.payouts = {}
+    def sent_one(self, op): self.sent[op] = self.sent.get(op, 0) + 1
+    def done(self, op, dt, status):
+        self.lat.setdefault(op, []).append(dt)
+        st = self.status.setdefault(op, {}); st[status] = st.get(status, 0) + 1
+    def timeout(self, op): self.timeouts[op] = self.timeouts.get(op, 0) + 1
+    def report(self, duration):
+        out = {}
+        for op in sorted(set(self.sent) | set(self.lat)):
+            xs = self.lat.get(op, [])
+            out[op] = {"sent": self.sent.get(op, 0), "done": len(xs), "timeouts": self.timeouts.get(op, 0),
+                       "status": self.status.get(op, {}), "throughput_per_s": round(len(xs)/duration, 1),
+                       **{f"p{p}_ms": (round(pct(xs, p)*1000, 3) if xs else None) for p in (50, 95, 99)},
+                       "max_ms": round(max(xs)*1000, 3) if xs else None}
+        return out
+
+class TimedClient(MqttClient):
+    # MqttClient that records request->response latency per op (last topic
+    # segment: get/debit/credit/claim) and payout_new send times.
+    def __init__(self, rec, *a, **k):
+        super().__init__(*a, **k); self.rec = rec
+    async def request(self, topic, payload, timeout=5.0):
+        op = topic.rsplit("/", 1)[-1]; self.rec.sent_one(op); t = time.perf_counter()
+        try: res = await super().request(topic, payload, timeout)
+        except asyncio.TimeoutError: self.rec.timeout(op); raise
+        self.rec.done(op, time.perf_counter()-t, res.get("status")); return res
+    def publish(self, topic, payload, qos=1, retain=False):
+        if topic.endswith("/payouts/new"): self.rec.sent_one("payout"); self.rec.payouts[payload["payout_id"]] = time.perf_counter()
+        super().publish(topic, payload, qos=qos, retain=retain)
+
+def parse_mix(s):
+    mix = {}
+    for part in s.split(","):
+        k, _, v = part.partition("="); mix[k.strip()] = float(v or 1)
+    return mix
+
+def start_core(host, port, db_path):
+    os.environ.update({"BROKER_HOST": host, "BROKER_PORT": str(port), "DB_PATH": db_path})
+    sys.path.insert(0, os.path.join(ROOT, "core"))
+    import core; core.start_mqtt()
+    return core
+
+def start_shards(host, port, db_path, n):
+    # One process per shard (own GIL, own SQLite file) on a TCP broker.
+    code = f"import sys, time; sys.path[:0] = [{os.path.join(ROOT, 'core')!r}, {ROOT!r}]; import core; core.start_mqtt(); time.sleep(1e9)"
+    out = subprocess.DEVNULL
+    return [subprocess.Popen([sys.executable, "-c", code], stdout=out, stderr=out,
+                             env=dict(os.environ, BROKER_HOST=host, BROKER_PORT=str(port), DB_PATH=db_path, CORE_SHARDS=str(n), CORE_SHARD=str(i)))
+            for i in range(n)]
+
+def core_stats(core, core_url):
+    if core is not None: return core.db.ledger_stats()
+    if core_url:
+        try:
+            with urllib.request.urlopen(core_url.rstrip("/")+"/api/runtime", timeout=5) as r: return json.load(r).get("ledger")
+        except Exception as e: return {"error": str(e)}
+    return None
+
+async def drive(bus, gen, rate, stop_at):
+    # Open-loop: emit one event every 1/rate s regardless of completions. gen
+    # returns an Event for the agent, or a coroutine run as its own task.
+    step = 1.0/rate; nxt = time.perf_counter() + random.random()*step; pending = set()
+    while time.perf_counter() < stop_at:
+        x = gen()
+        if isinstance(x, Event): await bus.publish(x)
+        else: t = asyncio.ensure_future(x); pending.add(t); t.add_done_callback(pending.discard)
+        nxt += step
+        await asyncio.sleep(max(0.0, nxt - time.perf_counter()))
+
+async def bench(a):
+    rec = Recorder(); broker = None
+    if a.broker == "inproc":
+        broker = Broker(port=0); host, port = "127.0.0.1", broker.serve_in_thread()
+    elif a.broker == "loopback":
+        # No sockets at all: core and agents share the in-process broker.
+        os.environ["EG_TRANSPORT"] = "loopback"; host, port = "bench", 1883; broker = loopback_broker(host, port)
+    else:
+        host, _, port = a.broker.partition(":"); port = int(port or 1883)
+    db_path = a.db or os.path.join(tempfile.mkdtemp(), "core.db"); core = None; shards = []
+    if a.core == "inproc" and a.core_shards > 1:
+        if a.broker == "loopback": raise SystemExit("--core-shards needs a TCP broker (inproc or host:port)")
+        shards = start_shards(host, port, db_path, a.core_shards); ids = {f"core-{i+1:02d}" for i in range(a.core_shards)}
+        for _ in range(300):
+            # Stand-in broker: wait until every shard has subscribed; otherwise give them 3s.
+            if broker is None: await asyncio.sleep(3); break
+            if all(i in broker.sessions and broker.sessions[i].subs for i in ids): break
+            await asyncio.sleep(0.1)
+    elif a.core == "inproc": core = start_core(host, port, db_path)
+    loop = asyncio.get_running_loop(); mix = parse_mix(a.mix); ops = list(mix); weights = [mix[k] for k in ops]
+    ns = os.getenv("MQTT_NAMESPACE", "eg")
+
+    # payout_new has no reply: its latency is publish -> delta on the feed.
+    watch = MqttClient(client_id=f"bench-watch-{os.getpid()}", host=host, port=port, ns=ns, clean_session=True)
+    def on_delta(c, u, m):
+        t = time.perf_counter()
+        for it in json.loads(m.payload.decode()).get("added", []):
+            t0 = rec.payouts.pop(it["payout_id"], None)
+            if t0 is not None: rec.done("payout", t - t0, "ok")
+    watch.on_message(on_delta); watch.connect()
+    watch.on_connect(lambda c, u, f, rc: c.subscribe(watch.topic("dev", "change-01", "payouts", "delta"), qos=1))
+
+    agents = []; tasks = []; mqs = {}
+    def spawn(mod, did, **kw):
+        bus = EventBus(); mq = TimedClient(rec, client_id=did, host=host, port=port, ns=ns, max_inflight=a.inflight); mq.connect()
+        agents.append(bus); tasks.append(asyncio.create_task(mod.run(bus, loop, did, mq, {}, **kw))); mqs[did] = mq; return bus
+    async def get(mq, tag):
+        # The slot reads balances from the retained wallet topic and sends no
+        # wallet_get of its own, so the bench sends the request itself.
+        try: await mq.request(mq.topic("core", "wallet", "get"), {"tag_uid": tag})
+        except asyncio.TimeoutError: pass
+    await asyncio.sleep(0.2)
+    drivers = []
+    for i in range(a.slots):
+        tag = f"BENCH{i:04d}"; bus = spawn(slot_agent, f"slot-b{i:03d}", rfid=False); mq = mqs[f"slot-b{i:03d}"]
+        await bus.publish(Event("rfid_scan", {"tag_uid": tag})); await bus.publish(Event("credit", {"amount_cents": 10**9}))
+        def gen(tag=tag, mq=mq):
+            op = random.choices(ops, weights)[0]
+            if op == "get": return get(mq, tag)
+            if op == "credit": return Event("credit", {"amount_cents": 500})
+            return Event("bet", {"amount_cents": 200})
+        drivers.append((bus, gen, a.rate))
+    for mod, n in ((roulette_agent, a.roulette), (blackjack_agent, a.blackjack)):
+        for i in range(n):
+            bus = spawn(mod, f"{mod.__name__.split('.')[-2]}-b{i:02d}")
+            drivers.append((bus, lambda: Event("gen_payout", {"amount_cents": random.choice([2000, 5000, 10000])}), a.payout_rate))
+    if a.claim_rate > 0:
+        bus = spawn(change_agent, "change-01"); await bus.publish(Event("rfid_scan", {"tag_uid": "BENCHCHANGE"}))
+        drivers.append((bus, lambda: Event("menu", {"key": "ok"}), a.claim_rate))
+
+    await asyncio.sleep(a.warmup); rec.__init__(); base = core_stats(core, a.core_url) or {}
+    t0 = time.perf_counter(); stop_at = t0 + a.duration
+    await asyncio.gather(*(drive(bus, gen, rate, stop_at) for bus, gen, rate in drivers if rate > 0)); duration = time.perf_counter() - t0
+    await asyncio.sleep(a.drain)
+    end = core_stats(core, a.core_url) or {}
+    for bus in agents: await bus.publish(Event("quit", {}))
+    await asyncio.wait(tasks, timeout=2)
+    for p in shards: p.kill()
+    sqlite = {k: end[k] - base.get(k, 0) for k in ("commits", "batches", "batched_ops") if isinstance(end.get(k), int)} if end else None
+    done = sum(len(v) for v in rec.lat.values())
+    return {"config": {k: v for k, v in vars(a).items() if k not in ("out", "verbose")}, "duration_s": round(duration, 3),
+            "ops": rec.report(duration), "total": {"done": done, "throughput_per_s": round(done/duration, 1)},
+            "sqlite": sqlite, "broker": broker.stats() if broker else None,
+            "runtime": {"ledger": end} if core is not None else None}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="EG fleet load generator")
+    ap.add_argument("--broker", default="inproc", help="'inproc' (stand-in TCP broker), 'loopback' (in-process transport) or host:port of mosquitto")
+    ap.add_argument("--core", choices=["inproc", "external"], default="inproc")
+    ap.add_argument("--core-url", default=None, help="core HTTP base URL for commit counts when --core external")
+    ap.add_argument("--db", default=None, help="core DB path for --core inproc (default: temp file)")
+    ap.add_argument("--core-shards", type=int, default=1, help="run the inproc core as N shard processes (CORE_SHARDS)")
+    ap.add_argument("--slots", type=int, default=10); ap.add_argument("--roulette", type=int, default=1); ap.add_argument("--blackjack", type=int, default=1)
+    ap.add_argument("--rate", type=float, default=20.0, help="ops/s per slot")
+    ap.add_argument("--mix", default="get=1,debit=6,credit=2", help="slot op weights")
+    ap.add_argument("--payout-rate", type=float, default=2.0, help="payouts/s per table")
+    ap.add_argument("--claim-rate", type=float, default=2.0, help="claims/s at the change station (0 = no change agent)")
+    ap.add_argument("--inflight", type=int, default=64, help="max in-flight requests per agent")
+    ap.add_argument("--duration", type=float, default=10.0); ap.add_argument("--warmup", type=float, default=1.0); ap.add_argument("--drain", type=float, default=1.0)
+    ap.add_argument("--out", default=None, help="write JSON report here (default: stdout)")
+    ap.add_argument("--verbose", action="store_true", help="keep agent console output")
+    a = ap.parse_args(argv)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if a.verbose else devnull):
+        report = asyncio.run(bench(a))
+    s = json.dumps(report, indent=2)
+    if a.out:
+        with open(a.out, "w") as f: f.write(s + "\n")
+    print(s)
+
+if __name__ == "__main__":
+    main()
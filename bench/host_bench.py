@@ -0,0 +1,50 @@
+import os, sys, json, time, asyncio, argparse, contextlib, tempfile
+# Device host cost: RSS, threads and broker connections for N virtual slots
+# in one process, shared connection (devices.host) vs one connection per
+# device, against the stand-in broker and an in-process core. Each slot
+# does a tap + bet so the per-device routing is exercised.
+#   python -m bench.host_bench --devices 1,10,50
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+from devices.common.event_bus import Event
+from devices.common.mqtt_helper import SharedConnection
+from devices.host import Host, rss_kb
+from bench.broker import Broker
+from bench.fleet import start_core
+
+async def one(n, shared, host, port, broker):
+    loop = asyncio.get_running_loop(); kb0 = rss_kb(); cid = f"bench-host-{n}"
+    conn = SharedConnection(cid, host, port) if shared else None
+    if conn is not None: conn.connect()
+    h = Host(loop, conn, host, port); h.base_kb = kb0; t = time.perf_counter()
+    for i in range(n): h.add({"kind": "slot", "device_id": f"slot-h{i:03d}"})
+    started = time.perf_counter() - t; await asyncio.sleep(0.5)
+    for i, (_, did, bus, mq, _) in enumerate(h.devices):
+        await bus.publish(Event("rfid_scan", {"tag_uid": f"HOST{i:04d}"})); await bus.publish(Event("bet", {"amount_cents": 0}))
+    await asyncio.sleep(1.0)
+    st = h.stats(); clients = sum(1 for k in list(broker.sessions) if k == cid or k.startswith("slot-h"))
+    await h.stop()
+    for c in {mq.client for _, _, _, mq, _ in h.devices}: c.disconnect(); c.loop_stop()
+    await asyncio.sleep(0.3)
+    return {"devices": n, "shared": shared, "broker_connections": clients, "rss_kb_delta": st["rss_kb"] - kb0,
+            "rss_per_device_kb": st["rss_per_device_kb"], "threads": st["threads"], "start_ms": round(started*1000, 1), "routing": st["shared"]}
+
+async def bench(a):
+    broker = Broker(port=0); port = broker.serve_in_thread(); host = "127.0.0.1"
+    start_core(host, port, os.path.join(tempfile.mkdtemp(), "core.db")); await asyncio.sleep(0.3)
+    out = []
+    for n in [int(x) for x in a.devices.split(",")]:
+        for shared in (True, False): out.append(await one(n, shared, host, port, broker))
+    return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="device host memory/connection benchmark")
+    ap.add_argument("--devices", default="1,10,50", help="comma-separated device counts")
+    ap.add_argument("--verbose", action="store_true", help="keep agent console output")
+    a = ap.parse_args(argv)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if a.verbose else devnull):
+        report = asyncio.run(bench(a))
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os, sys, json, time, asyncio, argparse, tempfile, threading, contextlib, subprocess, statistics
+# Broker restart recovery: an in-process core and N devices making steady
+# wallet requests against the stand-in broker, which is stopped for --down
+# seconds and started again on the same port (sessions kept). Reports how
+# the reconnects spread out (first CONNECT per client after the restart,
+# peak per 100 ms), how long until every device has a reply again, request
+# timeouts, broker session/queue counts and the core's admission stats.
+# Each mode runs in its own process, since the transport reads its env once:
+#   python -m bench.recovery --devices 100 --down 5 --out recovery.json
+#   python -m bench.recovery --modes persistent,clean,nojitter
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+MODES = {"persistent": {"MQTT_PERSISTENT": "1", "RECONNECT_JITTER": "1"},
+         "clean": {"MQTT_PERSISTENT": "0", "RECONNECT_JITTER": "1"},
+         "nojitter": {"MQTT_PERSISTENT": "1", "RECONNECT_JITTER": "0"},
+         "clean-nojitter": {"MQTT_PERSISTENT": "0", "RECONNECT_JITTER": "0"}}
+
+async def device(mq, tag, rate, stop_at, log):
+    step = 1.0/rate; nxt = time.perf_counter()
+    while time.perf_counter() < stop_at:
+        t = time.perf_counter()
+        try: await mq.request(mq.topic("core", "wallet", "get"), {"tag_uid": tag}, timeout=2.0); log.append((t, time.perf_counter(), True))
+        except asyncio.TimeoutError: log.append((t, time.perf_counter(), False))
+        nxt += step; await asyncio.sleep(max(0.0, nxt - time.perf_counter()))
+
+async def run_one(a):
+    from bench.broker import Broker
+    from bench.fleet import start_core
+    from devices.common.mqtt_helper import MqttClient
+    class ConnBroker(Broker):
+        def __init__(self, *x, **k): super().__init__(*x, **k); self.connects = []; self._l = threading.Lock()
+        def _packet(self, s, h, b):
+            ok = super()._packet(s, h, b)
+            if h >> 4 == 1:
+                with self._l: self.connects.append((time.perf_counter(), s.client_id))
+            return ok
+    broker = ConnBroker(port=0); port = broker.serve_in_thread()
+    core = start_core("127.0.0.1", port, os.path.join(tempfile.mkdtemp(), "core.db"))
+    devs = [MqttClient(client_id=f"rec-{i:03d}", host="127.0.0.1", port=port) for i in range(a.devices)]
+    for mq in devs: mq.connect()
+    await asyncio.sleep(1.0)
+    stop_at = time.perf_counter() + a.warmup + a.down + a.after; logs = [[] for _ in devs]
+    tasks = [asyncio.create_task(device(mq, f"REC{i:04d}", a.rate, stop_at, logs[i])) for i, mq in enumerate(devs)]
+    await asyncio.sleep(a.warmup)
+    t_down = time.perf_counter(); broker.stop_in_thread(); await asyncio.sleep(a.down)
+    broker.start_in_thread(); t_up = time.perf_counter()
+    await asyncio.gather(*tasks)
+    first = {}
+    for t, cid in broker.connects:
+        if t >= t_up and cid not in first: first[cid] = t
+    offs = sorted((t - t_up)*1000 for cid, t in first.items() if cid.startswith("rec-"))
+    peak = {}
+    for o in offs: peak[int(o//100)] = peak.get(int(o//100), 0) + 1
+    back = []
+    for log in logs:
+        ok = [e for s, e, good in log if good and s >= t_up]
+        back.append(ok[0] - t_up if ok else None)
+    n = lambda cond: sum(1 for log in logs for s, e, good in log if cond(s, good))
+    return {"devices": a.devices, "down_s": a.down,
+            "reconnect_ms": {"clients": len(offs), "first": round(offs[0], 1) if offs else None, "p50": round(statistics.median(offs), 1) if offs else None,
+                             "last": round(offs[-1], 1) if offs else None, "peak_per_100ms": max(peak.values()) if peak else 0},
+            "all_back_s": round(max(back), 3) if None not in back else None, "missing": back.count(None),
+            "requests": {"before": n(lambda s, g: s < t_down), "during": n(lambda s, g: t_down <= s < t_up), "after": n(lambda s, g: s >= t_up),
+                         "timeouts_after": n(lambda s, g: s >= t_up and not g)},
+            "connects": len(broker.connects), "paho_reconnect_waits": sum(getattr(mq.client, "reconnects", 0) for mq in devs),
+            "broker": broker.stats(), "admission": core.admit.stats()}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="fleet recovery after a broker restart")
+    ap.add_argument("--modes", default="persistent,clean,nojitter"); ap.add_argument("--devices", type=int, default=50)
+    ap.add_argument("--rate", type=float, default=2.0, help="requests/s per device"); ap.add_argument("--down", type=float, default=5.0)
+    ap.add_argument("--warmup", type=float, default=2.0); ap.add_argument("--after", type=float, default=20.0)
+    ap.add_argument("--one", action="store_true", help=argparse.SUPPRESS); ap.add_argument("--out", default=None)
+    a = ap.parse_args(argv)
+    if a.one:
+        with contextlib.redirect_stdout(sys.stderr): res = asyncio.run(run_one(a))
+        print(json.dumps(res)); return
+    out = {}
+    for m in a.modes.split(","):
+        args = [sys.executable, "-m", "bench.recovery", "--one", "--devices", str(a.devices), "--rate", str(a.rate), "--down", str(a.down),
+                "--warmup", str(a.warmup), "--after", str(a.after)]
+        p = subprocess.run(args, cwd=ROOT, env=dict(os.environ, **MODES[m], TXLOG_ROTATE_SEC="0"), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        out[m] = json.loads(p.stdout) if p.returncode == 0 else {"error": p.returncode}
+        print(f"[recovery] {m}: {out[m]}", file=sys.stderr)
+    res = json.dumps(out, indent=2)
+    if a.out:
+        with open(a.out, "w") as f: f.write(res + "\n")
+    else: print(res)
+
+if __name__ == "__main__":
+    main()
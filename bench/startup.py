@@ -0,0 +1,89 @@
+import os, sys, json, time, socket, argparse, tempfile, subprocess, statistics, threading
+# Cold/warm start: time from spawning a process to its first PUBLISH at the
+# broker (and its CONNECT), for each agent and for the core under uvicorn,
+# against the stand-in broker. Run 1 starts from an empty state dir / DB
+# (hardware probe, schema DDL); later runs reuse them.
+#   python -m bench.startup --runs 5 --out startup.json
+# Agents are driven over stdin to publish right away (slot: tap + bet,
+# tables: payout); the change station publishes nothing on its own, so its
+# first SUBSCRIBE is used instead.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+from bench.broker import Broker
+
+SCRIPTS = {"slot": "r STARTUP01\nb\n", "roulette": "b\n", "blackjack": "b\n", "change": ""}
+
+class TimedBroker(Broker):
+    # Records when each client id first sent CONNECT / SUBSCRIBE / PUBLISH.
+    def __init__(self, *a, **k):
+        super().__init__(*a, **k); self.first = {}; self._cv = threading.Condition()
+    def _packet(self, s, h, b):
+        ok = super()._packet(s, h, b); kind = {1: "connect", 3: "publish", 8: "subscribe"}.get(h >> 4)
+        if kind and s.client_id:
+            with self._cv: self.first.setdefault((s.client_id, kind), time.perf_counter()); self._cv.notify_all()
+        return ok
+    def wait(self, cid, kinds, timeout):
+        end = time.monotonic() + timeout
+        with self._cv:
+            while not any((cid, k) in self.first for k in kinds):
+                left = end - time.monotonic()
+                if left <= 0: return False
+                self._cv.wait(left)
+        return True
+    def reset(self, cid):
+        with self._cv:
+            for k in [k for k in self.first if k[0] == cid]: del self.first[k]
+
+def free_port():
+    with socket.socket() as s: s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def run_once(broker, cmd, cid, kinds, env, cwd, stdin, timeout):
+    broker.reset(cid); t0 = time.perf_counter()
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if stdin: p.stdin.write(stdin.encode()); p.stdin.flush()
+        ok = broker.wait(cid, kinds, timeout)
+    finally:
+        p.kill(); p.wait()
+    if not ok: return None
+    ms = lambda k: round((broker.first[(cid, k)] - t0)*1000, 1) if (cid, k) in broker.first else None
+    return {"connect_ms": ms("connect"), "first_ms": min(v for v in (ms(k) for k in kinds) if v is not None)}
+
+def summarize(runs):
+    ok = [r for r in runs if r]; warm = ok[1:]
+    med = lambda k, xs: round(statistics.median(r[k] for r in xs), 1) if xs else None
+    return {"cold": ok[0] if ok else None, "warm_connect_ms": med("connect_ms", warm), "warm_first_ms": med("first_ms", warm),
+            "failed": len(runs) - len(ok)}
+
+def bench(a):
+    broker = TimedBroker(port=0); port = broker.serve_in_thread(); out = {}
+    base = dict(os.environ, BROKER_HOST="127.0.0.1", BROKER_PORT=str(port))
+    for kind in a.agents.split(","):
+        state = tempfile.mkdtemp(prefix=f"eg-{kind}-"); cid = f"{kind}-01"
+        kinds = ("publish",) if SCRIPTS[kind] else ("subscribe",)
+        env = dict(base, EG_STATE_DIR=state)
+        runs = [run_once(broker, [sys.executable, "-m", f"devices.{kind}.agent", "--device-id", cid], cid, kinds, env, ROOT, SCRIPTS[kind], a.timeout)
+                for _ in range(a.runs)]
+        out[kind] = {"first": kinds[0], **summarize(runs)}; print(f"[startup] {kind}: {out[kind]}", file=sys.stderr)
+    if a.core:
+        d = tempfile.mkdtemp(prefix="eg-core-")
+        env = dict(base, DB_PATH=os.path.join(d, "core.db"), TXLOG_ROTATE_SEC="0", WEB_DIR=os.path.join(ROOT, "core", "web"), PYTHONPATH=ROOT)
+        runs = [run_once(broker, [sys.executable, "-m", "uvicorn", "core:app", "--host", "127.0.0.1", "--port", str(free_port()), "--log-level", "warning"],
+                         "core-01", ("publish",), env, os.path.join(ROOT, "core"), "", a.timeout) for _ in range(a.runs)]
+        out["core"] = {"first": "publish", **summarize(runs)}; print(f"[startup] core: {out['core']}", file=sys.stderr)
+    return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="agent and core start-up time")
+    ap.add_argument("--agents", default="slot,roulette,blackjack,change")
+    ap.add_argument("--no-core", dest="core", action="store_false")
+    ap.add_argument("--runs", type=int, default=5); ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--out", default=None)
+    a = ap.parse_args(argv)
+    res = json.dumps(bench(a), indent=2)
+    if a.out:
+        with open(a.out, "w") as f: f.write(res + "\n")
+    else: print(res)
+
+if __name__ == "__main__":
+    main()
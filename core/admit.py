@@ -0,0 +1,33 @@
+import threading, time
+class Admission:
+    # Token bucket in front of the dispatcher for device requests (rate/s,
+    # up to `burst` at once; rate 0 = off), applied only while a fleet's
+    # backlog can arrive at once: for `window` seconds after a reconnect or a
+    # resumed session, and to redelivered (dup) messages. In steady state
+    # every request passes untouched. When the bucket is empty acquire()
+    # holds paho's network thread, the same backpressure as a full dispatch
+    # queue: the replayed requests (the session queue plus every device's
+    # unacked resends) stay with the broker and reach the ledger at `rate`.
+    # Only the network thread calls acquire().
+    def __init__(self, rate: float, burst: int, window: float):
+        self.rate = rate; self.burst = max(1, burst); self.window = window; self.tokens = float(self.burst); self._last = time.monotonic(); self._lock = threading.Lock()
+        self.until = 0.0; self.connects = 0; self.windows = 0
+        self.admitted = 0; self.delayed = 0; self.waited = 0.0; self.max_wait = 0.0; self.redelivered = 0
+    def connected(self, session_present: bool):
+        # The first clean connect has nothing queued for us; later ones may.
+        self.connects += 1
+        if self.rate <= 0 or not (session_present or self.connects > 1): return
+        with self._lock: self.until = time.monotonic() + self.window; self.tokens = float(self.burst); self._last = time.monotonic()
+        self.windows += 1
+    def acquire(self, dup=False):
+        self.admitted += 1
+        if dup: self.redelivered += 1
+        if self.rate <= 0 or not (dup or (self.until and time.monotonic() < self.until)): return
+        with self._lock:
+            now = time.monotonic(); self.tokens = min(self.burst, self.tokens + (now - self._last)*self.rate); self._last = now
+            self.tokens -= 1; wait = -self.tokens/self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.delayed += 1; self.waited += wait; self.max_wait = max(self.max_wait, wait); time.sleep(wait)
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst, "window_s": self.window, "active": time.monotonic() < self.until, "windows": self.windows,
+                "admitted": self.admitted, "delayed": self.delayed, "waited_s": round(self.waited, 3), "max_wait_ms": round(self.max_wait*1000, 3), "redelivered": self.redelivered}
@@ -1,76 +1,336 @@
-import os, json
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+import os, time, threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import paho.mqtt.client as mqtt
-from db import DB
+from db import DB, MISS
+from dispatch import Dispatcher
+from feed import PayoutFeed, BalanceFeed
+from tally import Tally
+from txlog import TxLog
+from reads import ReadPool
+import reads
+from shared.transport import create_client
+from admit import Admission
+from shard import Shards, db_path
+from metrics import Metrics, rss_bytes, topic_family
+from latency import Traces, Latency
+from stream import StateView, PARTS
+from shared import codec
 
 BROKER_HOST=os.getenv("BROKER_HOST","localhost"); BROKER_PORT=int(os.getenv("BROKER_PORT","1883"))
-NS=os.getenv("MQTT_NAMESPACE","eg"); DB_PATH=os.getenv("DB_PATH","/data/core.db")
+TRANSPORT=os.getenv("EG_TRANSPORT","paho"); NS=os.getenv("MQTT_NAMESPACE","eg"); CORE_SHARDS=int(os.getenv("CORE_SHARDS","1")); CORE_SHARD=int(os.getenv("CORE_SHARD","0")); XFER_RETRY_SEC=float(os.getenv("XFER_RETRY_SEC","5"))
+DB_PATH=db_path(os.getenv("DB_PATH","/data/core.db"), CORE_SHARDS, CORE_SHARD)
+WEB_DIR=os.getenv("WEB_DIR",os.path.join(os.path.dirname(os.path.abspath(__file__)),"web"))
+DISPATCH_WORKERS=int(os.getenv("DISPATCH_WORKERS","4")); DISPATCH_DEPTH=int(os.getenv("DISPATCH_DEPTH","1024"))
+PAYOUT_PAGE_SIZE=int(os.getenv("PAYOUT_PAGE_SIZE","50")); PAYOUT_SNAPSHOT_DEBOUNCE=float(os.getenv("PAYOUT_SNAPSHOT_DEBOUNCE","2"))
+TXLOG_DIR=os.getenv("TXLOG_DIR",os.path.join(os.path.dirname(os.path.abspath(DB_PATH)),"txlog" if CORE_SHARDS<=1 else f"txlog-{CORE_SHARD}")); TXLOG_PARTITION=os.getenv("TXLOG_PARTITION","day")
+TXLOG_ROTATE_SEC=float(os.getenv("TXLOG_ROTATE_SEC","3600")); TXLOG_RETAIN_DAYS=float(os.getenv("TXLOG_RETAIN_DAYS","0"))
+TALLY_INTERVAL=float(os.getenv("TALLY_INTERVAL","0.25")); TALLY_KEEP_STEPS=int(os.getenv("TALLY_KEEP_STEPS","4"))
+CLAIM_MANY_MAX=int(os.getenv("CLAIM_MANY_MAX","50")); READ_POOL_SIZE=int(os.getenv("READ_POOL_SIZE","4")); API_MAX_LIMIT=int(os.getenv("API_MAX_LIMIT","1000"))
+LATENCY_WINDOW_SEC=float(os.getenv("LATENCY_WINDOW_SEC","300")); STREAM_INTERVAL=float(os.getenv("STREAM_INTERVAL_MS","100"))/1000.0; STREAM_DEPTH=int(os.getenv("STREAM_DEPTH","64"))
+ADMIT_RATE=float(os.getenv("ADMIT_RATE","1000")); ADMIT_BURST=int(os.getenv("ADMIT_BURST","200")); ADMIT_WINDOW_SEC=float(os.getenv("ADMIT_WINDOW_SEC","10"))
 
-app=FastAPI(title="EG Core",version="1.3.0"); app.mount("/web", StaticFiles(directory="/app/web", html=True), name="web")
+@asynccontextmanager
+async def lifespan(app):
+    start_mqtt(); yield
+app=FastAPI(title="EG Core",version="1.3.0",lifespan=lifespan); app.mount("/web", StaticFiles(directory=WEB_DIR, html=True), name="web")
 db=DB(DB_PATH)
-client=mqtt.Client(client_id="core-01", clean_session=True); client.enable_logger()
+dispatcher=Dispatcher(DISPATCH_WORKERS, DISPATCH_DEPTH)
+txlog=TxLog(db, TXLOG_DIR, TXLOG_PARTITION, TXLOG_ROTATE_SEC, TXLOG_RETAIN_DAYS).start()
+rpool=ReadPool(DB_PATH, READ_POOL_SIZE)
+shards=Shards(NS, CORE_SHARDS, CORE_SHARD, retry=XFER_RETRY_SEC)
+traces=Traces(); latency=Latency(LATENCY_WINDOW_SEC); dispatcher.started=traces.started
+admit=Admission(ADMIT_RATE, ADMIT_BURST, ADMIT_WINDOW_SEC)
+client=create_client(TRANSPORT, client_id=f"core-{CORE_SHARD+1:02d}")
+
+# /metrics. METRICS_SAMPLE (0..1) is the share of handler runs / DB calls
+# timed; counters and gauges are always on.
+metrics=Metrics()
+m_in=metrics.counter("eg_mqtt_messages_in_total", "MQTT messages received by the core, by handler topic", ("topic",))
+m_out=metrics.counter("eg_mqtt_messages_out_total", "MQTT messages published by the core, by topic family", ("topic",))
+dispatcher.timer=metrics.histogram("eg_handler_seconds", "handler run time on the dispatch workers, by topic", ("topic",))
+dispatcher.wait=metrics.histogram("eg_dispatch_wait_seconds", "time a message waits in its dispatch queue, by topic", ("topic",))
+db.timer=metrics.histogram("eg_db_seconds", "DB time: lock_wait per caller, exec per ledger op, commit per batch", ("kind","op"))
+metrics.gauge("eg_process_rss_bytes", "resident set size", rss_bytes)
+metrics.gauge("eg_process_threads", "live threads", threading.active_count)
+metrics.gauge("eg_mqtt_inflight", "QoS>0 publishes awaiting broker ack (paho)", lambda: getattr(client, "_inflight_messages", 0))
+metrics.gauge("eg_mqtt_out_queue", "outgoing messages held by the MQTT client (paho)", lambda: len(getattr(client, "_out_messages", ())))
+metrics.gauge("eg_dispatch_queue_depth", "queued messages per dispatch worker", lambda: {(str(i),): q.qsize() for i, q in enumerate(dispatcher.queues)}, ("worker",))
+metrics.gauge("eg_dispatch_stalls", "submits that blocked on a full dispatch queue", lambda: sum(dispatcher.stalls))
+metrics.gauge("eg_admission_delayed", "device requests held by admission control since start", lambda: admit.delayed)
+metrics.gauge("eg_admission_wait_seconds", "total time requests were held by admission control", lambda: admit.waited)
+metrics.gauge("eg_ledger_queue_depth", "ops waiting for the ledger writer", lambda: db._q.qsize())
+metrics.gauge("eg_ledger_commits", "SQLite commits since start", lambda: db.commits)
+metrics.gauge("eg_ledger_batched_ops", "ops applied by the ledger writer since start", lambda: db.batched_ops)
+metrics.gauge("eg_balance_cache_hits", "balance cache hits since start", lambda: db.cache_hits)
+metrics.gauge("eg_balance_cache_misses", "balance cache misses since start", lambda: db.cache_misses)
 
 def T(*p): return "/".join([NS]+list(p))
-def pub(t,p,qos=1,retain=False): client.publish(t, json.dumps(p,separators=(",",":")), qos=qos, retain=retain)
+def pub(t,p,qos=1,retain=False,ctype="json"):
+    client.publish(t, b"" if p is None else codec.encode(p, ctype), qos=qos, retain=retain); m_out.inc(topic_family(t))
+feed=PayoutFeed(db, pub, T("dev","change-01","payouts"), PAYOUT_PAGE_SIZE, PAYOUT_SNAPSHOT_DEBOUNCE)
+balances=BalanceFeed(db, pub, T("state","wallet"))
+tally=Tally(db, pub, T("night","tally"), TALLY_INTERVAL, TALLY_KEEP_STEPS)
+view=StateView(db, STREAM_INTERVAL, STREAM_DEPTH); tally.listeners.append(view.on_tally)
 
 def on_connect(c,u,f,rc):
-    c.subscribe(T("core","#"),qos=1); c.subscribe(T("night","vote"),qos=1)
-    pub(T("state","mode"), {"mode": db.get_mode()}, qos=1, retain=True)
+    sp=bool((f or {}).get("session present")); print(f"[core] MQTT rc={rc} session_present={sp}"); admit.connected(sp)
+    for t in shards.subscriptions(T("core","#"), T("night","vote")): c.subscribe(t, qos=1)
+    c.subscribe(T("dev","+","telemetry"), qos=0)  # every shard keeps the whole floor view
+    if shards.mine(0):
+        pub(T("state","mode"), {"mode": db.get_mode()}, qos=1, retain=True)
+        feed.publish_snapshot()
 
 def on_message(c,u,msg):
-    try: p=json.loads(msg.payload.decode("utf-8"))
+    fwd=shards.inbound(msg.topic) if shards.on else None
+    h=HANDLERS.get(msg.topic) if fwd is None else HANDLERS.get(fwd) or INTERNAL.get(fwd)
+    if h is None:
+        if fwd is None and msg.topic.startswith(DEV_PREFIX) and msg.topic.endswith("/telemetry"): telemetry_in(msg.payload)
+        return
+    m_in.inc(fwd or msg.topic)
+    if fwd is None: admit.acquire(getattr(msg, "dup", 0))
+    try: p=codec.decode(msg.payload)
+    except: return
+    if not isinstance(p, dict): return
+    if fwd is None and shards.on:
+        j=owner(msg.topic, p)
+        if not shards.mine(j):
+            t=shards.topic(j, msg.topic); client.publish(t, msg.payload, qos=1); shards.count("forwarded"); m_out.inc(topic_family(t)); return
+    if (fwd or msg.topic) in HANDLERS:
+        if msg.payload[0]==codec.MAGIC: _codecs[p.get("device_id")]="bin"
+        else: _codecs.pop(p.get("device_id"), None)
+    if "tr" in p: traces.begin(p)
+    if "tag_uid" in p: view.seen(p.get("device_id"), p["tag_uid"])
+    fn,key=h; dispatcher.submit(key(p), fn, p)
+
+DEV_PREFIX=T("dev","")
+def telemetry_in(payload):
+    m_in.inc(T("dev","+","telemetry"))
+    try: p=codec.decode(payload)
     except: return
-    if msg.topic==T("core","wallet","get"): wallet_get(p)
-    elif msg.topic==T("core","wallet","debit"): wallet_debit(p)
-    elif msg.topic==T("core","wallet","credit"): wallet_credit(p)
-    elif msg.topic==T("core","payouts","new"): payout_new(p)
-    elif msg.topic==T("core","payouts","claim"): payout_claim(p)
-    elif msg.topic==T("night","vote"): vote(p)
+    if isinstance(p, dict): dispatcher.submit(p.get("device_id"), telemetry, p)
 
-def respond(dev_id, body): pub(T("dev",dev_id,"res"), body, qos=1, retain=False)
+# Replies go out in the encoding of the device's last request; broadcasts and
+# retained state stay JSON for the browser UIs.
+_codecs={}
+def respond(dev_id, body, ctype=None): pub(T("dev",dev_id,"res"), traces.finish(dev_id, body), qos=1, retain=False, ctype=ctype or _codecs.get(dev_id,"json"))
 
 def wallet_get(p):
+    # From the cache, unless writes for this tag are still queued: then the
+    # read queues behind them, so it answers after them with their result.
     r=p.get("req_id"); d=p.get("device_id"); tag=p.get("tag_uid","").upper()
-    bal=db.get_balance(tag); db.log("wallet_get", d, tag, None, {"balance":bal})
-    respond(d, {"req_id":r,"type":"wallet_get","status":"ok","balance_cents":bal})
+    def ok(bal):
+        db.log("wallet_get", d, tag, None, {"balance":bal}); view.balance(tag, bal); return {"status":"ok","balance_cents":bal}
+    if db.queued(tag): durable(db.submit("balance", tag), d, r, "wallet_get", ok); return
+    respond(d, {"req_id":r,"type":"wallet_get", **ok(db.get_balance(tag))})
+
+def durable(f, d, r, typ, ok):
+    # Reply once the ledger batch holding this op has committed.
+    def done(f):
+        traces.done(d, r)
+        try: body=ok(f.result())
+        except Exception as e: print(f"[core] {typ} failed: {e}"); body={"status":"error"}
+        respond(d, {"req_id":r,"type":typ, **body})
+    f.add_done_callback(done)
+
+def ledger(p, typ, op, args, ok):
+    # Runs a ledger op at most once per (device_id, req_id); a redelivered
+    # request gets the stored result replayed instead of touching wallets.
+    r=p.get("req_id"); d=p.get("device_id"); tag=p.get("tag_uid","").upper()
+    if r is None or d is None: durable(db.submit(op, *args, tag=tag), d, r, typ, ok); return
+    res=db.replay(d, r)
+    if res is not MISS: respond(d, {"req_id":r,"type":typ, **ok(res)}); return
+    durable(db.submit("idem", d, r, op, *args, tag=tag), d, r, typ, ok)
 
 def wallet_debit(p):
-    r=p.get("req_id"); d=p.get("device_id"); tag=p.get("tag_uid","").upper(); amt=int(p.get("amount_cents",0))
-    nb=db.debit(tag, amt, d, "wallet_debit")
-    respond(d, {"req_id":r,"type":"wallet_debit","status":"ok" if nb is not None else "insufficient","new_balance_cents":nb})
+    d=p.get("device_id"); tag=p.get("tag_uid","").upper(); amt=int(p.get("amount_cents",0))
+    ledger(p, "wallet_debit", "debit", (tag, amt, d, "wallet_debit"),
+           lambda nb: {"status":"ok" if nb is not None else "insufficient","new_balance_cents":nb})
 
 def wallet_credit(p):
-    r=p.get("req_id"); d=p.get("device_id"); tag=p.get("tag_uid","").upper(); amt=int(p.get("amount_cents",0))
-    nb=db.credit(tag, amt, d, "wallet_credit")
-    respond(d, {"req_id":r,"type":"wallet_credit","status":"ok","new_balance_cents":nb})
+    d=p.get("device_id"); tag=p.get("tag_uid","").upper(); amt=int(p.get("amount_cents",0))
+    ledger(p, "wallet_credit", "credit", (tag, amt, d, "wallet_credit"), lambda nb: {"status":"ok","new_balance_cents":nb})
 
 def payout_new(p):
-    db.create_payout(p.get("payout_id"), p.get("source","unknown"), int(p.get("amount_cents",0)), p.get("meta",{}))
-    pub(T("dev","change-01","payouts"), {"items": db.list_ready_payouts()}, qos=1, retain=False)
+    # The feed publishes the delta once the batch commits. Tables send these
+    # through their outbox: the ack (req_id echoed once durable) lets them
+    # drop the entry, and a resent payout_id is ignored by create_payout.
+    f=db.submit("create_payout", p.get("payout_id"), p.get("source","unknown"), int(p.get("amount_cents",0)), p.get("meta",{}))
+    if p.get("req_id") and p.get("device_id"): durable(f, p["device_id"], p["req_id"], "payout_new", lambda _: {"status":"ok"})
+
+def payout_sync(p):
+    feed.publish_snapshot()
 
 def payout_claim(p):
-    r=p.get("req_id"); d=p.get("device_id"); tag=p.get("tag_uid","").upper(); pid=p.get("payout_id")
-    amt,status=db.claim_payout(pid, tag, d)
-    if status!="ok": respond(d, {"req_id":r,"type":"payout_claim","status":status}); return
-    nb=db.credit(tag, int(amt), d, "payout_claim_credit")
-    respond(d, {"req_id":r,"type":"payout_claim","status":"ok","credited_cents":int(amt),"new_balance_cents":nb})
-    pub(T("dev","change-01","payouts"), {"items": db.list_ready_payouts()}, qos=1, retain=False)
-
-_votes={}
+    d=p.get("device_id"); tag=p.get("tag_uid","").upper(); pid=p.get("payout_id"); j=shards.owner(tag)
+    if not shards.mine(j): claim_remote(p, j, [pid]); return
+    def ok(res):
+        amt,status,nb=res
+        if status!="ok": return {"status":status}
+        return {"status":"ok","credited_cents":int(amt),"new_balance_cents":nb}
+    ledger(p, "payout_claim", "claim_credit", (pid, tag, d), ok)
+
+def payout_claim_many(p):
+    # Several payouts to one tag: one round trip, one commit, one credit of
+    # the total. "all": true claims all of them or none.
+    d=p.get("device_id"); tag=p.get("tag_uid","").upper(); j=shards.owner(tag)
+    pids=[x for x in (p.get("payout_ids") or [])[:CLAIM_MANY_MAX] if x]; every=bool(p.get("all"))
+    if not shards.mine(j): claim_remote(p, j, pids, every, "payout_claim_many"); return
+    ledger(p, "payout_claim_many", "claim_many", (pids, tag, d, every), lambda res: res)
+
+# --- cross-shard claims (see shard.py) ---------------------------------------
+def claim_remote(p, j, pids, every=False, typ="payout_claim"):
+    # On shard 0 for a tag owned by shard j: claim + record the transfers
+    # here in one commit, the owner credits and replies. A redelivered claim
+    # resends the transfers.
+    r=p.get("req_id"); d=p.get("device_id"); tag=p.get("tag_uid","").upper(); many=typ=="payout_claim_many"
+    def go(res):
+        st=res["status"] if many else res["results"][0]["status"]
+        if st!="ok":
+            respond(d, {"req_id":r,"type":typ, **(res if many else {"status":st})}); return
+        items=[{"payout_id":x["payout_id"],"amount_cents":x["credited_cents"]} for x in res["results"] if x["status"]=="ok"]
+        xfer_send(tag, j, d, r, items, typ, res["results"] if many else None, traces.handoff(d, r))
+    def done(f):
+        try: go(f.result())
+        except Exception as e: print(f"[core] {typ} failed: {e}"); respond(d, {"req_id":r,"type":typ,"status":"error"})
+    if r is None or d is None: db.submit("claim_many", pids, tag, d, every, j, r).add_done_callback(done); return
+    res=db.replay(d, r)
+    if res is not MISS: go(res); return
+    db.submit("idem", d, r, "claim_many", pids, tag, d, every, j, r).add_done_callback(done)
+
+def xfer_send(tag, j, d, r, items, typ="payout_claim", results=None, tr=None):
+    pub(shards.topic(j, T("core","xfer","credit")), {"tag_uid":tag,"device_id":d,"req_id":r,"items":items,"type":typ,"results":results,
+                                                     "from":shards.index,"ctype":_codecs.get(d,"json"),"tr":tr})
+    shards.count("xfers_sent", len(items))
+
+def xfer_credit(p):
+    # Owner side: credit each payout_id at most once (all in one commit),
+    # reply to the device, ack shard 0.
+    d=p.get("device_id"); r=p.get("req_id"); tag=by_tag(p); items=p.get("items") or []
+    if not items: return
+    steps=[("idem", "xfer", it["payout_id"], "credit", tag, int(it["amount_cents"]), d, "payout_claim_credit") for it in items]
+    def applied(f):
+        try: nb=f.result()[-1]
+        except Exception as e: print(f"[core] xfer credit {[it['payout_id'] for it in items]} failed: {e}"); return
+        shards.count("xfers_credited", len(items)); traces.done(d, r)
+        body={"status":"ok","credited_cents":sum(int(it["amount_cents"]) for it in items),"new_balance_cents":nb}
+        if p.get("results") is not None: body["results"]=p["results"]
+        respond(d, {"req_id":r,"type":p.get("type","payout_claim"), **body}, p.get("ctype"))
+        pub(shards.topic(int(p.get("from",0)), T("core","xfer","ack")), {"tag_uid":tag,"payout_ids":[it["payout_id"] for it in items]})
+    db.atomic(*steps, tag=tag).add_done_callback(applied)
+
+def xfer_ack(p):
+    db.atomic(*[("xfer_done", pid) for pid in p.get("payout_ids") or []])
+
+def xfer_retry():
+    while True:
+        time.sleep(shards.retry)
+        try:
+            for x in db.xfers_due(time.time()-shards.retry):
+                xfer_send(x["tag_uid"], x["shard"], x["device_id"], x["req_id"], [{"payout_id":x["payout_id"],"amount_cents":x["amount_cents"]}])
+                shards.count("xfers_resent")
+        except Exception as e: print(f"[core] xfer retry failed: {e}")
+
 def vote(p):
-    step=str(p.get("step")); _votes.setdefault(step,{})[p.get("device_id")]=p.get("choice")
-    db.log("vote", p.get("device_id","?"), None, None, p)
+    tally.vote(p)
+
+def telemetry(p):
+    latency.add(p)
+
+def by_tag(p): return str(p.get("tag_uid","")).upper()
+def by_payout(p): return p.get("payout_id")
+def by_device(p): return p.get("device_id")
+# topic -> (handler, shard key). Claims are keyed by tag: the credit is a
+# wallet op, and double claims of one payout are settled by the DB anyway.
+HANDLERS={
+    T("core","wallet","get"): (wallet_get, by_tag),
+    T("core","wallet","debit"): (wallet_debit, by_tag),
+    T("core","wallet","credit"): (wallet_credit, by_tag),
+    T("core","payouts","new"): (payout_new, by_payout),
+    T("core","payouts","claim"): (payout_claim, by_tag),
+    T("core","payouts","claim_many"): (payout_claim_many, by_tag),
+    T("core","payouts","sync"): (payout_sync, by_device),
+    T("night","vote"): (vote, by_device),
+}
+# Shard-to-shard only: reachable on <ns>/shard/<i>/..., never from devices.
+INTERNAL={
+    T("core","xfer","credit"): (xfer_credit, by_tag),
+    T("core","xfer","ack"): (xfer_ack, by_tag),
+}
+dispatcher.labels={fn: t for t, (fn, _) in {**HANDLERS, **INTERNAL}.items()}; dispatcher.labels[telemetry]=T("dev","+","telemetry")
+WALLET_OPS={T("core","wallet",op) for op in ("get","debit","credit")}
+def owner(topic, p): return shards.owner(by_tag(p)) if topic in WALLET_OPS else 0
 
 @app.post("/api/mode")
 async def api_mode(req: Request):
-    body=await req.json(); mode=body.get("mode","day"); db.set_mode(mode)
+    body=await req.json(); mode=body.get("mode","day"); db.set_mode(mode); view.set_mode(mode)
     pub(T("state","mode"), {"mode":mode}, qos=1, retain=True); return {"ok":True,"mode":mode}
 
 @app.post("/api/night/step")
 async def api_night_step(req: Request):
-    body=await req.json(); pub(T("night","step"), body, qos=1, retain=False); return {"ok":True}
+    body=await req.json()
+    if body.get("step") is not None: tally.open(str(body["step"]))
+    view.set_step(body)
+    pub(T("night","step"), body, qos=1, retain=False); return {"ok":True}
+
+# Kiosk pages: one SSE stream from the core instead of a broker websocket
+# each. A "snapshot" event on connect, then coalesced "diff" events.
+def _parts(parts):
+    ps=tuple(x for x in parts.split(",") if x)
+    if any(x not in PARTS for x in ps): raise HTTPException(400, "parts: "+", ".join(PARTS))
+    return ps
+
+@app.get("/api/stream")
+async def api_stream(device_id: str | None = None, parts: str = ",".join(PARTS)):
+    return StreamingResponse(view.stream(device_id, _parts(parts)), media_type="text/event-stream", headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
+
+@app.get("/api/view")
+def api_view(device_id: str | None = None, parts: str = ",".join(PARTS)):
+    return view.snapshot(device_id, _parts(parts))
+
+@app.get("/metrics")
+def api_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/latency")
+def api_latency(device_id: str | None = None):
+    # Device-measured RTT per op over the last LATENCY_WINDOW_SEC, floor-wide and per device.
+    return latency.view(device_id)
+
+@app.get("/api/runtime")
+def api_runtime():
+    return {"ledger": db.ledger_stats(), "balance_cache": db.cache_stats(), "dispatch": dispatcher.stats(), "payout_feed": feed.stats(), "balance_feed": balances.stats(),
+            "idempotency": db.idem_stats(), "txlog": txlog.stats(), "reads": rpool.stats(), "tally": tally.stats(), "shards": shards.stats(), "traces": traces.stats(), "latency": latency.stats(), "stream": view.stats(), "admission": admit.stats(), "codec": {"json": codec.JSON_BACKEND, "bin_devices": sorted(d for d in _codecs if d)}}
+
+# Read endpoints run on the read pool: no DB.lock, nothing on the event loop.
+def _limit(n): return min(max(int(n),1),API_MAX_LIMIT)
+
+@app.get("/api/wallets/{tag}")
+async def api_wallet(tag: str):
+    if not shards.mine(shards.owner(tag.upper())): raise HTTPException(421, f"tag owned by shard {shards.owner(tag.upper())}")
+    w=await rpool.run(reads.wallet, tag.upper())
+    if w is None: raise HTTPException(404, "unknown tag")
+    return w
+
+@app.get("/api/tx")
+async def api_tx(device_id: str | None = None, tag_uid: str | None = None, op: str | None = None, since: str | None = None, until: str | None = None,
+                 after_id: int = 0, limit: int = 100):
+    # Live table and archive segments as one id-ordered log; page with after_id=<next_after_id>.
+    rows=await rpool.run(lambda c: txlog.query(device_id, tag_uid.upper() if tag_uid else None, op, since, until, after_id, _limit(limit), conn=c))
+    return {"rows":rows,"next_after_id":rows[-1]["id"] if rows else None}
+
+@app.get("/api/stats")
+async def api_stats(group: str = "device_id", since: str | None = None, until: str | None = None, device_id: str | None = None, source: str | None = None):
+    # Straight from the rollup table: cost grows with buckets, not history.
+    g=tuple(x for x in group.split(",") if x)
+    if any(x not in ("hour","device_id","source") for x in g): raise HTTPException(400, "group: hour, device_id, source")
+    return {"group": list(g), "rows": await rpool.run(reads.stats, g, since, until, device_id, source)}
+
+@app.get("/api/payouts")
+async def api_payouts(status: str = "ready", after: str | None = None, limit: int = 100):
+    rows,nxt=await rpool.run(reads.payouts, status, after, _limit(limit))
+    return {"rows":rows,"next":nxt}
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -85,6 +345,9 @@ async def index():
 </body></html>'''
 
 def start_mqtt():
+    # Runs from the app's lifespan (uvicorn core:app); in-process embedders
+    # (allinone, bench) call it after import. Later calls do nothing.
+    if client.on_message is on_message: return
     client.on_connect=on_connect; client.on_message=on_message
-    client.connect(BROKER_HOST, BROKER_PORT, keepalive=30); client.loop_start()
-start_mqtt()
+    client.connect_async(BROKER_HOST, BROKER_PORT, keepalive=30); client.loop_start()
+    if shards.on and shards.mine(0): threading.Thread(target=xfer_retry, name="xfer-retry", daemon=True).start()
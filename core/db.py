@@ -1,60 +1,413 @@
-import sqlite3, json, datetime, threading
+import sqlite3, json, datetime, threading, queue, time, os, zlib
+from collections import OrderedDict
+from concurrent.futures import Future
 class DB:
-    def __init__(self, path: str):
-        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    def __init__(self, path: str, batch_max: int | None = None, batch_ms: float | None = None, cache_size: int | None = None,
+                 idem_size: int | None = None, idem_ttl: float | None = None):
+        self.path = path; self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
         self.conn.row_factory = sqlite3.Row
         self.lock = threading.Lock()
+        self.batch_max = int(batch_max if batch_max is not None else os.getenv("LEDGER_BATCH_MAX","256"))
+        self.batch_ms = float(batch_ms if batch_ms is not None else os.getenv("LEDGER_BATCH_MS","2"))
+        self.commits = 0; self.batches = 0; self.batched_ops = 0
+        self._q = queue.SimpleQueue(); self._writer = None
+        self.cache_size = int(cache_size if cache_size is not None else os.getenv("BALANCE_CACHE_SIZE","4096"))
+        self._cache = OrderedDict(); self._clock = threading.Lock()
+        self.cache_hits = 0; self.cache_misses = 0; self.cache_evictions = 0
+        self._dirty = {}; self._undo = []; self._events = []; self._queued = {}
+        self.listeners = []
+        # timer: optional metrics.Histogram labelled (kind, op), kind one of
+        # lock_wait / exec / commit; only sampled calls are timed.
+        self.timer = None
+        self.idem_size = int(idem_size if idem_size is not None else os.getenv("IDEM_CACHE_SIZE","8192"))
+        self.idem_ttl = float(idem_ttl if idem_ttl is not None else os.getenv("IDEM_TTL_SEC","86400"))
+        self._reqs = OrderedDict(); self.idem_hits = 0; self.idem_db_hits = 0; self.idem_misses = 0; self._idem_pruned = 0.0
+        self._idem_rows = 0; self._idem_base = None
         self._init()
+        if self.batch_max > 1:
+            self._writer = threading.Thread(target=self._write_loop, name="ledger-writer", daemon=True); self._writer.start()
     def _init(self):
+        # user_version holds a checksum of schema.sql: an unchanged schema
+        # skips the DDL script (journal_mode=WAL is stored in the file;
+        # synchronous is per connection).
+        sql = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),'schema.sql'),'r').read(); ver = zlib.crc32(sql.encode()) & 0x7FFFFFFF
         with self.lock, self.conn:
-            self.conn.executescript(open('/app/schema.sql','r').read())
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != ver:
+                self.conn.executescript(sql); self.conn.execute(f"PRAGMA user_version={ver}")
+            # wallet_seq numbers the commits that changed wallets, across
+            # restarts. A new DB starts it at epoch ms, above any commit count
+            # published as "v" before it was persisted.
+            r = self.conn.execute("SELECT value FROM kv WHERE key='wallet_seq'").fetchone()
+            self.wallet_v = int(r[0]) if r else int(time.time()*1000)
     def now(self): return datetime.datetime.utcnow().isoformat(timespec="seconds")+"Z"
+
+    # --- transactions -------------------------------------------------------
+    # Ops named "_xxx" assume the caller holds self.lock inside an open
+    # transaction; public methods wrap them in tx(). With group commit on,
+    # submit() queues ops for the writer thread, which applies up to batch_max
+    # of them (or whatever arrives within batch_ms) in a single COMMIT and only
+    # then resolves the callers' futures. The queue is FIFO and there is one
+    # writer, so per-tag ordering is the submission order. Ops submitted with
+    # tag= are counted until their future resolves; queued(tag) tells a read
+    # whether it has to queue behind them instead of answering from the cache.
+    def tx(self, op: str = "tx"):
+        return _Tx(self, op)
+    def _locked(self, op: str, timed: bool | None = None):
+        # self.lock, with the wait timed when a timer is attached and sampling.
+        # The writer passes its per-batch decision (timed) so lock wait, exec
+        # and commit are measured on the same batches.
+        t = self.timer
+        if timed is None: timed = t is not None and t.sampled()
+        return _Timed(self, op) if timed else self.lock
+    def submit(self, op: str, *args, tag: str | None = None) -> Future:
+        f = Future(); fn = getattr(self, "_"+op)
+        if tag is not None and self._writer is not None:
+            with self._clock: self._queued[tag] = self._queued.get(tag, 0) + 1
+            f.add_done_callback(lambda _: self._settled(tag))
+        if self._writer is None:
+            try:
+                with self.tx(op): r = fn(*args)
+                f.set_result(r)
+            except Abort as e: f.set_result(e.result)
+            except Exception as e: f.set_exception(e)
+            return f
+        self._q.put((f, fn, args)); return f
+    def _settled(self, tag):
+        with self._clock:
+            n = self._queued.pop(tag) - 1
+            if n: self._queued[tag] = n
+    def queued(self, tag) -> bool: return tag in self._queued
+    def _write_loop(self):
+        while True:
+            batch = [self._q.get()]; deadline = time.monotonic() + self.batch_ms/1000.0
+            while len(batch) < self.batch_max:
+                try: batch.append(self._q.get_nowait()); continue
+                except queue.Empty: pass
+                left = deadline - time.monotonic()
+                if left <= 0: break
+                try: batch.append(self._q.get(timeout=left))
+                except queue.Empty: break
+            self._apply(batch)
+    def _apply(self, batch):
+        done = []; t = self.timer; timed = t is not None and t.sampled()
+        with self._locked("writer", timed):
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                for f, fn, args in batch:
+                    self.conn.execute("SAVEPOINT op"); mark = self._mark()
+                    if timed: t0 = time.perf_counter()
+                    try: r = fn(*args)
+                    except Abort as e:
+                        self.conn.execute("ROLLBACK TO op"); self.conn.execute("RELEASE op"); self._undo_to(mark)
+                        done.append((f, e.result, None)); continue
+                    except Exception as e:
+                        self.conn.execute("ROLLBACK TO op"); self.conn.execute("RELEASE op"); self._undo_to(mark)
+                        done.append((f, None, e)); continue
+                    self.conn.execute("RELEASE op"); done.append((f, r, None))
+                    if timed: t.observe(time.perf_counter()-t0, "exec", args[2] if fn.__name__ == "_idem" else fn.__name__.lstrip("_"))
+                if timed: t0 = time.perf_counter()
+                self._commit(); self.batches += 1; self.batched_ops += len(batch)
+                if timed: t.observe(time.perf_counter()-t0, "commit", "batch")
+            except Exception as e:
+                self._rollback(); done = [(f, None, e) for f, _, _ in batch]
+        for f, r, e in done:
+            if e is not None: f.set_exception(e)
+            else: f.set_result(r)
+    def _commit(self):
+        if self._dirty: v = self.wallet_v + 1; self.conn.execute("INSERT INTO kv(key,value) VALUES('wallet_seq',?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (str(v),))
+        self.conn.execute("COMMIT"); self.commits += 1
+        if self._dirty: self.wallet_v = v
+        # Still under self.lock: the cache moves to the new balances in the
+        # same critical section that made them durable, and listeners see
+        # events in commit order.
+        events = self._events
+        if self._dirty: events = events + [("wallet", tag, bal) for tag, bal in self._dirty.items()]
+        if self._dirty or events:
+            with self._clock:
+                for tag, bal in self._dirty.items(): self._cache_put(tag, bal)
+                for e in events:
+                    if e[0] == "req_done": self._idem_put(e[1], e[2])
+        self._dirty.clear(); self._undo.clear(); self._events = []
+        if events:
+            for fn in self.listeners:
+                try: fn(events)
+                except Exception as e: print(f"[db] commit listener failed: {e}")
+    def _rollback(self):
+        if self.conn.in_transaction: self.conn.execute("ROLLBACK")
+        self._dirty.clear(); self._undo.clear(); self._events = []
+    def _mark(self): return len(self._undo), len(self._events)
+    def _undo_to(self, mark):
+        mark, ev = mark; del self._events[ev:]
+        while len(self._undo) > mark:
+            tag, old = self._undo.pop()
+            if old is None: self._dirty.pop(tag, None)
+            else: self._dirty[tag] = old
+    # --- compound ops ---------------------------------------------------------
+    # atomic() runs several ops as one: one savepoint, one commit, results in
+    # step order. A step that raises undoes all of them; raising Abort(result)
+    # undoes them too but resolves the future with `result`. Wrapped in idem
+    # (submit("idem", dev, req, "atomic", steps)) the whole set runs once.
+    def atomic(self, *steps, tag: str | None = None) -> Future:
+        # steps: (op, *args) tuples naming "_op" methods.
+        return self.submit("atomic", steps, tag=tag)
+    def _atomic(self, steps):
+        return [getattr(self, "_"+op)(*args) for op, *args in steps]
+    def ledger_stats(self):
+        return {"group_commit": self._writer is not None, "batch_max": self.batch_max, "batch_ms": self.batch_ms,
+                "commits": self.commits, "batches": self.batches, "batched_ops": self.batched_ops, "queued": self._q.qsize()}
+
+    # --- balance cache --------------------------------------------------------
+    # LRU of committed balances, guarded by _clock only, so get_balance() on a
+    # hot tag never waits for self.lock or touches SQLite. Inside a transaction
+    # writes are staged in _dirty (with an undo log for per-op savepoints) and
+    # published to the cache by _commit().
+    def _cache_get(self, tag_uid):
+        with self._clock:
+            bal = self._cache.get(tag_uid)
+            if bal is None: self.cache_misses += 1; return None
+            self._cache.move_to_end(tag_uid); self.cache_hits += 1; return bal
+    def _cache_put(self, tag_uid, bal):
+        if self.cache_size <= 0: return
+        self._cache[tag_uid] = bal; self._cache.move_to_end(tag_uid)
+        while len(self._cache) > self.cache_size: self._cache.popitem(last=False); self.cache_evictions += 1
+    def cached_balance(self, tag_uid): return self._cache_get(tag_uid)
+    def cache_stats(self):
+        with self._clock:
+            n = self.cache_hits + self.cache_misses
+            return {"size": len(self._cache), "capacity": self.cache_size, "hits": self.cache_hits, "misses": self.cache_misses,
+                    "evictions": self.cache_evictions, "hit_rate": round(self.cache_hits/n, 4) if n else None}
+
+    # --- idempotency ----------------------------------------------------------
+    # QoS-1 redeliveries reuse the device's req_id. _idem() runs the ledger op
+    # at most once per (device_id, req_id): the result is stored in req_cache
+    # in the same savepoint as the op, and a repeat returns the stored result.
+    # Committed results also go to a small LRU (under _clock) so replay() can
+    # answer hot redeliveries without queueing behind the writer.
+    def replay(self, device_id, req_id):
+        with self._clock:
+            r = self._reqs.get((device_id, req_id), MISS)
+            if r is not MISS: self._reqs.move_to_end((device_id, req_id)); self.idem_hits += 1
+            return r
+    def _idem_put(self, key, result):
+        if self.idem_size <= 0: return
+        self._reqs[key] = result; self._reqs.move_to_end(key)
+        while len(self._reqs) > self.idem_size: self._reqs.popitem(last=False)
+    def _idem(self, device_id, req_id, op, *args):
+        r=self.conn.execute("SELECT result FROM req_cache WHERE device_id=? AND req_id=?", (device_id, req_id)).fetchone()
+        if r: self.idem_db_hits += 1; return json.loads(r["result"])
+        self.idem_misses += 1; res=getattr(self, "_"+op)(*args); now=time.time()
+        self.conn.execute("INSERT INTO req_cache(device_id,req_id,ts,result) VALUES(?,?,?,?)", (device_id, req_id, now, json.dumps(res))); self._idem_rows += 1
+        self._events.append(("req_done", (device_id, req_id), json.loads(json.dumps(res))))
+        if now - self._idem_pruned > 60:
+            self._idem_pruned = now; self._idem_rows -= self.conn.execute("DELETE FROM req_cache WHERE ts < ?", (now - self.idem_ttl,)).rowcount
+        return res
+    def idem_stats(self):
+        # table_rows is approximate: counted once, on its own connection (a
+        # WAL reader never holds up the writer), then kept up to date from
+        # inserts and prunes (a rolled-back batch isn't subtracted).
+        if self._idem_base is None:
+            c = sqlite3.connect(self.path)
+            try: d = self._idem_rows; self._idem_base = c.execute("SELECT COUNT(*) FROM req_cache").fetchone()[0] - d
+            finally: c.close()
+        rows = self._idem_base + self._idem_rows
+        with self._clock:
+            n = self.idem_hits + self.idem_db_hits + self.idem_misses
+            return {"lru_size": len(self._reqs), "lru_capacity": self.idem_size, "ttl_sec": self.idem_ttl, "table_rows": rows,
+                    "lru_hits": self.idem_hits, "db_hits": self.idem_db_hits, "misses": self.idem_misses,
+                    "hit_rate": round((self.idem_hits + self.idem_db_hits)/n, 4) if n else None}
+
+    # --- ledger -------------------------------------------------------------
     def get_balance(self, tag_uid:str)->int:
-        with self.lock, self.conn:
-            r=self.conn.execute("SELECT balance_cents FROM wallets WHERE tag_uid=?", (tag_uid,)).fetchone()
-            if not r:
-                self.conn.execute("INSERT INTO wallets(tag_uid,balance_cents,updated_at) VALUES(?,?,?)",(tag_uid,0,self.now())); return 0
-            return int(r["balance_cents"])
+        bal=self._cache_get(tag_uid)
+        if bal is not None: return bal
+        with self.tx("get_balance"): return self._balance(tag_uid, counted=True)
+    def _balance(self, tag_uid, counted=False):
+        if tag_uid in self._dirty: return self._dirty[tag_uid]
+        bal=self._cache_get(tag_uid) if not counted else None
+        if bal is not None: return bal
+        # An unknown tag reads as 0 without a row: only a write creates the
+        # wallet, so reading a stray tag publishes and retains nothing.
+        r=self.conn.execute("SELECT balance_cents FROM wallets WHERE tag_uid=?", (tag_uid,)).fetchone()
+        bal=int(r["balance_cents"]) if r else 0
+        with self._clock: self._cache_put(tag_uid, bal)
+        return bal
+    def _set_balance(self, tag_uid, nb):
+        self.conn.execute("INSERT INTO wallets(tag_uid,balance_cents,updated_at) VALUES(?,?,?) ON CONFLICT(tag_uid) DO UPDATE SET balance_cents=excluded.balance_cents, updated_at=excluded.updated_at",
+                          (tag_uid,nb,self.now())); self._stage(tag_uid, nb)
+    def _stage(self, tag_uid, bal):
+        self._undo.append((tag_uid, self._dirty.get(tag_uid))); self._dirty[tag_uid]=bal
     def credit(self, tag_uid, amt, device_id, op):
-        with self.lock, self.conn:
-            bal=self.get_balance(tag_uid); nb=bal+int(amt)
-            self.conn.execute("UPDATE wallets SET balance_cents=?, updated_at=? WHERE tag_uid=?", (nb,self.now(),tag_uid))
-            self.log(op, device_id, tag_uid, amt, {"old":bal,"new":nb}); return nb
+        with self.tx("credit"): return self._credit(tag_uid, amt, device_id, op)
+    def _credit(self, tag_uid, amt, device_id, op):
+        bal=self._balance(tag_uid); nb=bal+int(amt); self._set_balance(tag_uid, nb)
+        self._log(op, device_id, tag_uid, amt, {"old":bal,"new":nb})
+        if op in ROLLUP_OPS: self._roll(ROLLUP_OPS[op], device_id, device_id, amt)
+        return nb
     def debit(self, tag_uid, amt, device_id, op):
-        with self.lock, self.conn:
-            bal=self.get_balance(tag_uid); amt=int(amt)
-            if bal<amt: return None
-            nb=bal-amt; self.conn.execute("UPDATE wallets SET balance_cents=?, updated_at=? WHERE tag_uid=?", (nb,self.now(),tag_uid))
-            self.log(op, device_id, tag_uid, amt, {"old":bal,"new":nb}); return nb
+        with self.tx("debit"): return self._debit(tag_uid, amt, device_id, op)
+    def _debit(self, tag_uid, amt, device_id, op):
+        bal=self._balance(tag_uid); amt=int(amt)
+        if bal<amt: return None
+        nb=bal-amt; self._set_balance(tag_uid, nb)
+        self._log(op, device_id, tag_uid, amt, {"old":bal,"new":nb})
+        if op in ROLLUP_OPS: self._roll(ROLLUP_OPS[op], device_id, device_id, amt)
+        return nb
     def log(self, op, device_id, tag_uid, amount, details):
-        with self.lock, self.conn:
-            self.conn.execute("INSERT INTO tx_log(ts,device_id,op,tag_uid,amount_cents,details) VALUES(?,?,?,?,?,?)",
-                              (self.now(), device_id, op, tag_uid, amount if amount is not None else None, json.dumps(details)))
+        # Audit rows ride along with the next ledger batch; nobody waits on them.
+        if self._writer is not None: self._q.put((Future(), self._log, (op, device_id, tag_uid, amount, details))); return
+        with self.tx("log"): self._log(op, device_id, tag_uid, amount, details)
+    def log_many(self, rows):
+        # rows: (op, device_id, tag_uid, amount, details) tuples, one INSERT batch.
+        if not rows: return
+        if self._writer is not None: self._q.put((Future(), self._log_many, (rows,))); return
+        with self.tx("log_many"): self._log_many(rows)
+    def _log_many(self, rows):
+        now=self.now()
+        self.conn.executemany("INSERT INTO tx_log(ts,device_id,op,tag_uid,amount_cents,details) VALUES(?,?,?,?,?,?)",
+                              [(now, d, op, tag, amt, json.dumps(det)) for op, d, tag, amt, det in rows])
+    def _log(self, op, device_id, tag_uid, amount, details):
+        self.conn.execute("INSERT INTO tx_log(ts,device_id,op,tag_uid,amount_cents,details) VALUES(?,?,?,?,?,?)",
+                          (self.now(), device_id, op, tag_uid, amount if amount is not None else None, json.dumps(details)))
     def create_payout(self, payout_id, source, amount, meta):
-        with self.lock, self.conn:
-            r=self.conn.execute("SELECT payout_id FROM payouts WHERE payout_id=?", (payout_id,)).fetchone()
-            if r: return
-            self.conn.execute("INSERT INTO payouts(payout_id,source,amount_cents,status,meta,created_at) VALUES (?,?,?,?,?,?)",
-                              (payout_id, source, amount, "ready", json.dumps(meta or {}), self.now()))
-            self.log("payout_new", source, None, amount, {"payout_id":payout_id,"meta":meta})
+        with self.tx("create_payout"): return self._create_payout(payout_id, source, amount, meta)
+    def _create_payout(self, payout_id, source, amount, meta):
+        r=self.conn.execute("SELECT payout_id FROM payouts WHERE payout_id=?", (payout_id,)).fetchone()
+        if r: return
+        self.conn.execute("INSERT INTO payouts(payout_id,source,amount_cents,status,meta,created_at) VALUES (?,?,?,?,?,?)",
+                          (payout_id, source, amount, "ready", json.dumps(meta or {}), self.now()))
+        self._log("payout_new", source, None, amount, {"payout_id":payout_id,"meta":meta}); self._roll("created", source, source, amount)
+        self._events.append(("payout_added", self._payout_seq(), {"payout_id":payout_id,"source":source,"amount_cents":amount}))
+    def _payout_seq(self):
+        self.conn.execute("INSERT INTO kv(key,value) VALUES('payout_seq','1') ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1")
+        return int(self.conn.execute("SELECT value FROM kv WHERE key='payout_seq'").fetchone()[0])
     def list_ready_payouts(self):
-        with self.lock, self.conn:
+        with self._locked("list_ready_payouts"):
             return [dict(r) for r in self.conn.execute("SELECT payout_id,source,amount_cents FROM payouts WHERE status='ready' ORDER BY created_at ASC")]
+    def payout_snapshot(self):
+        # (version, ready items) read under one lock so they agree.
+        with self._locked("payout_snapshot"):
+            r=self.conn.execute("SELECT value FROM kv WHERE key='payout_seq'").fetchone()
+            return (int(r["value"]) if r else 0), [dict(r) for r in self.conn.execute("SELECT payout_id,source,amount_cents FROM payouts WHERE status='ready' ORDER BY created_at ASC")]
     def claim_payout(self, payout_id, tag_uid, device_id):
-        with self.lock, self.conn:
-            r=self.conn.execute("SELECT payout_id,amount_cents,status FROM payouts WHERE payout_id=?", (payout_id,)).fetchone()
-            if not r: return None, "not_found"
-            if r["status"]!="ready": return None, "already_claimed"
-            amt=int(r["amount_cents"])
-            self.conn.execute("UPDATE payouts SET status='claimed', claimed_by_tag=?, claimed_at=? WHERE payout_id=?",(tag_uid,self.now(),payout_id))
-            self.log("payout_claim", device_id, tag_uid, amt, {"payout_id":payout_id}); return amt,"ok"
+        with self.tx("claim_payout"): return self._claim_payout(payout_id, tag_uid, device_id)
+    def _claim_payout(self, payout_id, tag_uid, device_id):
+        r=self.conn.execute("SELECT payout_id,source,amount_cents,status FROM payouts WHERE payout_id=?", (payout_id,)).fetchone()
+        if not r: return None, "not_found"
+        if r["status"]!="ready": return None, "already_claimed"
+        amt=int(r["amount_cents"])
+        self.conn.execute("UPDATE payouts SET status='claimed', claimed_by_tag=?, claimed_at=? WHERE payout_id=?",(tag_uid,self.now(),payout_id))
+        self._log("payout_claim", device_id, tag_uid, amt, {"payout_id":payout_id}); self._roll("claimed", device_id, r["source"], amt)
+        self._events.append(("payout_claimed", self._payout_seq(), payout_id)); return amt,"ok"
+    def _claim_credit(self, payout_id, tag_uid, device_id):
+        # Claim and credit in one op so a queued claim can't be overtaken by
+        # later debits on the same tag, and can't be half-applied.
+        amt,status=self._claim_payout(payout_id, tag_uid, device_id)
+        if status!="ok": return None, status, None
+        return amt, status, self._credit(tag_uid, amt, device_id, "payout_claim_credit")
+    def _claim_many(self, payout_ids, tag_uid, device_id, all_or_none=False, shard=None, req_id=None):
+        # Claims each payout, then credits their total to the tag once. With
+        # all_or_none a payout that can't be claimed undoes the lot. With shard
+        # the wallet lives on that shard: transfers are recorded instead of
+        # the credit (see _claim_xfer).
+        results=[]; total=0
+        for pid in payout_ids:
+            amt,status=self._claim_payout(pid, tag_uid, device_id) if shard is None else self._claim_xfer(pid, tag_uid, device_id, shard, req_id)
+            results.append({"payout_id":pid,"status":status,"credited_cents":int(amt or 0)})
+            if status=="ok": total+=int(amt)
+            elif all_or_none:
+                for x in results[:-1]: x.update(status="rolled_back", credited_cents=0)
+                raise Abort({"status":status,"results":results,"credited_cents":0,"new_balance_cents":None})
+        nb=None
+        if shard is None: nb=self._credit(tag_uid, total, device_id, "payout_claim_credit") if total else self._balance(tag_uid)
+        return {"status":"ok" if total else "nothing_claimed","results":results,"credited_cents":total,"new_balance_cents":nb}
+    def _claim_xfer(self, payout_id, tag_uid, device_id, shard, req_id):
+        # Sharded core: the wallet lives on another shard. The claim and the
+        # pending transfer commit together; the transfer row stays until
+        # that shard acks the credit (see shard.py).
+        amt,status=self._claim_payout(payout_id, tag_uid, device_id)
+        if status=="ok":
+            self.conn.execute("INSERT OR REPLACE INTO xfer(payout_id,tag_uid,amount_cents,shard,device_id,req_id,ts) VALUES(?,?,?,?,?,?,?)",
+                              (payout_id, tag_uid, amt, shard, device_id, req_id, time.time()))
+        return amt, status
+    def _xfer_done(self, payout_id):
+        self.conn.execute("DELETE FROM xfer WHERE payout_id=?", (payout_id,))
+    def xfers_due(self, before):
+        with self._locked("xfers_due"):
+            return [dict(r) for r in self.conn.execute("SELECT payout_id,tag_uid,amount_cents,shard,device_id,req_id FROM xfer WHERE ts<? ORDER BY ts", (before,))]
+    # --- rollups --------------------------------------------------------------
+    # Per (hour, device_id, source) counts and sums, upserted in the savepoint
+    # of the op they describe. source is the device itself for bets/wins, the
+    # table for created payouts and the paying table for claims (device_id is
+    # then the change station). rollup.py rebuilds them from tx_log.
+    def _roll(self, kind, device_id, source, amt, hour=None, n=1):
+        self.conn.execute(f"INSERT INTO rollup(hour,device_id,source,{kind},{kind}_cents) VALUES(?,?,?,?,?) "
+                          f"ON CONFLICT(hour,device_id,source) DO UPDATE SET {kind}={kind}+excluded.{kind}, {kind}_cents={kind}_cents+excluded.{kind}_cents",
+                          (hour or self.now()[:13], device_id or "", source or "", n, int(amt or 0)))
+    def _rollup_rebuild(self, acc, upto, sources):
+        # acc: {(hour, device_id, source, kind): [n, cents]} for tx_log ids <= upto;
+        # rows committed since are added here, inside the writer's transaction.
+        for r in self.conn.execute("SELECT ts,device_id,op,amount_cents,details FROM tx_log WHERE id>? AND op IN (?,?,?,?)", (upto, *ROLLUP_LOG_OPS)):
+            rollup_add(acc, r["ts"], r["device_id"], r["op"], r["amount_cents"], json.loads(r["details"] or "null"), sources)
+        self.conn.execute("DELETE FROM rollup")
+        for (hour, dev, src, kind), (n, cents) in acc.items(): self._roll(kind, dev, src, cents, hour, n)
+        return len(acc)
+    # --- tx_log archive (driven by txlog.TxLog) -------------------------------
+    def _txlog_archive(self, m):
+        self.conn.execute("INSERT OR REPLACE INTO tx_archive(seg,part,min_id,max_id,min_ts,max_ts,rows,bytes,devices,ops) VALUES(?,?,?,?,?,?,?,?,?,?)",
+                          (m["seg"], m["part"], m["min_id"], m["max_id"], m["min_ts"], m["max_ts"], m["rows"], m["bytes"], json.dumps(m["devices"]), json.dumps(m["ops"])))
+        self.conn.execute("INSERT INTO kv(key,value) VALUES('txlog_archived_upto',?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (str(m["max_id"]),))
+    def _txlog_trim(self, upto, n):
+        return self.conn.execute("DELETE FROM tx_log WHERE id IN (SELECT id FROM tx_log WHERE id<=? ORDER BY id LIMIT ?)", (upto, n)).rowcount
+    def _txlog_forget(self, seg):
+        self.conn.execute("DELETE FROM tx_archive WHERE seg=?", (seg,))
     def get_mode(self):
-        with self.lock, self.conn:
+        with self._locked("get_mode"):
             r=self.conn.execute("SELECT value FROM kv WHERE key='mode'").fetchone()
             if not r: return "day"
-            import json
             return json.loads(r["value"])["mode"]
     def set_mode(self, mode:str):
-        with self.lock, self.conn:
-            import json
+        with self.tx("set_mode"):
             self.conn.execute("INSERT INTO kv(key,value) VALUES('mode',?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (json.dumps({"mode":mode}),))
+
+MISS = object()
+
+class Abort(Exception):
+    # Raised inside an op to roll its savepoint back and still answer the
+    # caller with `result` (see DB.atomic).
+    def __init__(self, result=None): super().__init__("aborted"); self.result = result
+# Ledger op name -> rollup column; the other rollup kinds come from payouts.
+ROLLUP_OPS = {"wallet_debit": "bet", "wallet_credit": "win"}
+ROLLUP_LOG_OPS = ("wallet_debit", "wallet_credit", "payout_new", "payout_claim")
+
+def rollup_add(acc, ts, device_id, op, amount, details, sources):
+    # One tx_log row into a rebuild accumulator (see DB._rollup_rebuild).
+    if op in ROLLUP_OPS: key = (ts[:13], device_id, device_id, ROLLUP_OPS[op])
+    elif op == "payout_new": key = (ts[:13], device_id, device_id, "created")
+    elif op == "payout_claim": key = (ts[:13], device_id, sources.get((details or {}).get("payout_id"), ""), "claimed")
+    else: return
+    a = acc.setdefault(key, [0, 0]); a[0] += 1; a[1] += int(amount or 0)
+
+class _Timed:
+    # db.lock acquired with the wait reported to db.timer.
+    def __init__(self, db, op): self.db = db; self.op = op
+    def __enter__(self):
+        t0 = time.perf_counter(); self.db.lock.acquire(); self.db.timer.observe(time.perf_counter()-t0, "lock_wait", self.op)
+    def __exit__(self, et, ev, tb): self.db.lock.release(); return False
+
+class _Tx:
+    # One locked BEGIN IMMEDIATE ... COMMIT; used for direct (non-queued) calls.
+    def __init__(self, db, op="tx"): self.db = db; self.op = op
+    def __enter__(self):
+        self.db._locked(self.op).__enter__()
+        try: self.db.conn.execute("BEGIN IMMEDIATE")
+        except Exception: self.db.lock.release(); raise
+        return self.db.conn
+    def __exit__(self, et, ev, tb):
+        try:
+            if et is None:
+                try: self.db._commit()
+                except Exception: self.db._rollback(); raise
+            else: self.db._rollback()
+        finally: self.db.lock.release()
+        return False
@@ -0,0 +1,43 @@
+import threading, queue, zlib, time
+class Dispatcher:
+    # Worker pool sharded by a message key (tag_uid, payout_id, ...): the same
+    # key always lands on the same worker, so per-wallet ordering is kept while
+    # unrelated keys run concurrently. Queues are bounded; when a shard is full
+    # submit() blocks the caller (paho's network thread), which pushes back on
+    # the broker instead of buffering without limit. Every stall is counted.
+    def __init__(self, workers: int = 4, depth: int = 1024, name: str = "dispatch"):
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(max(1, workers))]
+        self.depth = depth; self.stalls = [0]*len(self.queues); self.handled = 0; self.errors = 0
+        self._last_warn = 0.0
+        # Optional metrics.Histograms: timer gets handler run time, wait gets
+        # time spent queued, both labelled labels.get(fn, fn.__name__).
+        self.timer = None; self.wait = None; self.labels = {}
+        # started(arg), if set, runs as a worker picks the message up.
+        self.started = None
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._run, args=(q,), name=f"{name}-{i}", daemon=True).start()
+    def shard(self, key) -> int:
+        return zlib.crc32(str(key or "").encode()) % len(self.queues)
+    def submit(self, key, fn, arg):
+        i = self.shard(key); q = self.queues[i]; item = (fn, arg, time.perf_counter() if self.timer is not None else 0.0)
+        try: q.put_nowait(item); return
+        except queue.Full: pass
+        self.stalls[i] += 1; now = time.monotonic()
+        if now - self._last_warn > 5.0:
+            self._last_warn = now; print(f"[dispatch] shard {i} full ({self.depth}); applying backpressure, stalls={sum(self.stalls)}")
+        q.put(item)
+    def _run(self, q):
+        while True:
+            fn, arg, t0 = q.get(); t = self.timer; timed = t0 and t is not None and t.sampled()
+            if timed:
+                label = self.labels.get(fn) or fn.__name__; t1 = time.perf_counter()
+                if self.wait is not None: self.wait.observe(t1-t0, label)
+            try:
+                if self.started is not None: self.started(arg)
+                fn(arg)
+            except Exception as e: self.errors += 1; print(f"[dispatch] {getattr(fn,'__name__',fn)} failed: {e}")
+            if timed: t.observe(time.perf_counter()-t1, label)
+            self.handled += 1
+    def stats(self):
+        return {"workers": len(self.queues), "depth": self.depth, "queued": [q.qsize() for q in self.queues],
+                "stalls": list(self.stalls), "handled": self.handled, "errors": self.errors}
@@ -0,0 +1,50 @@
+import threading
+class PayoutFeed:
+    # Ready-payout feed for the change station. Every commit that adds or
+    # claims payouts becomes one delta {"base","v","added","claimed"} on
+    # <base>/delta, where base is the version the delta applies to. A paged,
+    # retained snapshot {"v","page","pages","items"} on <base>/snapshot/<n> is
+    # refreshed at most every `debounce` seconds (or on a sync request) for
+    # late joiners and for clients that detect a gap in the delta versions.
+    def __init__(self, db, pub, base: str, page_size: int = 50, debounce: float = 2.0):
+        self.db = db; self.pub = pub; self.base = base; self.page_size = max(1, page_size); self.debounce = debounce
+        self._lock = threading.Lock(); self._timer = None; self._pages = 0
+        self.deltas = 0; self.snapshots = 0
+        db.listeners.append(self.on_commit)
+    def on_commit(self, events):
+        # Runs under the DB lock, so deltas go out in version order.
+        evs = [e for e in events if e[0] in ("payout_added","payout_claimed")]
+        if not evs: return
+        added = [e[2] for e in evs if e[0]=="payout_added"]; claimed = [e[2] for e in evs if e[0]=="payout_claimed"]
+        self.pub(self.base+"/delta", {"base": evs[0][1]-1, "v": evs[-1][1], "added": added, "claimed": claimed}, qos=1, retain=False)
+        self.deltas += 1; self.schedule()
+    def schedule(self):
+        with self._lock:
+            if self._timer is not None: return
+            self._timer = threading.Timer(self.debounce, self.publish_snapshot); self._timer.daemon = True; self._timer.start()
+    def publish_snapshot(self):
+        with self._lock:
+            self._timer = None
+            v, items = self.db.payout_snapshot()
+            chunks = [items[i:i+self.page_size] for i in range(0, len(items), self.page_size)] or [[]]
+            for i, chunk in enumerate(chunks):
+                self.pub(f"{self.base}/snapshot/{i}", {"v": v, "page": i, "pages": len(chunks), "items": chunk}, qos=1, retain=True)
+            for i in range(len(chunks), self._pages): self.pub(f"{self.base}/snapshot/{i}", None, qos=1, retain=True)
+            self._pages = len(chunks); self.snapshots += 1
+    def stats(self):
+        return {"deltas": self.deltas, "snapshots": self.snapshots, "pages": self._pages}
+
+class BalanceFeed:
+    # Retained {"balance_cents","v"} on <base>/<tag> for every wallet a commit
+    # changed (one message per tag per batch). v is the DB's wallet_seq, which
+    # grows with every such commit and survives restarts, so a reader can
+    # tell a stale (retained) copy from a newer one.
+    def __init__(self, db, pub, base: str):
+        self.db = db; self.pub = pub; self.base = base; self.published = 0
+        db.listeners.append(self.on_commit)
+    def on_commit(self, events):
+        v = self.db.wallet_v
+        for e in events:
+            if e[0] == "wallet": self.pub(f"{self.base}/{e[1]}", {"balance_cents": e[2], "v": v}, qos=1, retain=True); self.published += 1
+    def stats(self):
+        return {"published": self.published}
@@ -0,0 +1,115 @@
+import time, threading
+from collections import OrderedDict, deque
+
+class Traces:
+    # Core-side stamps for requests carrying trace context ("tr"): begin() on
+    # receipt, started() when a dispatch worker picks the message up, done()
+    # once its ledger op is durable, finish() right before the reply is
+    # published. The reply echoes the device's tr plus ms offsets from
+    # receipt: q (dequeued), db (durable; reads: handler done) and pub.
+    # A cross-shard claim hands its trace to the owner shard with the time
+    # spent so far ("x"), which the owner adds to its offsets. Open traces
+    # are bounded; a request never answered here is dropped oldest first.
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize; self._open = OrderedDict(); self._lock = threading.Lock(); self.traced = 0; self.dropped = 0
+    def begin(self, p):
+        tr = p.get("tr"); d = p.get("device_id"); r = p.get("req_id")
+        if type(tr) is not dict or d is None or r is None: return
+        with self._lock:
+            self._open[(d, r)] = [tr, time.perf_counter(), None, None]
+            if len(self._open) > self.maxsize: self._open.popitem(last=False); self.dropped += 1
+    def _mark(self, d, r, i):
+        if not self._open: return
+        with self._lock:
+            e = self._open.get((d, r))
+            if e is not None and e[i] is None: e[i] = time.perf_counter()
+    def started(self, p):
+        if "tr" in p: self._mark(p.get("device_id"), p.get("req_id"), 2)
+    def done(self, d, r): self._mark(d, r, 3)
+    def finish(self, d, body):
+        if not self._open: return body
+        with self._lock: e = self._open.pop((d, body.get("req_id")), None)
+        if e is None: return body
+        tr, rx, dq, db = e; now = time.perf_counter(); x = float(tr.get("x") or 0)
+        def ms(t): return round((t - rx)*1000.0 + x, 3)
+        out = {k: v for k, v in tr.items() if k != "x"}; out.update(q=ms(dq or rx), db=ms(db or now), pub=ms(now)); self.traced += 1
+        return {**body, "tr": out}
+    def handoff(self, d, r):
+        with self._lock: e = self._open.pop((d, r), None)
+        if e is None: return None
+        tr = dict(e[0]); tr["x"] = round((time.perf_counter() - e[1])*1000.0 + float(tr.get("x") or 0), 3); return tr
+    def stats(self):
+        with self._lock: return {"open": len(self._open), "traced": self.traced, "dropped": self.dropped}
+
+def _pct(le, b, n, q):
+    # Upper bound of the bucket holding the q-quantile (None: above the last bound).
+    if not n: return None
+    acc = 0; want = q*n
+    for bound, c in zip(le, b):
+        acc += c
+        if acc >= want: return bound
+    return None
+
+class Latency:
+    # Floor-wide view of device RTT telemetry (devices/common/telemetry.py):
+    # keeps each device's summaries for `window` seconds and merges them per
+    # op. Traced requests split the mean RTT into net (device <-> broker <->
+    # core), queue (receipt -> dispatch worker), db (-> durable) and publish.
+    def __init__(self, window: float = 300.0, slowest: int = 10):
+        self.window = window; self.slowest = slowest; self._dev = {}; self._lock = threading.Lock(); self.summaries = 0
+    @staticmethod
+    def _clean(o):
+        # One op of a device summary with the types the view relies on, or
+        # None when it isn't one (telemetry is device input).
+        if not isinstance(o, dict): return None
+        try:
+            c = {k: int(o.get(k) or 0) for k in ("n", "to", "nt")}
+            c.update({k: float(o.get(k) or 0) for k in ("sum", "tsum", "q", "db", "pub")}); c["b"] = [int(x) for x in o.get("b") or ()]
+            m = o.get("max"); c["max"] = {**m, "rtt": float(m["rtt"])} if isinstance(m, dict) and m.get("rtt") is not None else None
+        except (TypeError, ValueError): return None
+        return c
+    def add(self, p):
+        d = p.get("device_id"); ops = p.get("ops")
+        if not d or not isinstance(ops, dict): return
+        ops = {str(k): c for k, c in ((k, self._clean(o)) for k, o in ops.items()) if c is not None}
+        le = tuple(p.get("le") or ())
+        if not ops or not all(type(x) in (int, float) for x in le): return
+        with self._lock:
+            q = self._dev.setdefault(d, deque()); q.append((time.time(), le, ops)); self.summaries += 1
+            self._expire(q, time.time())
+    def _expire(self, q, now):
+        while q and now - q[0][0] > self.window: q.popleft()
+    def _merge(self, into, le, o):
+        m = into.get("_le")
+        if m is None: into["_le"] = le
+        elif m != le: return
+        into["n"] = into.get("n", 0) + int(o.get("n", 0)); into["to"] = into.get("to", 0) + int(o.get("to", 0))
+        b = into.setdefault("b", [0]*len(o.get("b") or ()))
+        for i, c in enumerate(o.get("b") or ()):
+            if i < len(b): b[i] += c
+        for k in ("sum", "nt", "tsum", "q", "db", "pub"): into[k] = into.get(k, 0) + (o.get(k) or 0)
+    def _view(self, acc):
+        n = acc.get("n", 0); nt = acc.get("nt", 0); le = acc.get("_le", ()); b = acc.get("b", [])
+        v = {"n": n, "timeouts": acc.get("to", 0), "mean_ms": round(acc.get("sum", 0)/n, 3) if n else None,
+             **{f"p{int(q*100)}_ms": _pct(le, b, n, q) for q in (0.5, 0.9, 0.99)}, "traced": nt}
+        if nt:
+            v["split_ms"] = {"net": round((acc["tsum"] - acc["pub"])/nt, 3), "queue": round(acc["q"]/nt, 3),
+                             "db": round((acc["db"] - acc["q"])/nt, 3), "publish": round((acc["pub"] - acc["db"])/nt, 3)}
+        return v
+    def view(self, device_id: str | None = None):
+        now = time.time(); floor = {}; devs = {}; slow = []
+        with self._lock:
+            for d, q in self._dev.items():
+                self._expire(q, now)
+                if not q or (device_id and d != device_id): continue
+                mine = {}
+                for ts, le, ops in q:
+                    for op, o in ops.items():
+                        self._merge(floor.setdefault(op, {}), le, o); self._merge(mine.setdefault(op, {}), le, o)
+                        if o.get("max"): slow.append({"device_id": d, "op": op, "age_s": round(now - ts, 1), **o["max"]})
+                devs[d] = {"age_s": round(now - q[-1][0], 1), "ops": {op: self._view(a) for op, a in mine.items()}}
+            for d in [d for d, q in self._dev.items() if not q]: del self._dev[d]
+        slow.sort(key=lambda s: -s["rtt"])
+        return {"window_s": self.window, "ops": {op: self._view(a) for op, a in floor.items()}, "devices": devs, "slowest": slow[:self.slowest]}
+    def stats(self):
+        with self._lock: return {"devices": len(self._dev), "summaries": self.summaries}
@@ -0,0 +1,96 @@
+import os, threading, itertools, bisect
+# Minimal Prometheus text-format registry (no client library needed).
+# Counters are always counted; histograms time only a sample of events: with
+# METRICS_SAMPLE=0.1 one event in ten is timed, so _count/_sum cover that
+# sample (eg_metrics_sample_rate says which). Gauges are callbacks evaluated
+# at scrape time. Label values are kept as tuples; callers keep them bounded
+# (handler topics, op names, topic families), never tag_uids or device ids.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def _esc(v): return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values, le=None):
+    parts = [f'{k}="{_esc(v)}"' for k, v in zip(names, values)]
+    if le is not None: parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v): return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, reg, name, help, labels=()):
+        self.reg = reg; self.name = name; self.help = help; self.labels = tuple(labels); self.values = {}; self._lock = threading.Lock()
+    def inc(self, *lv, n=1):
+        with self._lock: self.values[lv] = self.values.get(lv, 0) + n
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock: items = sorted(self.values.items())
+        out += [f"{self.name}{_labels(self.labels, lv)} {_num(v)}" for lv, v in items]
+        return out
+
+class Histogram:
+    def __init__(self, reg, name, help, labels=(), buckets=BUCKETS):
+        self.reg = reg; self.name = name; self.help = help; self.labels = tuple(labels); self.buckets = tuple(buckets)
+        self.series = {}; self._lock = threading.Lock()
+    def sampled(self) -> bool: return self.reg.sampled()
+    def observe(self, seconds, *lv):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            s = self.series.get(lv)
+            if s is None: s = self.series[lv] = [[0]*(len(self.buckets)+1), 0.0]
+            s[0][i] += 1; s[1] += seconds
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock: items = sorted((lv, (list(c), t)) for lv, (c, t) in self.series.items())
+        for lv, (counts, total) in items:
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c; out.append(f"{self.name}_bucket{_labels(self.labels, lv, b)} {acc}")
+            acc += counts[-1]
+            out.append(f"{self.name}_bucket{_labels(self.labels, lv, '+Inf')} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labels, lv)} {total!r}"); out.append(f"{self.name}_count{_labels(self.labels, lv)} {acc}")
+        return out
+
+class Gauge:
+    # fn() returns a number, or {label value tuple: number}.
+    def __init__(self, reg, name, help, fn, labels=()):
+        self.reg = reg; self.name = name; self.help = help; self.fn = fn; self.labels = tuple(labels)
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try: v = self.fn()
+        except Exception: return out
+        if isinstance(v, dict): out += [f"{self.name}{_labels(self.labels, lv)} {_num(x)}" for lv, x in sorted(v.items())]
+        elif v is not None: out.append(f"{self.name} {_num(v)}")
+        return out
+
+class Metrics:
+    def __init__(self, sample: float | None = None):
+        rate = float(sample if sample is not None else os.getenv("METRICS_SAMPLE", "1"))
+        self.rate = min(1.0, max(0.0, rate)); self.every = round(1/self.rate) if self.rate > 0 else 0; self._n = itertools.count()
+        self._metrics = []
+        self.gauge("eg_metrics_sample_rate", "fraction of events timed by the histograms", lambda: self.rate)
+    def sampled(self) -> bool:
+        # Every Nth call, not random(): cheaper, and itertools.count is atomic.
+        if self.every == 1: return True
+        return self.every > 0 and next(self._n) % self.every == 0
+    def _add(self, m): self._metrics.append(m); return m
+    def counter(self, name, help, labels=()) -> Counter: return self._add(Counter(self, name, help, labels))
+    def histogram(self, name, help, labels=(), buckets=BUCKETS) -> Histogram: return self._add(Histogram(self, name, help, labels, buckets))
+    def gauge(self, name, help, fn, labels=()) -> Gauge: return self._add(Gauge(self, name, help, fn, labels))
+    def render(self) -> str:
+        return "\n".join(line for m in self._metrics for line in m.render()) + "\n"
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def topic_family(topic: str) -> str:
+    # Collapses per-device / per-tag / per-step segments so labels stay bounded:
+    # eg/dev/slot-01/res -> eg/dev/+/res, eg/state/wallet/ABCD -> eg/state/wallet/+
+    p = topic.split("/")
+    if len(p) > 2 and p[1] in ("dev", "shard"): p[2] = "+"
+    if len(p) > 3 and (p[1], p[2]) in (("state", "wallet"), ("night", "tally")): p[3:] = ["+"]
+    if len(p) > 1 and p[-2] == "snapshot": p[-1] = "+"
+    return "/".join(p)
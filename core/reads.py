@@ -0,0 +1,66 @@
+import os, sqlite3, threading, asyncio, time, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+# Read side of the HTTP API. Each executor thread owns one read-only WAL
+# connection: WAL readers neither take DB.lock nor block the ledger writer,
+# and running them on the executor keeps sqlite3 calls off the event loop.
+# Readers see the last committed state, never a batch in flight.
+class ReadPool:
+    def __init__(self, path: str, size: int = 4):
+        self.path = path; self.size = max(1, size)
+        self.executor = ThreadPoolExecutor(self.size, thread_name_prefix="db-read")
+        self._local = threading.local(); self._lock = threading.Lock()
+        self.opened = 0; self.queries = 0; self.errors = 0; self.busy = 0; self.total_ms = 0.0; self.max_ms = 0.0
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect("file:"+urllib.request.pathname2url(os.path.abspath(self.path))+"?mode=ro", uri=True,
+                                check_same_thread=False, isolation_level=None)
+            c.row_factory = sqlite3.Row; c.execute("PRAGMA query_only=1"); self._local.conn = c
+            with self._lock: self.opened += 1
+        return c
+    def _call(self, fn, args):
+        with self._lock: self.busy += 1
+        t = time.perf_counter(); ok = False
+        try: r = fn(self._conn(), *args); ok = True; return r
+        finally:
+            ms = (time.perf_counter()-t)*1000
+            with self._lock:
+                self.busy -= 1; self.queries += 1; self.total_ms += ms; self.max_ms = max(self.max_ms, ms)
+                if not ok: self.errors += 1
+    async def run(self, fn, *args):
+        # fn(conn, *args) on a pool thread.
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, fn, args)
+    def stats(self):
+        with self._lock:
+            return {"size": self.size, "connections": self.opened, "busy": self.busy, "queries": self.queries, "errors": self.errors,
+                    "avg_ms": round(self.total_ms/self.queries, 3) if self.queries else None, "max_ms": round(self.max_ms, 3)}
+
+def wallet(c, tag_uid):
+    r = c.execute("SELECT tag_uid,balance_cents,updated_at FROM wallets WHERE tag_uid=?", (tag_uid,)).fetchone()
+    return dict(r) if r else None
+
+def payouts(c, status="ready", after=None, limit=100):
+    # Keyset on (created_at, payout_id); `after` is the previous page's
+    # "next" cursor. Served from the payouts_status_cover index.
+    sql = "SELECT payout_id,source,amount_cents,status,claimed_by_tag,created_at,claimed_at FROM payouts"; w = []; args = []
+    if status != "all": w.append("status=?"); args.append(status)
+    if after:
+        ts, _, pid = after.partition("|"); w.append("(created_at>? OR (created_at=? AND payout_id>?))"); args += [ts, ts, pid]
+    if w: sql += " WHERE " + " AND ".join(w)
+    rows = [dict(r) for r in c.execute(sql + " ORDER BY created_at, payout_id LIMIT ?", args + [limit])]
+    return rows, (f"{rows[-1]['created_at']}|{rows[-1]['payout_id']}" if len(rows) == limit else None)
+
+STAT_COLS = ("bet", "bet_cents", "win", "win_cents", "created", "created_cents", "claimed", "claimed_cents")
+def stats(c, group=("device_id",), since=None, until=None, device_id=None, source=None):
+    # Sums over rollup buckets; group is any of hour/device_id/source (none =
+    # one total row). since/until are hour prefixes ("2026-10-18", "2026-10-18T14"), until exclusive.
+    w = []; args = []
+    if since: w.append("hour>=?"); args.append(since[:13])
+    if until: w.append("hour<?"); args.append(until[:13])
+    if device_id: w.append("device_id=?"); args.append(device_id)
+    if source: w.append("source=?"); args.append(source)
+    g = ",".join(group)
+    sql = f"SELECT {g+',' if g else ''}" + ",".join(f"SUM({k}) {k}" for k in STAT_COLS) + " FROM rollup"
+    if w: sql += " WHERE " + " AND ".join(w)
+    if g: sql += f" GROUP BY {g} ORDER BY {g}"
+    return [{k: (v or 0) if k in STAT_COLS else v for k, v in dict(r).items()} for r in c.execute(sql, args)]
@@ -0,0 +1,33 @@
+import os, sys, json, time
+from db import rollup_add, ROLLUP_LOG_OPS
+# Rebuilds the rollup table from the transaction log (archived segments plus
+# live tx_log): everything up to the current last id is scanned from a read
+# connection, then one writer op folds in whatever committed since and swaps
+# the table contents, so live traffic is neither lost nor counted twice.
+
+def rebuild(db, txlog, chunk: int = 5000) -> dict:
+    t0 = time.perf_counter()
+    with txlog._rlock:
+        r = txlog.rconn.execute("SELECT seq FROM sqlite_sequence WHERE name='tx_log'").fetchone(); upto = int(r[0]) if r else 0
+        sources = {pid: src for pid, src in txlog.rconn.execute("SELECT payout_id,source FROM payouts")}
+    acc = {}; after = 0; scanned = 0
+    while after < upto:
+        rows = [r for r in txlog.query(after_id=after, limit=chunk) if r["id"] <= upto]
+        if not rows: break
+        for r in rows:
+            if r["op"] in ROLLUP_LOG_OPS: rollup_add(acc, r["ts"], r["device_id"], r["op"], r["amount_cents"], r["details"], sources)
+        after = rows[-1]["id"]; scanned += len(rows)
+    buckets = db.submit("rollup_rebuild", acc, upto, sources).result()
+    return {"scanned": scanned, "upto": upto, "buckets": buckets, "ms": round((time.perf_counter()-t0)*1000, 1)}
+
+if __name__ == "__main__":
+    # python rollup.py rebuild --db /data/core.db [--dir /data/txlog]
+    import argparse
+    from db import DB
+    from txlog import TxLog
+    ap = argparse.ArgumentParser(description="rollup maintenance")
+    ap.add_argument("cmd", choices=["rebuild"]); ap.add_argument("--db", default=os.getenv("DB_PATH", "/data/core.db"))
+    ap.add_argument("--dir", default=None); ap.add_argument("--chunk", type=int, default=5000)
+    a = ap.parse_args()
+    t = TxLog(DB(a.db, batch_max=1), a.dir or os.path.join(os.path.dirname(os.path.abspath(a.db)), "txlog"), interval=0)
+    json.dump(rebuild(t.db, t, a.chunk), sys.stdout); print()
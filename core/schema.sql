@@ -4,3 +4,12 @@ CREATE TABLE IF NOT EXISTS wallets (tag_uid TEXT PRIMARY KEY, balance_cents INTE
 CREATE TABLE IF NOT EXISTS payouts (payout_id TEXT PRIMARY KEY, source TEXT NOT NULL, amount_cents INTEGER NOT NULL, status TEXT NOT NULL, claimed_by_tag TEXT, meta TEXT, created_at TEXT NOT NULL, claimed_at TEXT);
 CREATE TABLE IF NOT EXISTS tx_log (id INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT NOT NULL, device_id TEXT NOT NULL, op TEXT NOT NULL, tag_uid TEXT, amount_cents INTEGER, details TEXT);
 CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS payouts_status_cover ON payouts(status, created_at, payout_id, source, amount_cents, claimed_by_tag, claimed_at);
+CREATE TABLE IF NOT EXISTS req_cache (device_id TEXT NOT NULL, req_id TEXT NOT NULL, ts REAL NOT NULL, result TEXT NOT NULL, PRIMARY KEY(device_id, req_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS req_cache_ts ON req_cache(ts);
+CREATE TABLE IF NOT EXISTS tx_archive (seg TEXT PRIMARY KEY, part TEXT NOT NULL, min_id INTEGER NOT NULL, max_id INTEGER NOT NULL, min_ts TEXT NOT NULL, max_ts TEXT NOT NULL, rows INTEGER NOT NULL, bytes INTEGER NOT NULL, devices TEXT NOT NULL, ops TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS tx_archive_max_id ON tx_archive(max_id);
+CREATE INDEX IF NOT EXISTS tx_log_device ON tx_log(device_id, id);
+CREATE INDEX IF NOT EXISTS tx_log_tag ON tx_log(tag_uid, id);
+CREATE TABLE IF NOT EXISTS xfer (payout_id TEXT PRIMARY KEY, tag_uid TEXT NOT NULL, amount_cents INTEGER NOT NULL, shard INTEGER NOT NULL, device_id TEXT, req_id TEXT, ts REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS rollup (hour TEXT NOT NULL, device_id TEXT NOT NULL, source TEXT NOT NULL, bet INTEGER NOT NULL DEFAULT 0, bet_cents INTEGER NOT NULL DEFAULT 0, win INTEGER NOT NULL DEFAULT 0, win_cents INTEGER NOT NULL DEFAULT 0, created INTEGER NOT NULL DEFAULT 0, created_cents INTEGER NOT NULL DEFAULT 0, claimed INTEGER NOT NULL DEFAULT 0, claimed_cents INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(hour, device_id, source)) WITHOUT ROWID;
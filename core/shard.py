@@ -0,0 +1,46 @@
+import os, zlib, threading
+# Sharded core: CORE_SHARDS workers (CORE_SHARD=0..n-1), each with its own
+# DB file, share one MQTT shared subscription on <ns>/core/# so the broker
+# spreads device requests over them; the device topics don't change.
+# Wallets are owned by crc32(tag_uid) % n. Payouts, the payout feed and
+# night votes live on shard 0. A request that reaches a worker which doesn't
+# own it is republished, payload untouched, on <ns>/shard/<owner>/<rest>,
+# which only the owner subscribes to; the owner replies to the device.
+#
+# Cross-shard claim: shard 0 marks the payout claimed and records a transfer
+# (xfer table) in the same transaction, then sends core/xfer/credit to the
+# tag's shard. That shard credits the wallet at most once per payout_id,
+# answers the device and acks on core/xfer/ack; shard 0 resends unacked
+# transfers every `retry` seconds, so a shard that was down catches up.
+def db_path(path: str, n: int, index: int) -> str:
+    if n <= 1: return path
+    if "{shard}" in path: return path.format(shard=index)
+    root, ext = os.path.splitext(path); return f"{root}-{index}{ext}"
+
+class Shards:
+    def __init__(self, ns: str, n: int, index: int, group: str = "core", retry: float = 5.0):
+        if not 0 <= index < max(1, n): raise ValueError(f"CORE_SHARD={index} out of range for CORE_SHARDS={n}")
+        self.ns = ns; self.n = max(1, n); self.index = index; self.group = group; self.retry = retry
+        self._prefix = f"{ns}/shard/{index}/"; self._lock = threading.Lock()
+        self.forwarded = 0; self.received = 0; self.xfers_sent = 0; self.xfers_resent = 0; self.xfers_credited = 0
+    @property
+    def on(self): return self.n > 1
+    def owner(self, tag_uid: str) -> int: return zlib.crc32(tag_uid.encode("utf-8")) % self.n
+    def mine(self, j: int) -> bool: return j == self.index
+    def topic(self, j: int, topic: str) -> str:
+        # <ns>/core/wallet/debit -> <ns>/shard/<j>/core/wallet/debit
+        return f"{self.ns}/shard/{j}/{topic[len(self.ns)+1:]}"
+    def inbound(self, topic: str):
+        # Original topic of a message forwarded to this shard, else None.
+        if not topic.startswith(self._prefix): return None
+        with self._lock: self.received += 1
+        return f"{self.ns}/{topic[len(self._prefix):]}"
+    def subscriptions(self, *filters):
+        if not self.on: return list(filters)
+        return [f"$share/{self.group}/{f}" for f in filters] + [self._prefix + "#"]
+    def count(self, name: str, n: int = 1):
+        with self._lock: setattr(self, name, getattr(self, name) + n)
+    def stats(self):
+        with self._lock:
+            return {"shards": self.n, "index": self.index, "group": self.group, "forwarded": self.forwarded, "received": self.received,
+                    "xfers_sent": self.xfers_sent, "xfers_resent": self.xfers_resent, "xfers_credited": self.xfers_credited}
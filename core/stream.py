@@ -0,0 +1,136 @@
+import asyncio, threading
+from shared import codec
+PARTS = ("mode", "devices", "payouts", "night")
+
+class _Sub:
+    def __init__(self, device_id, parts, depth):
+        self.device_id = device_id; self.parts = parts; self.q = asyncio.Queue(maxsize=depth); self.dropped = False
+    @property
+    def key(self): return (self.device_id, self.parts)
+
+def _frame(event, obj, v=None):
+    b = codec.encode(obj)
+    if type(b) is str: b = b.encode("utf-8")
+    return (f"event: {event}\n" + (f"id: {v}\n" if v is not None else "")).encode() + b"data: " + b + b"\n\n"
+
+class StateView:
+    # What the kiosk pages show, kept in memory and fed by the core itself
+    # (commit listeners, the tally, the mode/night endpoints and the request
+    # path): mode, per-device {tag_uid, balance_cents}, ready payouts, night
+    # step and tallies. Changes mark keys dirty; every `interval` the event
+    # loop folds them into one diff {"v", <part>: ...} holding the new values
+    # (not increments), encodes it once per distinct filter and queues it on
+    # every stream. A stream starts with a full snapshot. A client more than
+    # `depth` messages behind is dropped; EventSource reconnects and gets a
+    # fresh snapshot. Device entries follow the tag a device last used in a
+    # wallet/claim request.
+    def __init__(self, db, interval: float = 0.1, depth: int = 64, keepalive: float = 15.0):
+        self.db = db; self.interval = interval; self.depth = depth; self.keepalive = keepalive
+        self._lock = threading.Lock(); self._subs = set(); self._task = None
+        self.mode = db.get_mode(); _, items = db.payout_snapshot(); self.payouts = {it["payout_id"]: it for it in items}
+        self.devices = {}; self._by_tag = {}; self._tags = {}; self.step = None; self.tally = {}
+        self.v = 0; self._d_mode = False; self._d_night = False; self._d_devs = set(); self._added = {}; self._claimed = set()
+        self.diffs = 0; self.snapshots = 0; self.dropped = 0; self.bytes_out = 0
+        db.listeners.append(self.on_commit)
+
+    # --- feeds (any thread) ----------------------------------------------------
+    def on_commit(self, events):
+        with self._lock:
+            for e in events:
+                if e[0] == "wallet":
+                    if e[1] in self._tags: self._tags[e[1]] = e[2]; self._d_devs |= self._by_tag.get(e[1], set())
+                elif e[0] == "payout_added":
+                    self.payouts[e[2]["payout_id"]] = e[2]
+                    if self._subs: self._added[e[2]["payout_id"]] = e[2]; self._claimed.discard(e[2]["payout_id"])
+                elif e[0] == "payout_claimed":
+                    self.payouts.pop(e[2], None)
+                    if self._subs and self._added.pop(e[2], None) is None: self._claimed.add(e[2])
+    def seen(self, device_id, tag_uid):
+        # Request path: cheap when the device's tag hasn't changed.
+        tag = str(tag_uid).upper()
+        if not device_id or self.devices.get(device_id) == tag: return
+        with self._lock:
+            old = self.devices.get(device_id); self.devices[device_id] = tag
+            if old is not None:
+                s = self._by_tag.get(old, set()); s.discard(device_id)
+                if not s: self._by_tag.pop(old, None); self._tags.pop(old, None)
+            self._by_tag.setdefault(tag, set()).add(device_id)
+            if tag not in self._tags: self._tags[tag] = self.db.cached_balance(tag)
+            self._d_devs.add(device_id)
+    def balance(self, tag_uid, bal):
+        with self._lock:
+            if tag_uid in self._tags and bal is not None: self._tags[tag_uid] = bal; self._d_devs |= self._by_tag[tag_uid]
+    def set_mode(self, mode):
+        with self._lock: self.mode = mode; self._d_mode = True
+    def set_step(self, body):
+        with self._lock: self.step = body; self._d_night = True
+    def on_tally(self, step, body):
+        with self._lock:
+            if body is None: self.tally.pop(step, None)
+            else: self.tally[step] = body
+            self._d_night = True
+
+    # --- views ---------------------------------------------------------------
+    def _device(self, d):
+        tag = self.devices.get(d)
+        return None if tag is None else {"tag_uid": tag, "balance_cents": self._tags.get(tag)}
+    def _night(self): return {"step": self.step, "tally": dict(self.tally)}
+    def snapshot(self, device_id=None, parts=PARTS):
+        with self._lock: return self._snapshot(device_id, parts)
+    def _snapshot(self, device_id, parts):
+        out = {"v": self.v}
+        if "mode" in parts: out["mode"] = self.mode
+        if "devices" in parts: out["devices"] = {d: self._device(d) for d in ([device_id] if device_id else self.devices)}
+        if "payouts" in parts: out["payouts"] = list(self.payouts.values())
+        if "night" in parts: out["night"] = self._night()
+        return out
+    def _take(self):
+        # The pending diff as {part: value}, or None; clears the dirty marks.
+        with self._lock:
+            if not (self._d_mode or self._d_night or self._d_devs or self._added or self._claimed): return None
+            self.v += 1; diff = {"v": self.v}
+            if self._d_mode: diff["mode"] = self.mode
+            if self._d_devs: diff["devices"] = {d: self._device(d) for d in self._d_devs}
+            if self._added or self._claimed: diff["payouts"] = {"added": list(self._added.values()), "claimed": sorted(self._claimed)}
+            if self._d_night: diff["night"] = self._night()
+            self._d_mode = self._d_night = False; self._d_devs = set(); self._added = {}; self._claimed = set()
+            self.diffs += 1; return diff
+    @staticmethod
+    def _filter(diff, device_id, parts):
+        out = {k: v for k, v in diff.items() if k == "v" or k in parts}
+        if device_id and "devices" in out:
+            if device_id not in out["devices"]: del out["devices"]
+            else: out["devices"] = {device_id: out["devices"][device_id]}
+        return out if len(out) > 1 else None
+
+    # --- fan-out (event loop) ------------------------------------------------
+    async def _run(self):
+        while self._subs:
+            await asyncio.sleep(self.interval)
+            diff = self._take()
+            if diff is None: continue
+            frames = {}
+            for s in tuple(self._subs):
+                if s.key not in frames:
+                    f = self._filter(diff, s.device_id, s.parts); frames[s.key] = _frame("diff", f, diff["v"]) if f else None
+                b = frames[s.key]
+                if b is None: continue
+                try: s.q.put_nowait(b)
+                except asyncio.QueueFull: s.dropped = True; self._subs.discard(s); self.dropped += 1
+        self._task = None
+    async def stream(self, device_id=None, parts=PARTS):
+        s = _Sub(device_id, tuple(p for p in PARTS if p in parts), self.depth)
+        if self._task is None: self._take()  # nobody was listening: the snapshot covers it
+        with self._lock: snap = self._snapshot(device_id, s.parts)
+        self._subs.add(s); self.snapshots += 1
+        if self._task is None: self._task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            b = _frame("snapshot", snap, snap["v"]); self.bytes_out += len(b); yield b
+            while not s.dropped:
+                try: b = await asyncio.wait_for(s.q.get(), self.keepalive)
+                except asyncio.TimeoutError: yield b": keepalive\n\n"; continue
+                self.bytes_out += len(b); yield b
+        finally: self._subs.discard(s)
+    def stats(self):
+        return {"streams": len(self._subs), "v": self.v, "diffs": self.diffs, "snapshots": self.snapshots, "dropped": self.dropped,
+                "bytes_out": self.bytes_out, "devices": len(self.devices), "payouts": len(self.payouts)}
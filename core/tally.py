@@ -0,0 +1,71 @@
+import threading, time
+from collections import OrderedDict
+class Tally:
+    # Night-mode vote tallies. Counts are kept per step and updated per vote
+    # (a repeat vote from a device moves its count). Results go out on
+    # <base>/<step> as retained {"step","v","votes","counts","closed"}, at
+    # most once per `interval` per step: a burst of votes between two flushes
+    # is a single publish. Votes are persisted to tx_log in one batch per
+    # flush (or every `batch` votes). Opening a step closes the previous
+    # ones; only the `keep` most recent steps stay in memory (and retained).
+    # Only open() creates a step: votes for a closed step are counted as late,
+    # votes naming no step or one never opened (or already evicted) as
+    # rejected, and both are dropped.
+    def __init__(self, db, pub, base: str, interval: float = 0.25, keep: int = 4, batch: int = 500):
+        self.db = db; self.pub = pub; self.base = base; self.interval = interval; self.keep = max(1, keep); self.batch = batch
+        self._lock = threading.Lock(); self._steps = OrderedDict(); self._dirty = set(); self._rows = []
+        self._timer = None; self._last = 0.0; self.listeners = []
+        self.votes = 0; self.late = 0; self.rejected = 0; self.published = 0; self.persisted = 0; self.evicted = 0
+    def _step(self, step):
+        st = self._steps.get(step)
+        if st is None:
+            st = self._steps[step] = {"counts": {}, "voters": {}, "v": 0, "closed": False}
+            while len(self._steps) > self.keep:
+                old, _ = self._steps.popitem(last=False); self._dirty.discard(old); self.evicted += 1
+                self.pub(f"{self.base}/{old}", None, qos=1, retain=True)
+                for fn in self.listeners: fn(old, None)
+        return st
+    def open(self, step: str):
+        with self._lock:
+            for name, st in self._steps.items():
+                if name != step and not st["closed"]: st["closed"] = True; st["v"] += 1; self._dirty.add(name)
+            self._step(step)
+        self.flush()
+    def vote(self, p):
+        step = p.get("step"); dev = p.get("device_id", "?"); choice = str(p.get("choice"))
+        with self._lock:
+            st = self._steps.get(str(step)) if step is not None else None
+            if st is None: self.rejected += 1; return
+            if st["closed"]: self.late += 1; return
+            step = str(step)
+            prev = st["voters"].get(dev)
+            if prev == choice: return
+            c = st["counts"]
+            if prev is not None:
+                c[prev] -= 1
+                if not c[prev]: del c[prev]
+            c[choice] = c.get(choice, 0) + 1; st["voters"][dev] = choice; st["v"] += 1
+            self.votes += 1; self._dirty.add(step); self._rows.append(("vote", dev, None, None, p))
+            full = len(self._rows) >= self.batch
+            if not full and self._timer is None:
+                wait = max(0.0, self._last + self.interval - time.monotonic())
+                self._timer = threading.Timer(wait, self.flush); self._timer.daemon = True; self._timer.start()
+        if full: self.flush()
+    def _publish(self, step, st):
+        body = {"step": step, "v": st["v"], "votes": len(st["voters"]), "counts": dict(st["counts"]), "closed": st["closed"]}
+        self.pub(f"{self.base}/{step}", body, qos=1, retain=True)
+        for fn in self.listeners: fn(step, body)
+        self.published += 1
+    def flush(self):
+        with self._lock:
+            if self._timer is not None: self._timer.cancel(); self._timer = None
+            self._last = time.monotonic(); rows, self._rows = self._rows, []; self.persisted += len(rows)
+            for step in sorted(self._dirty, key=list(self._steps).index): self._publish(step, self._steps[step])
+            self._dirty.clear()
+        if rows: self.db.log_many(rows)
+    def snapshot(self):
+        with self._lock:
+            return {s: {"v": st["v"], "votes": len(st["voters"]), "counts": dict(st["counts"]), "closed": st["closed"]} for s, st in self._steps.items()}
+    def stats(self):
+        return {"steps": len(self._steps), "votes": self.votes, "late": self.late, "rejected": self.rejected, "published": self.published, "persisted": self.persisted,
+                "evicted": self.evicted, "interval": self.interval}
@@ -0,0 +1,217 @@
+import os, sys, json, time, zlib, struct, sqlite3, threading, itertools, datetime
+from array import array
+from collections import OrderedDict
+# tx_log retention. The live tx_log table only holds the current partition
+# (a UTC day or ISO week): an insert is a rowid append plus two index
+# entries (device, tag) into B-trees that never outgrow one partition. A background rotation moves each closed partition into
+# compressed column segments under `archive_dir` and trims it from tx_log:
+#   1. write <part>-<first id>.seg (at most seg_rows rows each)
+#   2. register it in tx_archive and advance kv txlog_archived_upto, in one txn
+#   3. delete the archived ids from tx_log in small chunks
+# Rows with id <= archived_upto are read from segments, the rest from tx_log,
+# so query() sees every row exactly once even halfway through a rotation.
+#
+# Segment file: MAGIC, u32 header length, JSON header {rows, min/max id+ts,
+# cols: {name: [offset, length]}}, then one zlib blob per column. id and ts are
+# delta-coded int64, device_id/op/tag_uid dictionary-coded, details is one
+# JSON document per line. A query only inflates the columns it filters on
+# until something matches.
+MAGIC = b"EGTX1\n"; COLS = ("id", "ts", "device_id", "op", "tag_uid", "amount_cents", "details")
+TS_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+def _epoch(ts): return int(datetime.datetime.strptime(ts, TS_FMT).replace(tzinfo=datetime.timezone.utc).timestamp())
+def _iso(e): return time.strftime(TS_FMT, time.gmtime(e))
+
+def partition_of(ts: str, kind: str = "day") -> str:
+    if kind == "week":
+        y, w, _ = datetime.date.fromisoformat(ts[:10]).isocalendar(); return f"{y}-W{w:02d}"
+    return ts[:10]
+
+def _pack_ints(xs):
+    prev = 0; out = array("q")
+    for x in xs: out.append(x - prev); prev = x
+    return out.tobytes()
+def _unpack_ints(b):
+    a = array("q"); a.frombytes(b); return list(itertools.accumulate(a))
+def _pack_dict(xs):
+    d = {}; codes = array("I", (d.setdefault(x, len(d)) for x in xs))
+    return json.dumps(list(d)).encode() + b"\n" + codes.tobytes()
+def _unpack_dict(b):
+    i = b.index(b"\n"); vals = json.loads(b[:i]); codes = array("I"); codes.frombytes(b[i+1:])
+    return [vals[c] for c in codes]
+
+def write_segment(path, rows):
+    # rows: tx_log rows in id order.
+    cols = {
+        "id": _pack_ints(r["id"] for r in rows), "ts": _pack_ints(_epoch(r["ts"]) for r in rows),
+        "device_id": _pack_dict(r["device_id"] for r in rows), "op": _pack_dict(r["op"] for r in rows),
+        "tag_uid": _pack_dict(r["tag_uid"] for r in rows),
+        "amount_cents": json.dumps([r["amount_cents"] for r in rows]).encode(),
+        "details": "\n".join(r["details"] or "null" for r in rows).encode(),
+    }
+    head = {"v": 1, "rows": len(rows), "min_id": rows[0]["id"], "max_id": rows[-1]["id"], "min_ts": rows[0]["ts"], "max_ts": rows[-1]["ts"], "cols": {}}
+    blobs = []; off = 0
+    for k, b in cols.items():
+        z = zlib.compress(b, 6); head["cols"][k] = [off, len(z)]; blobs.append(z); off += len(z)
+    h = json.dumps(head).encode(); tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(h)) + h)
+        for z in blobs: f.write(z)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path); return head, len(MAGIC) + 4 + len(h) + off
+
+class Segment:
+    def __init__(self, path):
+        self.path = path; self._cols = {}
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC: raise ValueError(f"not a tx_log segment: {path}")
+            n = struct.unpack("<I", f.read(4))[0]; self.head = json.loads(f.read(n)); self.base = len(MAGIC) + 4 + n
+        self.rows = self.head["rows"]
+    def col(self, name):
+        c = self._cols.get(name)
+        if c is not None: return c
+        off, n = self.head["cols"][name]
+        with open(self.path, "rb") as f: f.seek(self.base + off); b = zlib.decompress(f.read(n))
+        if name == "id": c = _unpack_ints(b)
+        elif name == "ts": c = [_iso(e) for e in _unpack_ints(b)]
+        elif name in ("device_id", "op", "tag_uid"): c = _unpack_dict(b)
+        elif name == "amount_cents": c = json.loads(b)
+        else: c = b.decode().split("\n")
+        self._cols[name] = c; return c
+    def scan(self, after_id, limit, eq, since=None, until=None):
+        ids = self.col("id"); pos = [i for i in range(self.rows) if ids[i] > after_id]
+        for k, v in eq.items():
+            if pos: c = self.col(k); pos = [i for i in pos if c[i] == v]
+        if pos and (since or until):
+            ts = self.col("ts"); pos = [i for i in pos if (not since or ts[i] >= since) and (not until or ts[i] < until)]
+        pos = pos[:limit]
+        if not pos: return []
+        cols = {k: self.col(k) for k in COLS}
+        return [{k: (json.loads(cols[k][i]) if k == "details" else cols[k][i]) for k in COLS} for i in pos]
+
+class TxLog:
+    def __init__(self, db, archive_dir: str, partition: str = "day", interval: float = 3600.0, retain_days: float = 0,
+                 seg_rows: int = 200000, trim_chunk: int = 5000, cache_segments: int = 4):
+        self.db = db; self.dir = archive_dir; self.partition = partition; self.interval = interval; self.retain_days = retain_days
+        self.seg_rows = max(1, seg_rows); self.trim_chunk = max(1, trim_chunk)
+        os.makedirs(archive_dir, exist_ok=True)
+        # Reads use their own WAL connection so they never take the ledger lock.
+        self.rconn = sqlite3.connect(db.path, check_same_thread=False, isolation_level=None); self.rconn.row_factory = sqlite3.Row
+        self._rlock = threading.Lock(); self._rotating = threading.Lock(); self._stop = threading.Event(); self._thread = None
+        self._segs = OrderedDict(); self._slock = threading.Lock(); self.cache_segments = cache_segments
+        self.rotations = 0; self.archived = 0; self.last_rotate_ms = None; self.errors = 0
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._loop, name="txlog-rotate", daemon=True); self._thread.start()
+        return self
+    def stop(self): self._stop.set()
+    def _loop(self):
+        while not self._stop.is_set():
+            try: self.rotate()
+            except Exception as e: self.errors += 1; print(f"[txlog] rotation failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _upto(self, c):
+        r = c.execute("SELECT value FROM kv WHERE key='txlog_archived_upto'").fetchone(); return int(r[0]) if r else 0
+    def rotate(self, now: str | None = None) -> int:
+        # Archives every partition older than the one `now` falls in; returns
+        # the number of rows moved.
+        with self._rotating:
+            t0 = time.perf_counter(); hot = partition_of(now or self.db.now(), self.partition); moved = 0
+            with self._rlock: upto = self._upto(self.rconn)
+            self._trim(upto)
+            while True:
+                with self._rlock:
+                    rows = [dict(r) for r in self.rconn.execute(
+                        "SELECT id,ts,device_id,op,tag_uid,amount_cents,details FROM tx_log WHERE id>? ORDER BY id LIMIT ?", (upto, self.seg_rows))]
+                if not rows: break
+                part = partition_of(rows[0]["ts"], self.partition)
+                if part >= hot: break
+                rows = list(itertools.takewhile(lambda r: partition_of(r["ts"], self.partition) == part, rows))
+                seg = f"{part}-{rows[0]['id']}.seg"; head, size = write_segment(os.path.join(self.dir, seg), rows)
+                meta = {"seg": seg, "part": part, "min_id": head["min_id"], "max_id": head["max_id"], "min_ts": head["min_ts"],
+                        "max_ts": head["max_ts"], "rows": head["rows"], "bytes": size,
+                        "devices": sorted({r["device_id"] for r in rows}), "ops": sorted({r["op"] for r in rows})}
+                self.db.submit("txlog_archive", meta).result(); upto = head["max_id"]; moved += len(rows)
+                self._trim(upto)
+            self._expire()
+            with self._rlock: self.rconn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            self.rotations += 1; self.archived += moved; self.last_rotate_ms = round((time.perf_counter()-t0)*1000, 1)
+            return moved
+    def _trim(self, upto):
+        # Small deletes, each its own ledger batch, so writers never queue
+        # behind one huge DELETE.
+        while upto and self.db.submit("txlog_trim", upto, self.trim_chunk).result(): pass
+    def _expire(self):
+        if self.retain_days <= 0: return
+        cutoff = _iso(time.time() - self.retain_days*86400)
+        with self._rlock: old = [r[0] for r in self.rconn.execute("SELECT seg FROM tx_archive WHERE max_ts < ?", (cutoff,))]
+        for seg in old:
+            self.db.submit("txlog_forget", seg).result()
+            with self._slock: self._segs.pop(seg, None)
+            try: os.remove(os.path.join(self.dir, seg))
+            except FileNotFoundError: pass
+
+    def _segment(self, seg):
+        with self._slock:
+            s = self._segs.get(seg)
+            if s is not None: self._segs.move_to_end(seg); return s
+        s = Segment(os.path.join(self.dir, seg))
+        with self._slock:
+            self._segs[seg] = s
+            while len(self._segs) > self.cache_segments: self._segs.popitem(last=False)
+        return s
+    def query(self, device_id=None, tag_uid=None, op=None, since=None, until=None, after_id: int = 0, limit: int = 100, conn=None):
+        # Rows in id order with id > after_id; pass the last id back as
+        # after_id for the next page. since/until compare against ts
+        # (ISO prefixes such as "2026-10-18" work; until is exclusive).
+        # conn: a read connection owned by the caller (reads.ReadPool);
+        # without one the shared rconn is used under its lock.
+        if conn is not None: return self._query(conn, device_id, tag_uid, op, since, until, after_id, limit)
+        with self._rlock: return self._query(self.rconn, device_id, tag_uid, op, since, until, after_id, limit)
+    def _query(self, c, device_id, tag_uid, op, since, until, after_id, limit):
+        eq = {k: v for k, v in (("device_id", device_id), ("op", op), ("tag_uid", tag_uid)) if v is not None}
+        limit = max(1, int(limit)); out = []
+        c.execute("BEGIN")
+        try:
+            upto = self._upto(c)
+            if after_id < upto:
+                for r in c.execute("SELECT seg,devices,ops FROM tx_archive WHERE max_id>? AND (? IS NULL OR max_ts>=?) AND (? IS NULL OR min_ts<?) ORDER BY min_id",
+                                   (after_id, since, since, until, until)).fetchall():
+                    if device_id is not None and device_id not in json.loads(r["devices"]): continue
+                    if op is not None and op not in json.loads(r["ops"]): continue
+                    try: s = self._segment(r["seg"])
+                    except FileNotFoundError: continue
+                    out += s.scan(after_id, limit-len(out), eq, since, until)
+                    if len(out) >= limit: return out
+            sql = "SELECT id,ts,device_id,op,tag_uid,amount_cents,details FROM tx_log WHERE id>?"; args = [max(after_id, upto)]
+            for k, v in eq.items(): sql += f" AND {k}=?"; args.append(v)
+            if since: sql += " AND ts>=?"; args.append(since)
+            if until: sql += " AND ts<?"; args.append(until)
+            for r in c.execute(sql + " ORDER BY id LIMIT ?", args + [limit-len(out)]):
+                d = dict(r); d["details"] = json.loads(d["details"]) if d["details"] else None; out.append(d)
+            return out
+        finally: c.execute("COMMIT")
+    def stats(self):
+        with self._rlock:
+            r = self.rconn.execute("SELECT COUNT(*) n, COALESCE(SUM(rows),0) rows, COALESCE(SUM(bytes),0) bytes FROM tx_archive").fetchone()
+            upto = self._upto(self.rconn)
+        return {"partition": self.partition, "segments": r["n"], "archived_rows": r["rows"], "archive_bytes": r["bytes"], "archived_upto": upto,
+                "rotations": self.rotations, "moved_rows": self.archived, "last_rotate_ms": self.last_rotate_ms, "errors": self.errors}
+
+if __name__ == "__main__":
+    # python txlog.py rotate|query|stats --db /data/core.db [--dir /data/txlog]
+    import argparse
+    from db import DB
+    ap = argparse.ArgumentParser(description="tx_log archive tool")
+    ap.add_argument("cmd", choices=["rotate", "query", "stats"]); ap.add_argument("--db", default=os.getenv("DB_PATH", "/data/core.db"))
+    ap.add_argument("--dir", default=None); ap.add_argument("--partition", default=os.getenv("TXLOG_PARTITION", "day"))
+    ap.add_argument("--now", default=None, help="rotate as if it were this ts (archives everything before its partition)")
+    for k in ("device-id", "tag-uid", "op", "since", "until"): ap.add_argument("--"+k, default=None)
+    ap.add_argument("--after-id", type=int, default=0); ap.add_argument("--limit", type=int, default=100)
+    a = ap.parse_args()
+    t = TxLog(DB(a.db, batch_max=1), a.dir or os.path.join(os.path.dirname(os.path.abspath(a.db)), "txlog"), a.partition, interval=0)
+    if a.cmd == "rotate": print(json.dumps({"moved": t.rotate(a.now), **t.stats()}))
+    elif a.cmd == "stats": print(json.dumps(t.stats()))
+    else:
+        for r in t.query(a.device_id, a.tag_uid, a.op, a.since, a.until, a.after_id, a.limit): json.dump(r, sys.stdout); print()
@@ -0,0 +1,48 @@
+
+import os, sys, asyncio, argparse, importlib
+from .common.event_bus import EventBus, Event
+from .common.input_keyboard import keyboard_task
+from .common.mqtt_helper import MqttClient
+from .common.provisioning import read_yaml
+# All-in-one: core (FastAPI + ledger) and the device agents in one process on
+# one Pi, talking over the in-process loopback transport instead of TCP.
+#   python -m devices.allinone --device slot:slot-01 --device change:change-01
+# The keyboard drives the first device; only the first slot polls the RFID reader.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DEVICES = ["slot:slot-01", "roulette:roulette-01", "blackjack:blackjack-01", "change:change-01"]
+
+def load_pins(kind: str) -> dict:
+    path = os.path.join(ROOT, "devices", kind, "device_config.yaml")
+    return (read_yaml(path).get("pins") or {}) if os.path.exists(path) else {}
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", action="append", default=None, help="kind:device_id (repeatable)")
+    parser.add_argument("--host", default="0.0.0.0"); parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--db", default=os.path.join(ROOT, "data", "core.db"))
+    args = parser.parse_args()
+
+    os.environ.setdefault("EG_TRANSPORT", "loopback"); os.environ.setdefault("DB_PATH", args.db)
+    sys.path.insert(0, os.path.join(ROOT, "core"))
+    import uvicorn
+    import core; core.start_mqtt()  # the core's MQTT client, on the loopback broker
+    server = uvicorn.Server(uvicorn.Config(core.app, host=args.host, port=args.port, log_level="warning"))
+    srv = asyncio.create_task(server.serve())
+
+    loop = asyncio.get_running_loop(); buses = []; tasks = []; rfid = True
+    for spec in args.device or DEFAULT_DEVICES:
+        kind, _, device_id = spec.partition(":"); device_id = device_id or f"{kind}-01"
+        mod = importlib.import_module(f"devices.{kind}.agent"); kw = {}
+        if kind == "slot": kw["rfid"] = rfid; rfid = False
+        bus = EventBus(); mq = MqttClient(client_id=device_id); mq.connect()
+        buses.append(bus); tasks.append(asyncio.create_task(mod.run(bus, loop, device_id, mq, load_pins(kind), **kw)))
+        print(f"[allinone] {kind} {device_id}")
+    kb = asyncio.create_task(keyboard_task(buses[0], "allinone"))
+
+    await tasks[0]
+    for bus in buses[1:]: await bus.publish(Event("quit", {}))
+    await asyncio.wait(tasks[1:], timeout=2); kb.cancel()
+    server.should_exit = True; await srv
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,12 @@
 
 import os, asyncio, argparse
-from datetime import datetime
 from ..common.event_bus import EventBus
 from ..common.input_keyboard import keyboard_task
 from ..common.mqtt_helper import MqttClient
 from ..common.io_gpio import AsyncButton
 from ..common.identity import ensure_device_id
+from ..common.provisioning import state_path_for, read_yaml
+from ..common import hw
 
 async def main():
     parser = argparse.ArgumentParser()
@@ -17,41 +18,104 @@ async def main():
     loop = asyncio.get_running_loop()
     kb = asyncio.create_task(keyboard_task(bus, "provision"))
 
-    import yaml, json
-    with open(args.config,"r") as f:
-        raw_cfg = yaml.safe_load(f) or {}
+    raw_cfg = read_yaml(args.config)
     pins = (raw_cfg.get("pins") or {})
 
     allowed_ids = ["change-01"]
     agent_dir = os.path.dirname(__file__)
-    device_id = await ensure_device_id(bus, loop, agent_dir, "change", allowed_ids, args.config, args.device_id, pins)
+    device_id = await ensure_device_id(bus, loop, agent_dir, "change", allowed_ids, raw_cfg, args.device_id, pins)
+    hw.configure(state_path_for(agent_dir, "change"))
     print(f"[change] device_id = {device_id}")
 
-    mq = MqttClient(client_id=device_id); mq.connect()
+    mq = MqttClient(client_id=device_id, codec=raw_cfg.get("codec")); mq.connect()
+    await run(bus, loop, device_id, mq, pins)
 
-    sel_idx = 0; payouts = []; current_tag = None
+async def run(bus, loop, device_id: str, mq, pins: dict):
+    import json
+    sel_idx = 0; payouts = []; current_tag = None; inflight = set()
+    # Payout feed state: `ready` is the local copy at version `feed_v`; deltas
+    # that arrive before a snapshot, or after a gap, wait in `pending`.
+    feed_base = mq.topic("dev","change-01","payouts")
+    ready = {}; feed_v = None; pages = {}; pending = []; syncing = False
 
     def on_connect(c,u,f,rc):
-        print(f"[{device_id}] MQTT rc={rc}")
-        mq.subscribe(mq.topic("dev","change-01","payouts"), qos=1)
+        nonlocal syncing
+        print(f"[{device_id}] MQTT rc={rc}"); syncing = False
+        mq.subscribe(feed_base+"/snapshot/+", qos=1)
+        mq.subscribe(feed_base+"/delta", qos=1)
         mq.subscribe(mq.topic("dev","change-01","res"), qos=1)
 
-    def on_message(c,u,m):
+    def request_sync():
+        nonlocal syncing
+        if syncing: return
+        syncing = True; print(f"[change] payout feed gap at v={feed_v}; resyncing")
+        mq.publish(mq.topic("core","payouts","sync"), {"device_id": device_id})
+
+    def refresh():
         nonlocal payouts, sel_idx
-        if m.topic.endswith("/payouts"):
+        payouts = list(ready.values())
+        if sel_idx >= len(payouts): sel_idx = max(0, len(payouts)-1)
+        print(f"[change] payouts: {len(payouts)} items (v{feed_v}); selected index = {sel_idx}")
+
+    def apply(d):
+        nonlocal feed_v
+        for it in d.get("added", []): ready[it["payout_id"]] = it
+        for pid in d.get("claimed", []): ready.pop(pid, None)
+        feed_v = d["v"]
+
+    def drain_pending():
+        pending.sort(key=lambda d: d["base"])
+        while pending and pending[0]["base"] <= feed_v:
+            d = pending.pop(0)
+            if d["v"] > feed_v: apply(d)
+        if pending: request_sync()
+
+    def on_snapshot(data):
+        nonlocal ready, feed_v, syncing
+        v = data["v"]
+        if feed_v is not None and v <= feed_v: return
+        got = pages.setdefault(v, {}); got[data["page"]] = data["items"]
+        if len(got) < data["pages"]: return
+        ready = {it["payout_id"]: it for i in range(data["pages"]) for it in got[i]}
+        feed_v = v; syncing = False
+        for k in [k for k in pages if k <= v]: del pages[k]
+        drain_pending(); refresh()
+
+    def on_delta(d):
+        if feed_v is None or d["base"] > feed_v:
+            pending.append(d)
+            if feed_v is not None: request_sync()
+            return
+        if d["v"] <= feed_v: return
+        apply(d); refresh()
+
+    def on_message(c,u,m):
+        if m.topic.startswith(feed_base+"/"):
+            if not m.payload: return
             data = json.loads(m.payload.decode("utf-8"))
-            payouts = data.get("items", [])
-            if sel_idx >= len(payouts): sel_idx = max(0, len(payouts)-1)
-            print(f"[change] payouts: {len(payouts)} items; selected index = {sel_idx}")
+            if m.topic.endswith("/delta"): on_delta(data)
+            else: on_snapshot(data)
         else:
             print(f"[change] <- {m.topic} {m.payload.decode()}")
 
+    async def claim(pid, tag):
+        try: res = await mq.request(mq.topic("core","payouts","claim"), {"payout_id": pid, "tag_uid": tag})
+        except asyncio.TimeoutError: print(f"[change] claim {pid} timed out"); return
+        print(f"[change] claim {pid} -> {res.get('status')} credited={res.get('credited_cents')} balance={res.get('new_balance_cents')}")
+
+    async def claim_many(pids, tag):
+        # Every listed payout in one request and one ledger commit.
+        try: res = await mq.request(mq.topic("core","payouts","claim_many"), {"payout_ids": pids, "tag_uid": tag})
+        except asyncio.TimeoutError: print(f"[change] claim of {len(pids)} payouts timed out"); return
+        ok = sum(1 for r in res.get("results") or [] if r.get("status") == "ok")
+        print(f"[change] claim {ok}/{len(pids)} -> {res.get('status')} credited={res.get('credited_cents')} balance={res.get('new_balance_cents')}")
+
     mq.on_connect(on_connect); mq.on_message(on_message)
 
-    if (pins.get("buttons") or {}).get("claim") is not None:
-        AsyncButton(int(pins["buttons"]["claim"]), "claim", bus, loop)
+    for name in ("claim", "claim_all"):
+        if (pins.get("buttons") or {}).get(name) is not None: AsyncButton(int(pins["buttons"][name]), name, bus, loop)
 
-    print("[change] CMD: r <UID> (scan), n/p (select), Enter/claim (credit), q (quit).")
+    print("[change] CMD: r <UID> (scan), n/p (select), Enter/claim (credit), k claim_all (credit every ready payout), q (quit).")
 
     def claim_selected():
         nonlocal current_tag
@@ -60,10 +124,13 @@ async def main():
         if not current_tag:
             print("[change] scan a tag first (r <UID>)"); return
         pid = payouts[sel_idx]["payout_id"]
-        mq.publish(mq.topic("core","payouts","claim"), {
-            "req_id": f"{device_id}-{datetime.utcnow().timestamp()}",
-            "device_id": device_id, "payout_id": pid, "tag_uid": current_tag
-        })
+        t = asyncio.create_task(claim(pid, current_tag)); inflight.add(t); t.add_done_callback(inflight.discard)
+
+    def claim_all():
+        if not payouts or not current_tag:
+            print("[change] need a scanned tag and at least one payout."); return
+        pids = [it["payout_id"] for it in payouts]
+        t = asyncio.create_task(claim_many(pids, current_tag)); inflight.add(t); t.add_done_callback(inflight.discard)
 
     while True:
         ev = await bus.next()
@@ -76,7 +143,9 @@ async def main():
             elif key == "prev" and payouts: sel_idx = (sel_idx - 1) % len(payouts); print(f"[change] select {sel_idx}")
             elif key == "ok": claim_selected()
         elif ev.type == "button":
-            if ev.data.get("name")=="claim" and ev.data.get("edge")=="press": claim_selected()
+            if ev.data.get("edge")!="press": continue
+            if ev.data.get("name")=="claim": claim_selected()
+            elif ev.data.get("name")=="claim_all": claim_all()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,17 +1,119 @@
 
 from dataclasses import dataclass
 from typing import Any, Dict
+from collections import deque, OrderedDict
 import asyncio
 @dataclass
 class Event:
     type: str
     data: Dict[str, Any]
+
+POLICIES = ("block", "drop_oldest", "coalesce")
+
+class Subscription:
+    # One consumer's bounded queue. When it is full:
+    #   block        publish() waits for room (publish_nowait drops the new event)
+    #   drop_oldest  the oldest queued event is discarded
+    #   coalesce     an event whose key (default: its type) is already queued
+    #                replaces that entry in place; otherwise drop_oldest
+    # All methods run on the bus's event loop.
+    def __init__(self, bus, types, maxsize: int, policy: str, key=None):
+        if policy not in POLICIES: raise ValueError(f"unknown policy {policy!r}")
+        self.bus = bus; self.types = frozenset(types) if types else None; self.maxsize = max(1, maxsize); self.policy = policy
+        self.key = key or (lambda ev: ev.type)
+        self._q = OrderedDict() if policy == "coalesce" else deque(); self._getter = None; self._putters = deque()
+        self.delivered = 0; self.dropped = 0; self.coalesced = 0; self.max_depth = 0
+    def wants(self, ev): return self.types is None or ev.type in self.types
+    def depth(self): return len(self._q)
+    def _offer(self, ev) -> bool:
+        q = self._q
+        if self.policy == "coalesce":
+            k = self.key(ev)
+            if k in q: q[k] = ev; self.coalesced += 1; return True
+            if len(q) >= self.maxsize: q.popitem(last=False); self.dropped += 1
+            q[k] = ev
+        else:
+            if len(q) >= self.maxsize:
+                if self.policy == "block": return False
+                q.popleft(); self.dropped += 1
+            q.append(ev)
+        if len(q) > self.max_depth: self.max_depth = len(q)
+        g = self._getter
+        if g is not None and not g.done(): g.set_result(None)
+        return True
+    def _pop(self):
+        ev = self._q.popitem(last=False)[1] if self.policy == "coalesce" else self._q.popleft()
+        self.delivered += 1
+        while self._putters:
+            p = self._putters.popleft()
+            if not p.done(): p.set_result(None); break
+        return ev
+    async def _room(self):
+        f = asyncio.get_running_loop().create_future(); self._putters.append(f); await f
+    async def get(self) -> Event:
+        while not self._q:
+            self._getter = asyncio.get_running_loop().create_future()
+            try: await self._getter
+            finally: self._getter = None
+        return self._pop()
+    async def drain(self, max_n: int | None = None) -> list:
+        # Waits for one event, then takes whatever else is already queued.
+        evs = [await self.get()]
+        while self._q and (max_n is None or len(evs) < max_n): evs.append(self._pop())
+        return evs
+    def close(self): self.bus.unsubscribe(self)
+    def stats(self):
+        return {"types": sorted(self.types) if self.types else None, "policy": self.policy, "maxsize": self.maxsize, "depth": len(self._q),
+                "max_depth": self.max_depth, "delivered": self.delivered, "dropped": self.dropped, "coalesced": self.coalesced}
+
 class EventBus:
-    def __init__(self):
-        self.queue: asyncio.Queue[Event] = asyncio.Queue()
+    # Fan-out bus: every subscription whose types match gets its own copy of
+    # an event. next()/drain() read a catch-all subscription created on first
+    # use. Events nobody subscribes to yet are parked (bounded) and handed to
+    # the first matching subscription, so a consumer that starts late (e.g.
+    # the main loop after provisioning) doesn't miss what came before.
+    def __init__(self, maxsize: int = 256, policy: str = "block"):
+        self.maxsize = maxsize; self.policy = policy
+        self._subs = []; self._default = None; self._parked = deque(maxlen=maxsize)
+        self.published = 0; self.parked = 0
+    def subscribe(self, *types, maxsize: int | None = None, policy: str | None = None, key=None) -> Subscription:
+        s = Subscription(self, types, maxsize or self.maxsize, policy or self.policy, key); self._subs.append(s)
+        if self._parked:
+            keep = deque(maxlen=self.maxsize)
+            for ev in self._parked:
+                if s.wants(ev): s._offer(ev)
+                else: keep.append(ev)
+            self._parked = keep
+        return s
+    def unsubscribe(self, s):
+        if s in self._subs: self._subs.remove(s)
+        if s is self._default: self._default = None
+    def _park(self, ev): self._parked.append(ev); self.parked += 1
     async def publish(self, ev: Event):
-        await self.queue.put(ev)
+        self.published += 1; hit = False
+        for s in tuple(self._subs):
+            if not s.wants(ev): continue
+            hit = True
+            while not s._offer(ev): await s._room()
+        if not hit: self._park(ev)
+    def publish_nowait(self, ev: Event):
+        # Loop thread only; never waits, so a full "block" queue drops the event.
+        self.published += 1; hit = False
+        for s in self._subs:
+            if not s.wants(ev): continue
+            hit = True
+            if not s._offer(ev): s.dropped += 1
+        if not hit: self._park(ev)
     def publish_threadsafe(self, loop: asyncio.AbstractEventLoop, ev: Event):
-        loop.call_soon_threadsafe(self.queue.put_nowait, ev)
+        # From GPIO/RFID threads: one callback, no task per event.
+        loop.call_soon_threadsafe(self.publish_nowait, ev)
+    def default(self) -> Subscription:
+        if self._default is None: self._default = self.subscribe()
+        return self._default
     async def next(self) -> Event:
-        return await self.queue.get()
+        return await self.default().get()
+    async def drain(self, max_n: int | None = None) -> list:
+        return await self.default().drain(max_n)
+    def stats(self):
+        return {"published": self.published, "parked": self.parked, "parked_now": len(self._parked),
+                "dropped": sum(s.dropped for s in self._subs), "subscriptions": [s.stats() for s in self._subs]}
@@ -0,0 +1,42 @@
+import os, threading
+from .provisioning import load_state, save_state
+# Hardware backend detection, lazy and cached. The first use of a device
+# class (RFID reader, GPIO) probes its backends in order; the winner (or
+# "mock") is remembered under `hw:` in the device state file, so the next
+# start loads only that backend instead of trying every library. A cached
+# backend that no longer loads is probed again; EG_HW_PROBE=1 ignores the
+# cache (e.g. after fitting a reader to a Pi that last started without one).
+# Without configure() (device host, all-in-one) results are per process.
+_lock = threading.Lock(); _path = None; _cache = None
+
+def configure(state_path: str | None):
+    global _path, _cache
+    with _lock: _path = state_path; _cache = None
+
+def _load():
+    global _cache
+    if _cache is None:
+        _cache = {} if _path is None or os.getenv("EG_HW_PROBE") == "1" else dict(load_state(_path).get("hw") or {})
+    return _cache
+
+def backend(key: str, probes: dict, default: str = "mock"):
+    # probes: name -> loader returning the backend object (raising when it is
+    # unavailable). Returns (name, object), or (default, None).
+    with _lock: hit = _load().get(key)
+    if hit == default: return default, None
+    order = sorted(probes, key=lambda n: n != hit)
+    for name in order:
+        try: obj = probes[name]()
+        except Exception: continue
+        remember(key, name); return name, obj
+    remember(key, default); return default, None
+
+def remember(key: str, name: str):
+    with _lock:
+        c = _load()
+        if c.get(key) == name: return
+        c[key] = name
+        if _path is None: return
+        st = load_state(_path); st["hw"] = dict(c)
+        try: save_state(_path, st)
+        except OSError as e: print(f"[hw] could not persist probe result: {e}")
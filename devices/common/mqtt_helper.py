@@ -1,22 +1,167 @@
 
-import os, json
-import paho.mqtt.client as mqtt
+import os, time, asyncio, itertools, threading
+from shared.transport import create_client, topic_matches
+from shared import codec
+from .outbox import Outbox
+from .telemetry import Telemetry
 class MqttClient:
-    def __init__(self, client_id: str, ns: str = "eg", host: str | None = None, port: int | None = None):
-        self.ns = ns
+    def __init__(self, client_id: str, ns: str = "eg", host: str | None = None, port: int | None = None, max_inflight: int | None = None,
+                 transport: str | None = None, codec: str | None = None, outbox: str | None = None, conn=None, clean_session: bool | None = None):
+        self.ns = ns; self.client_id = client_id
+        # Payload encoding for this device's publishes: "json" or "bin" (the
+        # core answers in kind). EG_CODEC overrides the default.
+        self.codec = codec or os.getenv("EG_CODEC","json")
         self.host = host or os.getenv("BROKER_HOST","localhost")
         self.port = int(port or os.getenv("BROKER_PORT","1883"))
-        self.client = mqtt.Client(client_id=client_id, clean_session=True)
-        self.client.enable_logger()
+        # conn: a SharedConnection carrying this device alongside others
+        # (devices/host.py); otherwise the device has its own connection.
+        # _subs: every filter this device holds (-> qos), re-sent on each
+        # connect, so a subscribe made before the CONNACK or lost with the
+        # session still takes effect. clean_session=None: MQTT_PERSISTENT.
+        self.conn = conn; self._subs = {}
+        self.client = conn.client if conn is not None else create_client(transport, client_id=client_id, clean_session=clean_session)
+        # request/response: req_ids are <client_id>-<boot nonce>-<counter>, so
+        # they never repeat across restarts; replies on dev/<id>/res resolve
+        # the matching future on the caller's event loop.
+        self.max_inflight = int(max_inflight or os.getenv("MQTT_MAX_INFLIGHT","32"))
+        self.res_topic = self.topic("dev", client_id, "res")
+        self._boot = os.urandom(4).hex(); self._seq = itertools.count(1)
+        self._pending = {}; self._sem = None; self._res_sub = False
+        self._user_on_message = None; self._user_on_connect = None
+        if conn is None: self.client.on_message = self._on_message; self.client.on_connect = self._on_connect; self.client.on_disconnect = self._on_disconnect
+        # send(): store-and-forward through a persistent outbox file, acked by the core.
+        self.outbox = Outbox(outbox, self._send_raw) if outbox else None
+        if self.outbox is not None: self._res_sub = True
+        # EG_TRACE (0..1): share of requests carrying trace context; > 0 also
+        # turns on RTT telemetry (TELEMETRY_SEC window, TRACE_SLOW_MS logged).
+        rate = float(os.getenv("EG_TRACE","0"))
+        self.telemetry = Telemetry(lambda b: self.publish(self.topic("dev", client_id, "telemetry"), b, qos=0), rate,
+                                   float(os.getenv("TELEMETRY_SEC","30")), float(os.getenv("TRACE_SLOW_MS","500")), client_id) if rate > 0 else None
     def connect(self, keepalive=30):
-        self.client.connect(self.host, self.port, keepalive=keepalive)
+        if self.conn is not None: self.conn.attach(self); return
+        # The network thread connects and retries with jittered backoff.
+        self.client.connect_async(self.host, self.port, keepalive=keepalive)
         self.client.loop_start()
     def topic(self, *parts):
         return "/".join([self.ns] + list(parts))
     def subscribe(self, topic: str, qos=1):
-        self.client.subscribe(topic, qos=qos)
-    def on_message(self, fn): self.client.on_message = fn
-    def on_connect(self, fn): self.client.on_connect = fn
+        self._subs[topic] = qos
+        if self.conn is None:
+            if self.client.is_connected(): self.client.subscribe(topic, qos=qos)
+            return
+        self.conn.subscribe(self, topic, qos)
+    def unsubscribe(self, topic: str):
+        if self._subs.pop(topic, None) is None: return
+        if self.conn is None: self.client.unsubscribe(topic); return
+        self.conn.unsubscribe(self, topic)
+    def on_message(self, fn): self._user_on_message = fn
+    def on_connect(self, fn):
+        # Handlers are often registered after connect(); don't miss the CONNACK.
+        self._user_on_connect = fn
+        if self.client.is_connected(): fn(self.client, None, None, 0)
     def publish(self, topic: str, payload: dict, qos=1, retain=False):
-        s = json.dumps(payload, separators=(",",":"))
-        self.client.publish(topic, s, qos=qos, retain=retain)
+        self.client.publish(topic, codec.encode(payload, self.codec), qos=qos, retain=retain)
+    def send(self, topic: str, payload: dict, key: str | None = None, qos=1):
+        # Must-deliver publish: survives broker outages and agent restarts.
+        # key doubles as req_id, which the core echoes back as the ack.
+        key = key or self.new_req_id(); body = {"device_id": self.client_id, **payload, "req_id": key}
+        if self.outbox is None: self.publish(topic, body, qos=qos); return key
+        self.outbox.put(key, topic, codec.encode(body, self.codec), qos); return key
+    def _send_raw(self, topic, payload, qos): self.client.publish(topic, payload, qos=qos)
+    def new_req_id(self) -> str:
+        return f"{self.client_id}-{self._boot}-{next(self._seq):x}"
+    async def request(self, topic: str, payload: dict, timeout: float = 5.0) -> dict:
+        loop = asyncio.get_running_loop()
+        if self._sem is None: self._sem = asyncio.Semaphore(self.max_inflight)
+        if not self._res_sub: self._res_sub = True; self.subscribe(self.res_topic, qos=1)
+        async with self._sem:
+            rid = self.new_req_id(); fut = loop.create_future(); self._pending[rid] = (loop, fut); tm = self.telemetry
+            body = {"device_id": self.client_id, **payload, "req_id": rid}
+            if tm is not None:
+                op = topic[len(self.ns)+6:] if topic.startswith(self.ns+"/core/") else topic
+                if tm.sample(): body["tr"] = {"s": round(time.time(), 6)}
+            t0 = time.perf_counter()
+            try: self.publish(topic, body); res = await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                if tm is not None: tm.timeout(op)
+                raise
+            finally: self._pending.pop(rid, None)
+            if tm is not None: tm.record(op, (time.perf_counter()-t0)*1000.0, res.get("tr"), rid)
+            return res
+    def inflight(self) -> int: return len(self._pending)
+    def _on_connect(self, c, u, f, rc):
+        if self.conn is None:
+            if self._res_sub and self.res_topic not in self._subs: c.subscribe(self.res_topic, qos=1)
+            for t, q in list(self._subs.items()): c.subscribe(t, qos=q)
+        if self.outbox is not None: self.outbox.on_connect()
+        if self._user_on_connect: self._user_on_connect(c, u, f, rc)
+    def _on_disconnect(self, c, u, rc):
+        if self.outbox is not None: self.outbox.on_disconnect()
+    def _on_message(self, c, u, m):
+        if m.topic == self.res_topic and (self._pending or self.outbox is not None):
+            try: body = codec.decode(m.payload)
+            except Exception: body = None
+            rid = body.get("req_id") if isinstance(body, dict) else None
+            entry = self._pending.pop(rid, None)
+            if entry:
+                loop, fut = entry; loop.call_soon_threadsafe(_resolve, fut, body); return
+            if self.outbox is not None and self.outbox.ack(rid): return
+        if self._user_on_message: self._user_on_message(c, u, m)
+def _resolve(fut, body):
+    if not fut.done(): fut.set_result(body)
+
+class SharedConnection:
+    # One broker connection for many MqttClients (pass conn=...). Each client
+    # keeps its own res topic, req_ids, outbox and callbacks; the connection
+    # ref-counts filters (a filter is unsubscribed at the broker once no
+    # client holds it) and routes each incoming message to every client
+    # holding a matching filter: exact topics by dict lookup, wildcard
+    # filters by scan. A client subscribing to a filter another client
+    # already holds re-sends the SUBSCRIBE so the broker replays retained
+    # messages for it; the others may see that retained message twice.
+    def __init__(self, client_id: str, host: str | None = None, port: int | None = None, transport: str | None = None, clean_session: bool | None = None):
+        self.client_id = client_id
+        self.host = host or os.getenv("BROKER_HOST","localhost"); self.port = int(port or os.getenv("BROKER_PORT","1883"))
+        self.client = create_client(transport, client_id=client_id, clean_session=clean_session)
+        self.client.on_message = self._on_message; self.client.on_connect = self._on_connect; self.client.on_disconnect = self._on_disconnect
+        self._lock = threading.Lock(); self._members = []; self._exact = {}; self._wild = {}; self._qos = {}
+        self.routed = 0; self.unrouted = 0
+    def connect(self, keepalive=30):
+        self.client.connect_async(self.host, self.port, keepalive=keepalive); self.client.loop_start()
+    def attach(self, mq):
+        with self._lock: self._members.append(mq)
+        if mq._res_sub: mq.subscribe(mq.res_topic, qos=1)
+        if self.client.is_connected(): mq._on_connect(self.client, None, None, 0)
+    def subscribe(self, mq, flt, qos=1):
+        with self._lock:
+            routes = self._wild if "+" in flt or "#" in flt else self._exact
+            holders = routes.setdefault(flt, [])
+            if mq not in holders: holders.append(mq)
+            self._qos[flt] = max(qos, self._qos.get(flt, 0))
+        self.client.subscribe(flt, qos=qos)
+    def unsubscribe(self, mq, flt):
+        with self._lock:
+            routes = self._wild if flt in self._wild else self._exact; holders = routes.get(flt, [])
+            if mq in holders: holders.remove(mq)
+            if holders: return
+            routes.pop(flt, None); self._qos.pop(flt, None)
+        self.client.unsubscribe(flt)
+    def _on_connect(self, c, u, f, rc):
+        with self._lock: subs = list(self._qos.items()); members = list(self._members)
+        for flt, q in subs: c.subscribe(flt, qos=q)
+        for mq in members: mq._on_connect(c, u, f, rc)
+    def _on_disconnect(self, c, u, rc):
+        with self._lock: members = list(self._members)
+        for mq in members: mq._on_disconnect(c, u, rc)
+    def _on_message(self, c, u, m):
+        with self._lock:
+            targets = list(self._exact.get(m.topic, ()))
+            for flt, holders in self._wild.items():
+                if topic_matches(flt, m.topic): targets += [h for h in holders if h not in targets]
+        if not targets: self.unrouted += 1; return
+        self.routed += 1
+        for mq in targets: mq._on_message(c, u, m)
+    def stats(self):
+        with self._lock:
+            return {"client_id": self.client_id, "connected": self.client.is_connected(), "devices": len(self._members),
+                    "filters": len(self._qos), "routed": self.routed, "unrouted": self.unrouted}
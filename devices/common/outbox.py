@@ -0,0 +1,84 @@
+import os, time, sqlite3, threading
+from collections import OrderedDict, deque
+# Store-and-forward for messages that must reach the core (payouts). put()
+# only appends to memory, so agents keep taking input at full speed while
+# the broker is away; a flusher thread commits new entries (and acked
+# deletions) to a local SQLite file every `flush_ms`, one fsync per batch.
+# While connected a drainer publishes unacked entries in put() order, at
+# most `rate` per second with at most `window` unacked at once, and resends
+# any that are not acked within `retry` seconds. The core acks on
+# dev/<id>/res with the entry's key as req_id; acked entries are dropped.
+# Duplicates (resend after a lost ack, restart between send and ack) are
+# absorbed by the core, which dedupes on the key.
+class Outbox:
+    def __init__(self, path: str, send, rate: float | None = None, window: int | None = None, retry: float | None = None,
+                 flush_ms: float | None = None):
+        self.path = path; self.send = send
+        self.rate = float(rate if rate is not None else os.getenv("OUTBOX_RATE","500")); self.window = int(window if window is not None else os.getenv("OUTBOX_WINDOW","64"))
+        self.retry = float(retry if retry is not None else os.getenv("OUTBOX_RETRY_SEC","5")); self.flush_ms = float(flush_ms if flush_ms is not None else os.getenv("OUTBOX_FLUSH_MS","50"))
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, topic TEXT NOT NULL, payload BLOB NOT NULL, qos INTEGER NOT NULL, ts REAL NOT NULL)")
+        self._lock = threading.Lock(); self._wake = threading.Condition(self._lock); self.connected = False
+        self._items = OrderedDict((r[0], (r[1], bytes(r[2]), r[3])) for r in self.conn.execute("SELECT key,topic,payload,qos FROM outbox ORDER BY seq"))
+        self._new = []; self._acked = []; self._todo = deque(); self._sent = OrderedDict()
+        self.queued = 0; self.sent = 0; self.resent = 0; self.acked = 0; self.fsyncs = 0
+        threading.Thread(target=self._flush_loop, name="outbox-flush", daemon=True).start()
+        threading.Thread(target=self._drain_loop, name="outbox-drain", daemon=True).start()
+    def put(self, key: str, topic: str, payload: bytes, qos: int = 1):
+        with self._lock:
+            if key in self._items: return
+            self._items[key] = (topic, payload, qos); self._new.append((key, topic, payload, qos, time.time())); self.queued += 1
+            if self.connected: self._todo.append(key); self._wake.notify()
+    def ack(self, key) -> bool:
+        with self._lock:
+            if self._items.pop(key, None) is None: return False
+            self._sent.pop(key, None); self._acked.append(key); self.acked += 1; self._wake.notify(); return True
+    def on_connect(self):
+        # Start over from the oldest unacked entry, in order.
+        with self._lock: self.connected = True; self._sent.clear(); self._todo = deque(self._items); self._wake.notify()
+    def on_disconnect(self):
+        with self._lock: self.connected = False
+    def pending(self) -> int: return len(self._items)
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_ms/1000.0)
+            with self._lock: new, self._new = self._new, []; acked, self._acked = self._acked, []
+            if not new and not acked: continue
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT OR IGNORE INTO outbox(key,topic,payload,qos,ts) VALUES(?,?,?,?,?)", new)
+                self.conn.executemany("DELETE FROM outbox WHERE key=?", [(k,) for k in acked])
+                self.conn.execute("COMMIT"); self.fsyncs += 1
+            except Exception as e:
+                print(f"[outbox] flush failed: {e}")
+                if self.conn.in_transaction: self.conn.execute("ROLLBACK")
+                with self._lock: self._new[:0] = new; self._acked[:0] = acked
+    def _drain_loop(self):
+        step = 1.0/self.rate if self.rate > 0 else 0.0; nxt = time.monotonic()
+        while True:
+            with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if self.connected:
+                        late = []
+                        while self._sent:
+                            k, t = next(iter(self._sent.items()))
+                            if now - t < self.retry: break
+                            del self._sent[k]; late.append(k); self.resent += 1
+                        self._todo.extendleft(reversed(late))
+                        while self._todo and self._todo[0] not in self._items: self._todo.popleft()
+                        if self._todo and len(self._sent) < self.window: break
+                    timeout = None
+                    if self.connected and self._sent: timeout = max(0.0, next(iter(self._sent.values())) + self.retry - now)
+                    self._wake.wait(timeout)
+                key = self._todo.popleft(); topic, payload, qos = self._items[key]; self._sent[key] = now
+            try: self.send(topic, payload, qos); self.sent += 1
+            except Exception as e: print(f"[outbox] send failed: {e}")
+            nxt = max(nxt + step, time.monotonic() - 1.0)
+            d = nxt - time.monotonic()
+            if d > 0: time.sleep(d)
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._items), "unacked_inflight": len(self._sent), "connected": self.connected, "queued": self.queued,
+                    "sent": self.sent, "resent": self.resent, "acked": self.acked, "fsyncs": self.fsyncs}
@@ -1,20 +1,27 @@
 
-import os, asyncio, yaml
-from .event_bus import Event
+import os
 DEFAULT_STATE_DIR = os.getenv("EG_STATE_DIR", None)
+# yaml is imported on first use (libyaml's C loader when available), and a
+# state file is parsed once per process: save_state() refreshes the copy.
+_states = {}
+def read_yaml(path: str) -> dict:
+    import yaml
+    with open(path,"r") as f: return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
 def state_path_for(agent_dir: str, device_kind: str) -> str:
     base = DEFAULT_STATE_DIR or os.path.join(agent_dir, "state")
     os.makedirs(base, exist_ok=True)
     return os.path.join(base, "device_state.yaml")
 def load_state(path: str):
+    if path in _states: return dict(_states[path])
     if not os.path.exists(path): return {}
-    try:
-        with open(path,"r") as f: return (yaml.safe_load(f) or {})
+    try: st = read_yaml(path)
     except Exception: return {}
+    _states[path] = st; return dict(st)
 def save_state(path: str, state: dict):
+    import yaml
     tmp = path + ".tmp"
     with open(tmp,"w") as f: yaml.safe_dump(state, f, sort_keys=False)
-    os.replace(tmp, path)
+    os.replace(tmp, path); _states[path] = dict(state)
 async def provision_device_id(bus, loop, agent_dir: str, device_kind: str, allowed_ids: list, gpio_pins: dict | None = None) -> str:
     state_file = state_path_for(agent_dir, device_kind)
     state = load_state(state_file)
@@ -29,23 +36,28 @@ async def provision_device_id(bus, loop, agent_dir: str, device_kind: str, allow
             if "menu_next" in btns: AsyncButton(int(btns["menu_next"]), "menu_next", bus, loop)
             if "menu_ok" in btns:   AsyncButton(int(btns["menu_ok"]),   "menu_ok",   bus, loop)
     except Exception as e: print("[provision] GPIO not available:", e)
-    while True:
-        ev = await bus.next()
-        if ev.type == "menu":
-            key = ev.data.get("key")
-            if key == "next": idx = (idx + 1) % len(allowed_ids); print_menu(allowed_ids, idx)
-            elif key == "prev": idx = (idx - 1) % len(allowed_ids); print_menu(allowed_ids, idx)
-            elif key == "ok":
-                selected = allowed_ids[idx]; print(f"[provision] Selected: {selected}")
-                state["device_id"] = selected; save_state(state_file, state); return selected
-        elif ev.type == "button":
-            name = ev.data.get("name"); edge = ev.data.get("edge")
-            if edge != "press": continue
-            if name == "menu_prev": idx = (idx - 1) % len(allowed_ids); print_menu(allowed_ids, idx)
-            elif name == "menu_next": idx = (idx + 1) % len(allowed_ids); print_menu(allowed_ids, idx)
-            elif name == "menu_ok":
-                selected = allowed_ids[idx]; print(f"[provision] Selected: {selected}")
-                state["device_id"] = selected; save_state(state_file, state); return selected
+    # Own subscription: menu/button events end here and never reach the
+    # agent's main loop, which starts only after provisioning returns.
+    sub = bus.subscribe("menu", "button")
+    try:
+        while True:
+            ev = await sub.get()
+            if ev.type == "menu":
+                key = ev.data.get("key")
+                if key == "next": idx = (idx + 1) % len(allowed_ids); print_menu(allowed_ids, idx)
+                elif key == "prev": idx = (idx - 1) % len(allowed_ids); print_menu(allowed_ids, idx)
+                elif key == "ok":
+                    selected = allowed_ids[idx]; print(f"[provision] Selected: {selected}")
+                    state["device_id"] = selected; save_state(state_file, state); return selected
+            elif ev.type == "button":
+                name = ev.data.get("name"); edge = ev.data.get("edge")
+                if edge != "press": continue
+                if name == "menu_prev": idx = (idx - 1) % len(allowed_ids); print_menu(allowed_ids, idx)
+                elif name == "menu_next": idx = (idx + 1) % len(allowed_ids); print_menu(allowed_ids, idx)
+                elif name == "menu_ok":
+                    selected = allowed_ids[idx]; print(f"[provision] Selected: {selected}")
+                    state["device_id"] = selected; save_state(state_file, state); return selected
+    finally: sub.close()
 def print_menu(allowed, idx):
     line = " | ".join([f"[{x}]" if i==idx else x for i,x in enumerate(allowed)])
     print(f">> {line}")
@@ -1,48 +1,90 @@
 
-import threading, time
+import os, threading, time
 from .event_bus import Event
+from . import hw
+def _simple():
+    from mfrc522 import SimpleMFRC522  # type: ignore
+    return SimpleMFRC522()
+def _lowlevel():
+    import MFRC522  # type: ignore
+    return MFRC522.MFRC522()
+class Presence:
+    # Collapses raw reads into one tag_present when a card has been seen for
+    # `dwell` seconds and one tag_removed after `absence` seconds without a
+    # read (missed reads shorter than that are ignored). A different card
+    # replacing the current one reads as removed + present.
+    def __init__(self, emit, dwell: float = 0.1, absence: float = 0.8):
+        self.emit = emit; self.dwell = dwell; self.absence = absence
+        self.uid = None; self.present = False; self.first = 0.0; self.last = 0.0
+    def seen(self, uid, now):
+        if uid != self.uid:
+            self._leave(); self.uid = uid; self.first = now
+        self.last = now
+        if not self.present and now - self.first >= self.dwell:
+            self.present = True; self.emit("tag_present", uid)
+    def tick(self, now):
+        if self.uid is not None and now - self.last > self.absence: self._leave()
+    def _leave(self):
+        if self.present: self.emit("tag_removed", self.uid)
+        self.uid = None; self.present = False
+    def active(self): return self.uid is not None
+
 class RFIDReader:
-    def __init__(self, bus, loop):
+    # Polls the reader and feeds a Presence tracker. The poll interval is
+    # `fast` while a card is (or just was) near the antenna and backs off to
+    # `slow` once the field has been empty for `idle` seconds. The reader
+    # backend is probed on the polling thread (hw caches the result), so it
+    # never holds up the agent's start.
+    def __init__(self, bus, loop, dwell: float | None = None, absence: float | None = None, fast: float | None = None,
+                 slow: float | None = None, idle: float | None = None):
         self.bus = bus; self.loop = loop; self._stop=False; self._thread=None
-        self._mode="mock"
-        try:
-            from mfrc522 import SimpleMFRC522  # type: ignore
-            self.reader = SimpleMFRC522(); self._mode="simple"
-        except Exception:
-            try:
-                import MFRC522  # type: ignore
-                self.mfrc = MFRC522.MFRC522(); self._mode="lowlevel"
-            except Exception:
-                self.reader=None
+        ms = lambda v, env, d: float(v) if v is not None else float(os.getenv(env, d))/1000.0
+        self.fast = ms(fast, "RFID_POLL_FAST_MS", "50"); self.slow = ms(slow, "RFID_POLL_SLOW_MS", "400"); self.idle = ms(idle, "RFID_IDLE_MS", "2000")
+        self.presence = Presence(self._emit, ms(dwell, "RFID_DWELL_MS", "100"), ms(absence, "RFID_ABSENCE_MS", "800"))
+        self.polls = 0; self.reads = 0; self.events = 0
+        self._mode=None; self.reader=None; self.mfrc=None
     def start(self):
         self._stop=False; self._thread=threading.Thread(target=self._run, daemon=True); self._thread.start()
     def stop(self):
         self._stop=True
         if self._thread: self._thread.join(timeout=0.2)
+    def _emit(self, kind, uid):
+        self.events += 1; self.bus.publish_threadsafe(self.loop, Event(kind, {"tag_uid": uid}))
     def _run(self):
+        self._mode, dev = hw.backend("rfid", {"simple": _simple, "lowlevel": _lowlevel})
+        if self._mode=="simple": self.reader = dev
+        elif self._mode=="lowlevel": self.mfrc = dev
         if self._mode=="simple": self._loop_simple()
         elif self._mode=="lowlevel": self._loop_lowlevel()
         else:
             print("[RFID] MOCK: use keyboard command 'r <UID>'")
             while not self._stop: time.sleep(0.5)
+    def _poll(self, read):
+        last = 0.0
+        while not self._stop:
+            now = time.monotonic(); self.polls += 1
+            try: uid = read()
+            except Exception: uid = None; time.sleep(0.3)
+            if uid: self.reads += 1; self.presence.seen(uid, now); last = now
+            else: self.presence.tick(now)
+            near = self.presence.active() or now - last < self.idle
+            time.sleep(self.fast if near else self.slow)
     def _loop_simple(self):
         print("[RFID] SimpleMFRC522 mode")
-        while not self._stop:
-            try:
-                id_val, _ = self.reader.read()
-                uid = f"{int(id_val):08X}"
-                self.loop.call_soon_threadsafe(self.bus.queue.put_nowait, Event("rfid_scan", {"tag_uid": uid}))
-            except Exception:
-                time.sleep(0.3)
+        def read():
+            # read_id_no_block() returns None when the field is empty, unlike
+            # read(), which blocks until a card shows up.
+            id_val = self.reader.read_id_no_block()
+            return f"{int(id_val):08X}" if id_val else None
+        self._poll(read)
     def _loop_lowlevel(self):
         print("[RFID] MFRC522 low-level mode")
-        while not self._stop:
-            try:
-                (status, TagType) = self.mfrc.MFRC522_Request(self.mfrc.PICC_REQIDL)
-                if status == self.mfrc.MI_OK:
-                    (status, uid) = self.mfrc.MFRC522_Anticoll()
-                    if status == self.mfrc.MI_OK and uid:
-                        uid_hex = "".join(f"{b:02X}" for b in uid[:5])
-                        self.loop.call_soon_threadsafe(self.bus.queue.put_nowait, Event("rfid_scan", {"tag_uid": uid_hex}))
-            except Exception:
-                time.sleep(0.3)
+        def read():
+            (status, TagType) = self.mfrc.MFRC522_Request(self.mfrc.PICC_REQIDL)
+            if status != self.mfrc.MI_OK: return None
+            (status, uid) = self.mfrc.MFRC522_Anticoll()
+            return "".join(f"{b:02X}" for b in uid[:5]) if status == self.mfrc.MI_OK and uid else None
+        self._poll(read)
+    def stats(self):
+        return {"mode": self._mode, "polls": self.polls, "reads": self.reads, "events": self.events,
+                "present": self.presence.uid if self.presence.present else None}
@@ -0,0 +1,41 @@
+import time, bisect, itertools
+# Per-device request latency (MqttClient.request), summarised per op over a
+# rolling window and published on <ns>/dev/<id>/telemetry every `interval`
+# seconds. The flush rides on the request path: no timer thread or task per
+# device, and an idle device sends nothing. A sampled share of requests
+# carries trace context ("tr": {"s": send time}); the core echoes it with ms
+# offsets from its receipt (q dequeued, db durable, pub published), which
+# splits those requests' RTT into network/broker vs core time.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Telemetry:
+    def __init__(self, publish, sample: float = 1.0, interval: float = 30.0, slow_ms: float = 500.0, name: str = "dev"):
+        self.publish = publish; self.interval = interval; self.slow_ms = slow_ms; self.name = name
+        self.every = round(1/sample) if sample > 0 else 0; self._n = itertools.count()
+        self._ops = {}; self._t0 = time.monotonic(); self.sent = 0
+    def sample(self) -> bool:
+        return self.every == 1 or (self.every > 0 and next(self._n) % self.every == 0)
+    def _op(self, op):
+        o = self._ops.get(op)
+        if o is None: o = self._ops[op] = {"n": 0, "b": [0]*(len(BUCKETS_MS)+1), "sum": 0.0, "to": 0, "nt": 0, "tsum": 0.0, "q": 0.0, "db": 0.0, "pub": 0.0, "max": None}
+        return o
+    def record(self, op, rtt_ms, tr=None, req_id=None):
+        o = self._op(op); o["n"] += 1; o["b"][bisect.bisect_left(BUCKETS_MS, rtt_ms)] += 1; o["sum"] += rtt_ms
+        seg = {"rtt": round(rtt_ms, 3), "req_id": req_id}
+        if type(tr) is dict and tr.get("pub") is not None:
+            o["nt"] += 1; o["tsum"] += rtt_ms
+            for k in ("q", "db", "pub"): o[k] += float(tr.get(k) or 0); seg[k] = tr.get(k)
+            seg["net"] = round(rtt_ms - float(tr["pub"]), 3)
+        if o["max"] is None or rtt_ms > o["max"]["rtt"]: o["max"] = seg
+        if rtt_ms >= self.slow_ms: print(f"[{self.name}] slow {op} {rtt_ms:.0f}ms {seg}")
+        self.maybe_flush()
+    def timeout(self, op):
+        self._op(op)["to"] += 1; self.maybe_flush()
+    def maybe_flush(self):
+        if time.monotonic() - self._t0 >= self.interval: self.flush()
+    def flush(self):
+        now = time.monotonic(); ops = self._ops; window = now - self._t0; self._ops = {}; self._t0 = now
+        if not ops: return
+        for o in ops.values():
+            for k in ("sum", "tsum", "q", "db", "pub"): o[k] = round(o[k], 3)
+        self.publish({"device_id": self.name, "window_s": round(window, 3), "le": BUCKETS_MS, "ops": ops}); self.sent += 1
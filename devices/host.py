@@ -0,0 +1,95 @@
+
+import os, asyncio, argparse, importlib, threading
+from .common.event_bus import EventBus, Event
+from .common.input_keyboard import keyboard_task
+from .common.mqtt_helper import MqttClient, SharedConnection
+from .common.provisioning import read_yaml
+# Device host: many virtual devices in one process, as coroutines on one
+# event loop sharing one multiplexed broker connection.
+#   python -m devices.host --config devices/host.yaml
+# Device ids come from the config (no interactive provisioning); pins default
+# to the kind's device_config.yaml. A spec with `count` expands its
+# device_id template: {kind: slot, device_id: "slot-{n:02d}", count: 8, start: 2}
+# -> slot-02..slot-09. The keyboard drives one device (--keyboard, default
+# the first); only slots with `rfid: true` poll a reader.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTBOX_KINDS = ("roulette", "blackjack")
+
+def load_config(path: str) -> dict: return read_yaml(path)
+
+def expand(specs: list) -> list:
+    out = []
+    for spec in specs:
+        n = int(spec.get("count", 1)); start = int(spec.get("start", 1))
+        for i in range(n):
+            d = {k: v for k, v in spec.items() if k not in ("count", "start")}
+            d["device_id"] = str(spec.get("device_id") or f"{spec['kind']}-{{n:02d}}").format(n=start+i); out.append(d)
+    return out
+
+def kind_pins(kind: str, cache={}) -> dict:
+    if kind not in cache:
+        path = os.path.join(ROOT, "devices", kind, "device_config.yaml")
+        cache[kind] = (load_config(path).get("pins") or {}) if os.path.exists(path) else {}
+    return cache[kind]
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1])
+    except OSError: pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Host:
+    # conn=None gives every device its own connection (the per-agent setup),
+    # which bench/host_bench.py uses as the baseline.
+    def __init__(self, loop, conn: SharedConnection | None = None, host: str | None = None, port: int | None = None):
+        self.loop = loop; self.conn = conn; self.host = host; self.port = port; self.devices = []; self.base_kb = rss_kb()
+    def add(self, spec: dict):
+        kind = spec["kind"]; did = spec["device_id"]; mod = importlib.import_module(f"devices.{kind}.agent")
+        outbox = None
+        if kind in OUTBOX_KINDS:
+            d = os.path.join(ROOT, "devices", kind, "state"); os.makedirs(d, exist_ok=True); outbox = os.path.join(d, f"outbox-{did}.db")
+        bus = EventBus(); mq = MqttClient(client_id=did, host=self.host, port=self.port, codec=spec.get("codec"), outbox=outbox, conn=self.conn)
+        mq.connect(); kw = {"rfid": bool(spec.get("rfid", False))} if kind == "slot" else {}
+        task = asyncio.create_task(mod.run(bus, self.loop, did, mq, spec.get("pins") or kind_pins(kind), **kw))
+        self.devices.append((kind, did, bus, mq, task)); return bus
+    def bus(self, device_id: str):
+        return next((b for _, d, b, _, _ in self.devices if d == device_id), None)
+    async def stop(self, timeout: float = 2.0):
+        for _, _, bus, _, task in self.devices:
+            if not task.done(): await bus.publish(Event("quit", {}))
+        await asyncio.wait([t for *_, t in self.devices], timeout=timeout)
+    def stats(self):
+        n = len(self.devices); kb = rss_kb()
+        return {"devices": n, "connections": 1 if self.conn is not None else n, "rss_kb": kb,
+                "rss_per_device_kb": round((kb - self.base_kb)/n, 1) if n else None, "threads": threading.active_count(),
+                "shared": self.conn.stats() if self.conn is not None else None}
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(__file__), "host.yaml"))
+    parser.add_argument("--keyboard", default=None, help="device_id the keyboard drives (default: first device)")
+    parser.add_argument("--stats-sec", type=float, default=0.0, help="print host stats every N seconds (0 = off)")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config); loop = asyncio.get_running_loop()
+    conn = SharedConnection(cfg.get("host_id") or f"host-{os.uname().nodename}"); conn.connect()
+    host = Host(loop, conn)
+    for spec in expand(cfg.get("devices") or []):
+        spec.setdefault("codec", cfg.get("codec")); host.add(spec); print(f"[host] {spec['kind']} {spec['device_id']}")
+    if not host.devices: print("[host] no devices configured"); return
+    print(f"[host] {host.stats()}")
+    kb_id = args.keyboard or host.devices[0][1]; kb = asyncio.create_task(keyboard_task(host.bus(kb_id), kb_id))
+
+    async def report():
+        while True: await asyncio.sleep(args.stats_sec); print(f"[host] {host.stats()}")
+    rep = asyncio.create_task(report()) if args.stats_sec > 0 else None
+    await next(t for _, d, _, _, t in host.devices if d == kb_id)
+    await host.stop()
+    kb.cancel()
+    if rep: rep.cancel()
+
+if __name__ == "__main__":
+    asyncio.run(main())
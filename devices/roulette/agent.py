@@ -6,9 +6,12 @@ from ..common.input_keyboard import keyboard_task
 from ..common.mqtt_helper import MqttClient
 from ..common.io_gpio import AsyncButton
 from ..common.identity import ensure_device_id
+from ..common.provisioning import state_path_for, read_yaml
+from ..common import hw
 
 def new_id(prefix):
-    return f"{prefix}-{int(datetime.utcnow().timestamp()*1000):x}"
+    # ms timestamp plus a random suffix: several tables can pay out in the same ms.
+    return f"{prefix}-{int(datetime.utcnow().timestamp()*1000):x}{os.urandom(2).hex()}"
 
 async def main():
     parser = argparse.ArgumentParser()
@@ -20,17 +23,20 @@ async def main():
     loop = asyncio.get_running_loop()
     kb = asyncio.create_task(keyboard_task(bus, "provision"))
 
-    import yaml
-    with open(args.config,"r") as f:
-        raw_cfg = yaml.safe_load(f) or {}
+    raw_cfg = read_yaml(args.config)
     pins = (raw_cfg.get("pins") or {})
 
     allowed_ids = ["roulette-01"]
     agent_dir = os.path.dirname(__file__)
-    device_id = await ensure_device_id(bus, loop, agent_dir, "roulette", allowed_ids, args.config, args.device_id, pins)
+    device_id = await ensure_device_id(bus, loop, agent_dir, "roulette", allowed_ids, raw_cfg, args.device_id, pins)
+    hw.configure(state_path_for(agent_dir, "roulette"))
     print(f"[roulette] device_id = {device_id}")
 
-    mq = MqttClient(client_id=device_id); mq.connect()
+    outbox = os.path.join(os.path.dirname(state_path_for(agent_dir, "roulette")), "outbox.db")
+    mq = MqttClient(client_id=device_id, codec=raw_cfg.get("codec"), outbox=outbox); mq.connect()
+    await run(bus, loop, device_id, mq, pins)
+
+async def run(bus, loop, device_id: str, mq, pins: dict):
     mq.on_connect(lambda c,u,f,rc: print(f"[{device_id}] MQTT rc={rc}"))
 
     if (pins.get("buttons") or {}).get("spin") is not None:
@@ -39,13 +45,15 @@ async def main():
     print("[roulette] CMD: g <amount> payout; 'b' -> 5000; GPIO 'spin' -> random payout; n/p/enter menu.")
 
     async def send_payout(amount:int):
+        # Through the outbox when there is one: keyed by payout_id, so a
+        # resend can never create a second payout.
         pid = new_id("p")
-        mq.publish(mq.topic("core","payouts","new"), {
+        mq.send(mq.topic("core","payouts","new"), {
             "payout_id": pid,
             "source": "roulette",
             "amount_cents": amount,
             "meta": {"round": new_id("R")}
-        })
+        }, key=pid)
 
     while True:
         ev = await bus.next()
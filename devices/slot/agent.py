@@ -1,12 +1,13 @@
 
-import os, asyncio, argparse
-from datetime import datetime
-from ..common.event_bus import EventBus
+import os, json, asyncio, argparse
+from ..common.event_bus import EventBus, Event
 from ..common.input_keyboard import keyboard_task
 from ..common.mqtt_helper import MqttClient
 from ..common.io_gpio import AsyncButton, AsyncOutput
 from ..common.rfid import RFIDReader
 from ..common.identity import ensure_device_id
+from ..common.provisioning import state_path_for, read_yaml
+from ..common import hw
 
 async def main():
     parser = argparse.ArgumentParser()
@@ -18,48 +19,93 @@ async def main():
     loop = asyncio.get_running_loop()
     kb = asyncio.create_task(keyboard_task(bus, "provision"))
 
-    import yaml
-    with open(args.config,"r") as f:
-        raw_cfg = yaml.safe_load(f) or {}
+    raw_cfg = read_yaml(args.config)
     pins = (raw_cfg.get("pins") or {})
 
     allowed_ids = [f"slot-{i:02d}" for i in range(1,10)]
     agent_dir = os.path.dirname(__file__)
-    device_id = await ensure_device_id(bus, loop, agent_dir, "slot", allowed_ids, args.config, args.device_id, pins)
+    device_id = await ensure_device_id(bus, loop, agent_dir, "slot", allowed_ids, raw_cfg, args.device_id, pins)
+    hw.configure(state_path_for(agent_dir, "slot"))
     print(f"[slot] device_id = {device_id}")
 
-    mq = MqttClient(client_id=device_id); mq.connect()
-    mq.subscribe(mq.topic("dev", device_id, "res"), qos=1)
-    mq.on_connect(lambda c,u,f,rc: print(f"[{device_id}] MQTT rc={rc}"))
-    mq.on_message(lambda c,u,m: print(f"[{device_id}] <- {m.topic} {m.payload.decode()}"))
+    mq = MqttClient(client_id=device_id, codec=raw_cfg.get("codec")); mq.connect()
+    await run(bus, loop, device_id, mq, pins)
+
+BALANCE_FALLBACK = float(os.getenv("BALANCE_FALLBACK_MS", "300"))/1000.0
+
+async def run(bus, loop, device_id: str, mq, pins: dict, rfid: bool = True):
+    # Event loop of the slot, minus bootstrap; reused by bench/fleet.py.
+    # Balances come from the core's retained eg/state/wallet/<tag>: the slot
+    # subscribes to the inserted tag and the broker hands over the current
+    # value. wallet_get is only sent if nothing arrives within
+    # BALANCE_FALLBACK_MS (a tag the core hasn't published yet).
+    wallet_prefix = mq.topic("state","wallet","")
+    def on_connect(c,u,f,rc):
+        print(f"[{device_id}] MQTT rc={rc}")
+        if tag_uid: mq.subscribe(wallet_prefix+tag_uid, qos=1)
+    def on_message(c,u,m):
+        if m.topic.startswith(wallet_prefix):
+            try: body = json.loads(m.payload)
+            except Exception: return
+            bus.publish_threadsafe(loop, Event("balance", {"tag_uid": m.topic[len(wallet_prefix):], **body})); return
+        print(f"[{device_id}] <- {m.topic} {m.payload.decode()}")
 
     btn_pin = (pins.get("buttons") or {}).get("bet")
     if btn_pin is not None: AsyncButton(int(btn_pin), "bet", bus, loop)
     lamp_pin = (pins.get("outputs") or {}).get("lamp")
     lamp = AsyncOutput(int(lamp_pin)) if lamp_pin is not None else None
 
-    rfid = RFIDReader(bus, loop); rfid.start()
+    if rfid: RFIDReader(bus, loop).start()
 
-    tag_uid = None
+    tag_uid = None; inflight = set(); balance = None; fallback = None
+    mq.on_connect(on_connect); mq.on_message(on_message)
     print("[slot] CMD: r <UID>, b (bet200), c (credit500), n/p/enter (menu), q")
 
+    async def call(op, body, reason=None):
+        # One request per task, so bets pipeline and each result is handled
+        # as soon as it arrives.
+        if reason: body["reason"] = reason
+        try: res = await mq.request(mq.topic("core","wallet",op), {"device_id": device_id, **body})
+        except asyncio.TimeoutError: print(f"[slot] {op} timed out"); return
+        if op == "get": bus.publish_nowait(Event("balance", {"tag_uid": body["tag_uid"], "balance_cents": res.get("balance_cents"), "v": 0}))
+        else: print(f"[slot] {op} {body.get('amount_cents')} -> {res.get('status')} balance = {res.get('new_balance_cents')}")
+
+    def spawn(op, body, reason=None):
+        t = asyncio.create_task(call(op, body, reason)); inflight.add(t); t.add_done_callback(inflight.discard)
+
     while True:
         ev = await bus.next()
         if ev.type == "quit": print("Bye."); break
-        if ev.type == "rfid_scan":
-            tag_uid = ev.data["tag_uid"].upper(); print(f"[slot] RFID {tag_uid}")
-            mq.publish(mq.topic("core","wallet","get"), {"req_id": f"{device_id}-{datetime.utcnow().timestamp()}","device_id": device_id,"tag_uid": tag_uid})
+        if ev.type in ("rfid_scan", "tag_present"):
+            # The reader reports a resting card once (tag_present); the
+            # keyboard's 'r <UID>' still sends rfid_scan.
+            new = ev.data["tag_uid"].upper(); print(f"[slot] RFID {new}")
+            if new == tag_uid and balance is not None: print(f"[slot] {tag_uid} balance = {balance[0]}")
+            elif new != tag_uid:
+                if tag_uid: mq.unsubscribe(wallet_prefix+tag_uid)
+                tag_uid = new; balance = None; mq.subscribe(wallet_prefix+tag_uid, qos=1)
+                if fallback: fallback.cancel()
+                fallback = loop.call_later(BALANCE_FALLBACK, lambda t=tag_uid: bus.publish_nowait(Event("balance_timeout", {"tag_uid": t})))
             if lamp: lamp.on()
+        elif ev.type == "balance":
+            if ev.data["tag_uid"] != tag_uid or (balance and ev.data.get("v", 0) <= balance[1]): continue
+            if balance is None: print(f"[slot] {tag_uid} balance = {ev.data['balance_cents']}")
+            balance = (ev.data["balance_cents"], ev.data.get("v", 0))
+            if fallback: fallback.cancel(); fallback = None
+        elif ev.type == "balance_timeout":
+            if ev.data["tag_uid"] == tag_uid and balance is None: spawn("get", {"tag_uid": tag_uid})
+        elif ev.type == "tag_removed":
+            if tag_uid == ev.data["tag_uid"].upper():
+                print(f"[slot] RFID {tag_uid} removed"); mq.unsubscribe(wallet_prefix+tag_uid); tag_uid = None; balance = None
+                if fallback: fallback.cancel(); fallback = None
+                if lamp: lamp.off()
         elif ev.type == "button":
             if ev.data.get("name")=="bet" and ev.data.get("edge")=="press":
-                if tag_uid:
-                    mq.publish(mq.topic("core","wallet","debit"), {"req_id": f"{device_id}-{datetime.utcnow().timestamp()}","device_id": device_id,"tag_uid": tag_uid,"amount_cents":200,"reason":"slot_bet"})
+                if tag_uid: spawn("debit", {"tag_uid": tag_uid, "amount_cents": 200}, "slot_bet")
         elif ev.type == "bet":
-            if tag_uid:
-                mq.publish(mq.topic("core","wallet","debit"), {"req_id": f"{device_id}-{datetime.utcnow().timestamp()}","device_id": device_id,"tag_uid": tag_uid,"amount_cents":ev.data["amount_cents"],"reason":"slot_bet"})
+            if tag_uid: spawn("debit", {"tag_uid": tag_uid, "amount_cents": ev.data["amount_cents"]}, "slot_bet")
         elif ev.type == "credit":
-            if tag_uid:
-                mq.publish(mq.topic("core","wallet","credit"), {"req_id": f"{device_id}-{datetime.utcnow().timestamp()}","device_id": device_id,"tag_uid": tag_uid,"amount_cents":ev.data["amount_cents"],"reason":"slot_win"})
+            if tag_uid: spawn("credit", {"tag_uid": tag_uid, "amount_cents": ev.data["amount_cents"]}, "slot_win")
 
 if __name__ == "__main__":
     asyncio.run(main())
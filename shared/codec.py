@@ -0,0 +1,108 @@
+import os, json, struct
+# Payload codecs, shared by the core and the agents so both ends of a
+# device<->core exchange agree on the binary schemas. The first byte is the
+# content-type marker:
+#   0xEB    compact binary for the fixed wallet/payout message shapes
+#   other   JSON (what browsers on the websocket listener speak)
+# decode() sniffs the marker, so each device picks its encoding (codec: in
+# device_config.yaml / EG_CODEC) and the core answers in the same one.
+# encode(obj, "bin") falls back to JSON when no schema fits the message.
+# JSON uses orjson when it is installed (EG_JSON=std forces the stdlib).
+MAGIC = 0xEB
+
+try:
+    if os.getenv("EG_JSON", "auto") == "std": raise ImportError
+    import orjson
+    JSON_BACKEND = "orjson"; _loads = orjson.loads
+    def _dumps(o):
+        # orjson refuses what the stdlib takes (ints past 64 bits).
+        try: return orjson.dumps(o)
+        except TypeError: return json.dumps(o, separators=(",", ":")).encode("utf-8")
+except ImportError:
+    JSON_BACKEND = "json"
+    def _dumps(o): return json.dumps(o, separators=(",", ":"))
+    _loads = json.loads
+
+# Strings that show up in almost every message go on the wire as one byte.
+ENUM = ["ok", "insufficient", "error", "not_found", "already_claimed", "busy",
+        "wallet_get", "wallet_debit", "wallet_credit", "payout_claim", "payout_new",
+        "slot_bet", "slot_win", "roulette", "blackjack", "unknown"]
+_ENUM = {s: i for i, s in enumerate(ENUM)}
+
+class _Schema:
+    # fields: (key, kind) with kind s=str, i=int64, e=ENUM str, j=any JSON.
+    # Layout: <MAGIC sid presence-mask> then per field q|B|H(length), then
+    # the str/JSON bytes in field order. Absent (or None) fields clear their
+    # mask bit and decode as missing keys.
+    def __init__(self, sid, name, fields):
+        self.sid = sid; self.name = name; self.fields = fields; self.keys = frozenset(k for k, _ in fields)
+        self.st = struct.Struct("<BBH" + "".join({"s": "H", "j": "H", "i": "q", "e": "B"}[k] for _, k in fields))
+    def encode(self, obj):
+        mask = 0; head = []; tail = []
+        for bit, (key, kind) in enumerate(self.fields):
+            v = obj.get(key)
+            if v is None: head.append(0); continue
+            mask |= 1 << bit
+            if kind == "i":
+                if type(v) is not int or not -0x8000000000000000 <= v <= 0x7FFFFFFFFFFFFFFF: return None
+                head.append(v)
+            elif kind == "e":
+                c = _ENUM.get(v)
+                if c is None: return None
+                head.append(c)
+            else:
+                if kind == "s":
+                    if type(v) is not str: return None
+                    b = v.encode("utf-8")
+                else:
+                    b = _dumps(v)
+                    if type(b) is str: b = b.encode("utf-8")
+                if len(b) > 0xFFFF: return None
+                head.append(len(b)); tail.append(b)
+        return self.st.pack(MAGIC, self.sid, mask, *head) + b"".join(tail)
+    def decode(self, buf):
+        vals = self.st.unpack_from(buf, 0); mask = vals[2]; off = self.st.size; out = {}
+        for bit, (key, kind) in enumerate(self.fields):
+            v = vals[3+bit]
+            if kind in "sj":
+                if mask >> bit & 1:
+                    b = buf[off:off+v]
+                    out[key] = b.decode("utf-8") if kind == "s" else _loads(b)
+                off += v
+            elif mask >> bit & 1: out[key] = ENUM[v] if kind == "e" else v
+        return out
+
+SCHEMAS = [
+    _Schema(1, "wallet_req", [("req_id","s"), ("device_id","s"), ("tag_uid","s"), ("amount_cents","i"), ("reason","e"), ("tr","j")]),
+    _Schema(2, "claim_req", [("req_id","s"), ("device_id","s"), ("payout_id","s"), ("tag_uid","s"), ("tr","j")]),
+    _Schema(3, "payout_new", [("payout_id","s"), ("source","e"), ("amount_cents","i"), ("req_id","s"), ("device_id","s"), ("meta","j")]),
+    _Schema(4, "wallet_res", [("req_id","s"), ("type","e"), ("status","e"), ("balance_cents","i"), ("new_balance_cents","i"), ("credited_cents","i"), ("tr","j")]),
+]
+_BY_ID = {s.sid: s for s in SCHEMAS}; _BY_KEYS = {}
+
+def _schema_for(obj):
+    ks = frozenset(obj)
+    try: return _BY_KEYS[ks]
+    except KeyError: pass
+    s = next((s for s in SCHEMAS if ks <= s.keys), None)
+    if len(_BY_KEYS) < 256: _BY_KEYS[ks] = s
+    return s
+
+def encode(obj, ctype: str = "json"):
+    if ctype == "bin" and type(obj) is dict:
+        s = _schema_for(obj)
+        if s is not None:
+            b = s.encode(obj)
+            if b is not None: return b
+    return _dumps(obj)
+
+def decode(payload):
+    if not payload: return None
+    if payload[0] == MAGIC:
+        s = _BY_ID.get(payload[1])
+        if s is None: raise ValueError(f"unknown binary schema {payload[1]}")
+        return s.decode(payload)
+    return _loads(payload)
+
+def content_type(payload) -> str:
+    return "bin" if payload and payload[0] == MAGIC else "json"
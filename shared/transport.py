@@ -0,0 +1,212 @@
+import os, time, random, threading, queue, itertools
+# MQTT transports, shared by the core and the agents (the core image ships
+# this package next to core.py); one module per process, so an all-in-one
+# process has a single loopback broker for core and devices. Both backends
+# expose the subset of paho's Client API that core.py and
+# devices/common/mqtt_helper.py use: on_connect/on_message
+# attributes, connect, loop_start/loop_stop, disconnect, subscribe,
+# unsubscribe, publish, is_connected.
+#
+#   paho      real broker over TCP (default)
+#   loopback  in-process broker: MQTT wildcard matching, retained messages,
+#             QoS-1 at-least-once delivery (queued for offline
+#             clean_session=False clients), $share/<group>/<filter> shared
+#             subscriptions (round-robin). No sockets, so an all-in-one
+#             install or a benchmark pays no TCP/broker hop.
+#
+# Select with EG_TRANSPORT or the `kind` argument of create_client().
+#
+# Sessions are persistent (clean_session=False) unless MQTT_PERSISTENT=0:
+# the broker keeps subscriptions and queues QoS-1 messages while a client is
+# away. Connect with connect_async(): the network thread retries, waiting
+# between RECONNECT_MIN_SEC and RECONNECT_MAX_SEC (doubling per failure) with
+# full jitter, so a fleet coming back after a broker restart spreads out
+# instead of reconnecting in the same instant (RECONNECT_JITTER=0: paho's
+# fixed doubling).
+def persistent() -> bool: return os.getenv("MQTT_PERSISTENT", "1") != "0"
+
+def create_client(kind: str | None = None, client_id: str = "", clean_session: bool | None = None):
+    kind = kind or os.getenv("EG_TRANSPORT", "paho")
+    if clean_session is None: clean_session = not persistent()
+    if kind == "paho":
+        c = _paho_class()(client_id=client_id, clean_session=clean_session); c.enable_logger()
+        c.reconnect_delay_set(float(os.getenv("RECONNECT_MIN_SEC", "1")), float(os.getenv("RECONNECT_MAX_SEC", "10"))); return c
+    if kind == "loopback": return LoopbackClient(client_id, clean_session)
+    raise ValueError(f"unknown transport {kind!r}")
+
+_paho = None
+def _paho_class():
+    global _paho
+    if _paho is not None: return _paho
+    import paho.mqtt.client as mqtt
+    class Client(mqtt.Client):
+        jitter = os.getenv("RECONNECT_JITTER", "1") != "0"
+        reconnects = 0
+        def _reconnect_wait(self):
+            # paho's delay schedule, slept as uniform(0, delay) ("full jitter").
+            self.reconnects += 1
+            if not self.jitter: return super()._reconnect_wait()
+            with self._reconnect_delay_mutex:
+                d = self._reconnect_delay = self._reconnect_min_delay if self._reconnect_delay is None else min(self._reconnect_delay*2, self._reconnect_max_delay)
+            end = time.monotonic() + random.uniform(0, d)
+            while self._state != mqtt.mqtt_cs_disconnecting and not self._thread_terminate and time.monotonic() < end:
+                time.sleep(min(end - time.monotonic(), 0.1))
+    _paho = Client; return Client
+
+def topic_matches(flt: str, topic: str) -> bool:
+    f = flt.split("/"); t = topic.split("/")
+    for i, p in enumerate(f):
+        if p == "#": return True
+        if i >= len(t) or (p != "+" and p != t[i]): return False
+    return len(f) == len(t)
+
+def share_group(flt: str):
+    # "$share/<group>/<filter>" -> (group, filter); plain filters -> (None, flt).
+    if not flt.startswith("$share/"): return None, flt
+    _, g, f = flt.split("/", 2); return g, f
+
+class Message:
+    __slots__ = ("topic", "payload", "qos", "retain", "mid")
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0):
+        self.topic = topic; self.payload = payload; self.qos = qos; self.retain = retain; self.mid = mid
+
+class MessageInfo:
+    # Loopback publishes are handed off synchronously, so they are "sent"
+    # as soon as publish() returns.
+    rc = 0
+    def __init__(self, mid): self.mid = mid
+    def wait_for_publish(self, timeout=None): return None
+    def is_published(self): return True
+
+class LoopbackBroker:
+    def __init__(self, name: str = "default"):
+        self.name = name; self.lock = threading.Lock(); self.sessions = {}; self.retained = {}; self._rr = {}
+        self.msgs_in = 0; self.msgs_out = 0
+    def attach(self, client):
+        with self.lock:
+            s = self.sessions.get(client.client_id); old = s.client if s else None
+            present = not (s is None or client.clean_session or s.clean)
+            if not present: s = _Session(client.clean_session); self.sessions[client.client_id] = s
+            s.client = client; backlog, s.backlog = s.backlog, []
+        if old is not None and old is not client: old._detached()
+        return present, backlog
+    def detach(self, client):
+        with self.lock:
+            s = self.sessions.get(client.client_id)
+            if s is None or s.client is not client: return
+            s.client = None
+            if s.clean: del self.sessions[client.client_id]
+    def subscribe(self, client, flt, qos):
+        with self.lock:
+            s = self.sessions[client.client_id]; s.subs[flt] = min(qos, 1)
+            # Retained messages are not sent to shared subscriptions.
+            ret = [] if flt.startswith("$share/") else [(t, p, q) for t, (p, q) in self.retained.items() if topic_matches(flt, t)]
+        for t, p, q in ret: client._deliver(Message(t, p, min(q, qos), True)); self.msgs_out += 1
+    def unsubscribe(self, client, flt):
+        with self.lock:
+            s = self.sessions.get(client.client_id)
+            if s: s.subs.pop(flt, None)
+    def publish(self, topic, payload, qos, retain):
+        with self.lock:
+            self.msgs_in += 1
+            if retain:
+                if payload: self.retained[topic] = (payload, qos)
+                else: self.retained.pop(topic, None)
+            targets = []; shared = {}
+            for s in self.sessions.values():
+                q = None
+                for f, sq in s.subs.items():
+                    g, f = share_group(f)
+                    if not topic_matches(f, topic): continue
+                    if g is None: q = sq if q is None else max(q, sq)
+                    else: shared.setdefault((g, f), []).append((s, sq))
+                if q is None: continue
+                q = min(q, qos)
+                if s.client is not None: targets.append((s.client, q))
+                elif q: s.backlog.append(Message(topic, payload, q))
+            for k, members in shared.items():
+                # One member per group, round-robin over the online ones.
+                online = [m for m in members if m[0].client is not None] or members
+                n = self._rr[k] = self._rr.get(k, -1) + 1; s, q = online[n % len(online)]; q = min(q, qos)
+                if s.client is not None: targets.append((s.client, q))
+                elif q: s.backlog.append(Message(topic, payload, q))
+        for c, q in targets: c._deliver(Message(topic, payload, q)); self.msgs_out += 1
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "online": sum(1 for s in self.sessions.values() if s.client is not None),
+                    "retained": len(self.retained), "msgs_in": self.msgs_in, "msgs_out": self.msgs_out,
+                    "backlog": sum(len(s.backlog) for s in self.sessions.values())}
+
+class _Session:
+    __slots__ = ("clean", "subs", "client", "backlog")
+    def __init__(self, clean): self.clean = clean; self.subs = {}; self.client = None; self.backlog = []
+
+_brokers = {}; _brokers_lock = threading.Lock()
+def loopback_broker(host: str = "localhost", port: int = 1883) -> LoopbackBroker:
+    # One broker per (host, port), so isolated test rigs can coexist.
+    with _brokers_lock:
+        b = _brokers.get((host, port))
+        if b is None: b = _brokers[(host, port)] = LoopbackBroker(f"{host}:{port}")
+        return b
+
+class LoopbackClient:
+    # Callbacks run on the client's own delivery thread (started by
+    # loop_start), like paho's network thread, so handlers never run inside
+    # the publisher's call stack.
+    def __init__(self, client_id: str = "", clean_session: bool = True, userdata=None):
+        self.client_id = client_id or f"loopback-{id(self):x}"; self.clean_session = clean_session; self.userdata = userdata
+        self.on_connect = None; self.on_message = None; self.on_disconnect = None
+        self.broker = None; self._addr = None; self._inbox = queue.SimpleQueue(); self._thread = None; self._mid = itertools.count(1)
+        self._unsent = []
+    def enable_logger(self, logger=None): pass
+    def connect(self, host: str = "localhost", port: int = 1883, keepalive: int = 60):
+        self._addr = (host, int(port)); self.broker = loopback_broker(*self._addr); present, backlog = self.broker.attach(self)
+        self._inbox.put(("connect", {"session present": int(present)}))
+        for m in backlog: self._deliver(m)
+        # Like paho, QoS>0 publishes made while offline go out on connect.
+        unsent, self._unsent = self._unsent, []
+        for m in unsent: self.broker.publish(m.topic, m.payload, m.qos, m.retain)
+        return 0
+    def connect_async(self, host: str = "localhost", port: int = 1883, keepalive: int = 60): return self.connect(host, port, keepalive)
+    def reconnect_delay_set(self, min_delay=1, max_delay=120): pass
+    def reconnect(self): return self.connect(*self._addr) if self._addr else 1
+    def disconnect(self):
+        if self.broker: self.broker.detach(self); self.broker = None; self._inbox.put(("disconnect", 0))
+        return 0
+    def _detached(self):
+        # Session taken over by another client with the same id.
+        self.broker = None; self._inbox.put(("disconnect", 7))
+    def is_connected(self): return self.broker is not None
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=f"loopback-{self.client_id}", daemon=True); self._thread.start()
+        return 0
+    def loop_stop(self, force=False):
+        if self._thread is not None: self._inbox.put(("stop", None)); self._thread.join(timeout=1); self._thread = None
+        return 0
+    def subscribe(self, topic, qos=0):
+        if self.broker is None: return (4, None)
+        self.broker.subscribe(self, topic, qos); return (0, next(self._mid))
+    def unsubscribe(self, topic):
+        if self.broker is not None: self.broker.unsubscribe(self, topic)
+        return (0, next(self._mid))
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = next(self._mid)
+        if isinstance(payload, str): payload = payload.encode("utf-8")
+        elif payload is None: payload = b""
+        if self.broker is not None: self.broker.publish(topic, bytes(payload), qos, retain)
+        elif qos: self._unsent.append(Message(topic, bytes(payload), qos, retain, mid))
+        return MessageInfo(mid)
+    def _deliver(self, m): self._inbox.put(("message", m))
+    def _loop(self):
+        while True:
+            kind, arg = self._inbox.get()
+            try:
+                if kind == "message":
+                    if self.on_message: self.on_message(self, self.userdata, arg)
+                elif kind == "connect":
+                    if self.on_connect: self.on_connect(self, self.userdata, arg, 0)
+                elif kind == "disconnect":
+                    if self.on_disconnect: self.on_disconnect(self, self.userdata, arg)
+                elif kind == "stop": return
+            except Exception as e: print(f"[loopback] {self.client_id} callback failed: {e}")
@@ -0,0 +1,11 @@
+import os, sys, pytest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for p in (ROOT, os.path.join(ROOT, "core")):
+    if p not in sys.path: sys.path.insert(0, p)
+
+@pytest.fixture
+def db(tmp_path):
+    # Group commit on, with a batch window wide enough that ops submitted
+    # back to back land in one batch.
+    from db import DB
+    return DB(str(tmp_path / "core.db"), batch_max=64, batch_ms=50)
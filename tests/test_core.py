@@ -0,0 +1,53 @@
+import os, json, queue, pytest
+# The core end to end over the loopback transport: requests published as a
+# device would, replies read from dev/<id>/res.
+
+@pytest.fixture(scope="module")
+def core(tmp_path_factory):
+    d = tmp_path_factory.mktemp("core")
+    os.environ.update(EG_TRANSPORT="loopback", DB_PATH=str(d / "core.db"), TXLOG_ROTATE_SEC="0", LEDGER_BATCH_MS="20")
+    import core
+    core.start_mqtt(); return core
+
+@pytest.fixture
+def dev(core):
+    from shared.transport import create_client
+    c = create_client("loopback", "test-dev", clean_session=True); res = queue.Queue()
+    c.on_message = lambda c, u, m: res.put(json.loads(m.payload))
+    c.connect("localhost", 1883); c.loop_start(); c.subscribe("eg/dev/test-dev/res", 1)
+    def send(op, **body):
+        c.publish(f"eg/core/{op}", json.dumps({"device_id": "test-dev", **body}), qos=1)
+    def replies(n):
+        return [res.get(timeout=5) for _ in range(n)]
+    yield send, replies
+    c.disconnect()
+
+def test_debit_replay_charges_once(core, dev):
+    send, replies = dev
+    send("wallet/credit", tag_uid="C1", amount_cents=1000, req_id="c1"); send("wallet/debit", tag_uid="C1", amount_cents=300, req_id="d1")
+    send("wallet/debit", tag_uid="C1", amount_cents=300, req_id="d1")
+    r = replies(3)
+    assert [(x["req_id"], x["new_balance_cents"]) for x in r] == [("c1", 1000), ("d1", 700), ("d1", 700)]
+    assert core.db.get_balance("C1") == 700
+
+def test_get_after_debit_sees_it(core, dev):
+    send, replies = dev
+    send("wallet/credit", tag_uid="C2", amount_cents=700, req_id="c2"); replies(1)
+    send("wallet/debit", tag_uid="C2", amount_cents=100, req_id="d2"); send("wallet/get", tag_uid="C2", req_id="g2")
+    r = replies(2)
+    assert [(x["req_id"], x.get("new_balance_cents", x.get("balance_cents"))) for x in r] == [("d2", 600), ("g2", 600)]
+
+def test_claim_many_partial(core, dev):
+    send, replies = dev
+    for pid, amt in (("M1", 200), ("M2", 300)): core.db.submit("create_payout", pid, "roulette-01", amt, {}).result(2)
+    send("payouts/claim", tag_uid="C3", payout_id="M2", req_id="k1"); replies(1)
+    send("payouts/claim_many", tag_uid="C3", payout_ids=["M1", "M2"], req_id="k2")
+    r, = replies(1)
+    assert r["status"] == "ok" and r["credited_cents"] == 200 and r["new_balance_cents"] == 500
+    assert [x["status"] for x in r["results"]] == ["ok", "already_claimed"]
+
+def test_unknown_tag_read_creates_nothing(core, dev):
+    send, replies = dev
+    send("wallet/get", tag_uid="NOPE", req_id="g3")
+    assert replies(1)[0]["balance_cents"] == 0
+    assert core.db.conn.execute("SELECT COUNT(*) FROM wallets WHERE tag_uid='NOPE'").fetchone()[0] == 0
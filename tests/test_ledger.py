@@ -0,0 +1,73 @@
+import pytest
+from db import Abort, MISS
+
+def test_group_commit_one_batch(db):
+    fs = [db.submit("credit", "T1", 100, "dev", "wallet_credit") for _ in range(5)]
+    assert [f.result(2) for f in fs] == [100, 200, 300, 400, 500]
+    assert db.commits == 1 and db.batched_ops == 5
+    assert db.get_balance("T1") == 500
+
+def test_failing_op_rolls_back_alone(db):
+    def boom(tag):
+        db._credit(tag, 50, "dev", "wallet_credit"); raise RuntimeError("boom")
+    db._boom = boom
+    a = db.submit("credit", "T1", 10, "dev", "wallet_credit"); b = db.submit("boom", "T1"); c = db.submit("debit", "T1", 3, "dev", "wallet_debit")
+    assert a.result(2) == 10 and c.result(2) == 7
+    with pytest.raises(RuntimeError): b.result(2)
+    assert db.commits == 1 and db.get_balance("T1") == 7
+
+def test_debit_insufficient(db):
+    assert db.submit("debit", "T1", 1, "dev", "wallet_debit").result(2) is None
+    assert db.get_balance("T1") == 0
+
+def test_read_waits_for_queued_writes(db):
+    db.submit("credit", "T1", 700, "dev", "wallet_credit").result(2)
+    f = db.submit("debit", "T1", 100, "dev", "wallet_debit", tag="T1")
+    assert db.queued("T1") and not db.queued("T2")
+    g = db.submit("balance", "T1")
+    assert g.result(2) == 600 and f.result(2) == 600 and not db.queued("T1")
+
+def test_idem_replays_result(db):
+    a = db.submit("idem", "dev", "r1", "debit", "T1", 5, "dev", "wallet_debit")
+    db.submit("credit", "T1", 100, "dev", "wallet_credit").result(2)
+    assert a.result(2) is None  # insufficient, and stored as such
+    assert db.submit("idem", "dev", "r2", "debit", "T1", 30, "dev", "wallet_debit").result(2) == 70
+    assert db.submit("idem", "dev", "r2", "debit", "T1", 30, "dev", "wallet_debit").result(2) == 70
+    assert db.replay("dev", "r2") == 70 and db.replay("dev", "r3") is MISS
+    assert db.get_balance("T1") == 70 and db.idem_stats()["table_rows"] == 2
+
+def test_idem_failed_op_not_stored(db):
+    db._boom = lambda: 1/0
+    with pytest.raises(ZeroDivisionError): db.submit("idem", "dev", "r1", "boom").result(2)
+    assert db.submit("idem", "dev", "r1", "credit", "T1", 5, "dev", "wallet_credit").result(2) == 5
+
+def test_atomic_all_or_nothing(db):
+    ok = db.atomic(("credit", "T1", 10, "dev", "wallet_credit"), ("credit", "T2", 20, "dev", "wallet_credit")).result(2)
+    assert ok == [10, 20]
+    with pytest.raises(TypeError):
+        db.atomic(("credit", "T1", 10, "dev", "wallet_credit"), ("debit", "T2", None, "dev", "wallet_debit")).result(2)
+    assert (db.get_balance("T1"), db.get_balance("T2")) == (10, 20)
+
+def test_abort_rolls_back_with_result(db):
+    def give_up(tag):
+        db._credit(tag, 99, "dev", "wallet_credit"); raise Abort({"status": "nope"})
+    db._give_up = give_up
+    assert db.submit("give_up", "T1").result(2) == {"status": "nope"}
+    assert db.get_balance("T1") == 0
+
+def pay(db, *amounts):
+    for i, a in enumerate(amounts): db.submit("create_payout", f"P{i}", "roulette-01", a, {}).result(2)
+
+def test_claim_many_partial(db):
+    pay(db, 500, 700); db.submit("claim_credit", "P1", "OTHER", "chg").result(2)
+    res = db.submit("claim_many", ["P0", "P1", "PX"], "T1", "chg").result(2)
+    assert [(r["payout_id"], r["status"], r["credited_cents"]) for r in res["results"]] == [
+        ("P0", "ok", 500), ("P1", "already_claimed", 0), ("PX", "not_found", 0)]
+    assert res["status"] == "ok" and res["credited_cents"] == 500 and res["new_balance_cents"] == 500
+
+def test_claim_many_all_or_none(db):
+    pay(db, 500, 700); db.submit("claim_credit", "P1", "OTHER", "chg").result(2)
+    res = db.submit("claim_many", ["P0", "P1"], "T1", "chg", True).result(2)
+    assert res["status"] == "already_claimed" and [r["status"] for r in res["results"]] == ["rolled_back", "already_claimed"]
+    assert db.get_balance("T1") == 0
+    assert db.submit("claim_many", ["P0"], "T1", "chg").result(2)["credited_cents"] == 500